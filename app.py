@@ -8,21 +8,22 @@ import time
 import src.styles as shadcn_style
 from src.localization import t
 from src.utils import (
-    extract_text_from_pdf, 
-    extract_text_from_docx, 
     check_bloom_criteria, 
     export_to_excel, 
     save_analysis_history,
     create_error_response,
+    create_pending_response,
     get_text_color_for_bloom, # Helper for UI
     get_bloom_color
 )
 from src.analysis import (
-    extract_questions, 
+    extract_uploaded_file, 
     analyze_question, 
+    get_analysis_settings,
     AI_PROVIDERS, 
     DEFAULT_PROVIDER, 
     DEFAULT_MODEL_NAME,
+    DEFAULT_BATTLE_CONTESTANTS,
     improve_question_with_ai,
     generate_exam_with_ai
 )
@@ -32,8 +33,11 @@ from src.ui import (
     render_dashboard_overview, 
     render_detailed_results, 
     render_history_sidebar_v2,
-    render_user_manual
+    render_user_manual,
+    follow_job
 )
+from src.jobs import submit_analysis_job, resume_unfinished_jobs
+from src.database import verify_job_access
 
 # --- 2. Setup Page ---
 st.set_page_config(
@@ -52,11 +56,29 @@ load_custom_css()
 # --- 2. Session State ---
 if 'analysis_results' not in st.session_state: st.session_state.analysis_results = None
 if 'question_texts' not in st.session_state: st.session_state.question_texts = []
+if 'question_items' not in st.session_state: st.session_state.question_items = None
 if 'custom_prompt' not in st.session_state: st.session_state.custom_prompt = ""
 if 'selected_provider' not in st.session_state: st.session_state.selected_provider = DEFAULT_PROVIDER
 if 'selected_model' not in st.session_state: st.session_state.selected_model = DEFAULT_MODEL_NAME
 if 'language' not in st.session_state: st.session_state.language = 'th'
 if 'last_uploaded_file_name' not in st.session_state: st.session_state.last_uploaded_file_name = ""
+if 'batch_mode' not in st.session_state: st.session_state.batch_mode = False
+if 'failover' not in st.session_state: st.session_state.failover = False
+if 'hedging' not in st.session_state: st.session_state.hedging = False
+if 'battle_contestants' not in st.session_state: st.session_state.battle_contestants = [list(c) for c in DEFAULT_BATTLE_CONTESTANTS]
+if 'job_error' not in st.session_state: st.session_state.job_error = None
+if 'active_job_id' not in st.session_state:
+    # กลับมาติดตาม job เดิมหลัง reload หน้า (job id + token อยู่ใน URL ที่ session นี้สร้างไว้)
+    job_param = st.query_params.get("job")
+    job_id = int(job_param) if job_param and job_param.isdigit() else None
+    if job_id and not verify_job_access(job_id, st.query_params.get("key")):
+        job_id = None
+        st.query_params.pop("job", None)
+        st.query_params.pop("key", None)
+    st.session_state.active_job_id = job_id
+
+# ทำ job ที่ค้างจาก process ก่อนหน้า (restart/crash) ต่อ — ทำครั้งเดียวต่อ process
+resume_unfinished_jobs()
 
 # --- 3. Main Logic ---
 
@@ -74,6 +96,18 @@ with st.sidebar:
     
     st.caption(f"{t('model_used')}: `{st.session_state.selected_model}`")
     
+    from src.database import get_analysis_cache_stats
+    cache_stats = get_analysis_cache_stats()
+    st.caption(f"♻️ Cache: {cache_stats['entries']} รายการ · hit {cache_stats['hits']} / miss {cache_stats['misses']} ({cache_stats['hit_rate']}%)")
+    from src.prompt_budget import get_prompt_token_stats
+    for usage in get_prompt_token_stats()["summary"]:
+        actual = f" · จริง ~{usage['avg_actual']}" if usage['avg_actual'] is not None else ""
+        st.caption(f"🧮 `{usage['model']}`: {usage['requests']} คำขอ · input ~{usage['avg_estimated']} tokens/คำขอ{actual}")
+    from src.capabilities import get_context_cache_stats
+    context_stats = get_context_cache_stats()
+    if context_stats['created']:
+        st.caption(f"📌 Context cache: สร้าง {context_stats['created']} · ใช้ซ้ำ {context_stats['reused']} ครั้ง")
+    
     st.markdown("---")
     render_history_sidebar_v2()
     
@@ -101,19 +135,13 @@ def process_upload_and_analyze():
         st.success(f"⚡ ใช้ข้อมูลทีสกัดไว้แล้ว ({len(questions)} ข้อ)")
     else:
         with st.spinner("🚀 กำลังแกะข้อสอบ..."):
-            text = ""
             try:
-                if uploaded_file.type == "application/pdf":
-                    text = extract_text_from_pdf(uploaded_file)
-                elif uploaded_file.type == "text/plain":
-                    text = str(uploaded_file.read(), "utf-8")
-                elif "wordprocessingml" in uploaded_file.type: # DOCX
-                    text = extract_text_from_docx(uploaded_file)
+                extraction = extract_uploaded_file(uploaded_file)
+                questions = extraction["questions"]
+                st.session_state.question_items = extraction["items"]
             except Exception as e:
                 st.error(f"{t('file_read_error')} {e}")
                 return
-
-            questions = extract_questions(text)
             
             if not questions:
                 st.error(t('no_questions_found'))
@@ -123,41 +151,20 @@ def process_upload_and_analyze():
         st.success(f"✅ พบ {len(questions)} ข้อ! กำลังเริ่มวิเคราะห์...")
     time.sleep(0.5) # Short pause for eye-candy
     
-    # C. Analyze Each Question
-    results = []
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i, q_text in enumerate(questions):
-        status_text.caption(f"🤖 วิเคราะห์ข้อ {i+1}/{len(questions)}...")
-        
-        analysis = analyze_question(q_text, i+1)
-        
-        if not analysis:
-            analysis = create_error_response("Analysis returned None")
-            
-        results.append(analysis)
-        progress_bar.progress((i + 1) / len(questions))
-    
-    st.session_state.analysis_results = results
-    
-    # D. Save History
-    summary_text = f"Analyzed {len(questions)} questions using {st.session_state.selected_provider}"
-    save_analysis_history(uploaded_file.name, results, summary_text)
-    
-    status_text.empty()
-    st.toast(t('analysis_complete'), icon="🎉")
-    st.rerun()
-    
-    st.toast(t('analysis_complete'), icon="🎉")
-    time.sleep(1)
-    st.rerun()
+    # C. Submit Background Job (ทำงานต่อแม้ปิดแท็บหรือเน็ตหลุด)
+    # คำตอบจากส่วนเฉลยของไฟล์ (ถ้ามี) ใช้ตรวจ correct_option ของแต่ละข้อ
+    items = st.session_state.get('question_items') or []
+    answer_keys = [q.answer for q in items] if len(items) == len(questions) else None
+    job_id = submit_analysis_job(uploaded_file.name, questions, get_analysis_settings(), answer_keys)
+    follow_job(job_id)
+    st.session_state.analysis_results = [create_pending_response() for _ in questions]
+    st.toast(f"🚀 เริ่มวิเคราะห์ {len(questions)} ข้อ (Job #{job_id})", icon="🤖")
 
 # 3.4 Render Input Section
 uploaded_file = render_input_studio(process_upload_and_analyze)
 
 # 3.5 Render Results Section
-if st.session_state.analysis_results:
+if st.session_state.analysis_results and not st.session_state.active_job_id:
     st.markdown(f"### {t('step3_title')}")
     
     # Prepare Data
@@ -264,7 +271,7 @@ if st.session_state.analysis_results:
                         from src.database import add_to_question_bank
                         if st.button(f"💾 Save Q{idx+1} to Bank", key=f"save_bank_{idx}"):
                             orig_q = st.session_state.question_texts[idx] if idx < len(st.session_state.question_texts) else ""
-                            add_to_question_bank(orig_q, row.to_dict(), "", st.session_state.get('last_uploaded_file_name', ''))
+                            add_to_question_bank(orig_q, st.session_state.analysis_results[idx], "", st.session_state.get('last_uploaded_file_name', ''))
                             st.toast(f"✅ Q{idx+1} saved to Question Bank!", icon="📚")
                     else:
                         st.error(row.get('improvement_suggestion'))
@@ -284,5 +291,13 @@ if st.session_state.analysis_results:
                      st.markdown(f"**{t('correct_analysis')}** ({row.get('correct_option', '?')})")
                      st.write(row.get('correct_option_analysis', '-'))
                      
+                     # ตรวจกับเฉลยในไฟล์ (ไม่ต้องเรียก AI เพิ่ม)
+                     result = st.session_state.analysis_results[idx]
+                     if result.get('answer_key'):
+                         if result.get('answer_key_match') is False:
+                             st.warning(f"⚠️ ไม่ตรงกับเฉลยในไฟล์ (เฉลย: {result['answer_key']}, AI: {result.get('correct_option', '?')})")
+                         elif result.get('answer_key_match'):
+                             st.caption(f"✅ ตรงกับเฉลยในไฟล์ ({result['answer_key']})")
+                     
                      st.markdown(f"**{t('distractor_analysis')}**")
                      st.write(row.get('distractor_analysis', '-'))
\ No newline at end of file
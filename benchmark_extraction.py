@@ -0,0 +1,114 @@
+import re
+import sys
+import time
+import random
+import argparse
+
+from src.question_scanner import split_questions
+from src.analysis import iter_questions
+
+# 1. การแยกข้อแบบเดิม (ก่อนใช้ question_scanner) เก็บไว้เพื่อเทียบผลและความเร็ว
+def legacy_clean_and_normalize(text):
+    if not text: return ""
+    thai_digits = "๐๑๒๓๔๕๖๗๘๙"
+    arabic_digits = "0123456789"
+    for t, a in zip(thai_digits, arabic_digits):
+        text = text.replace(t, a)
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = text.replace('\r', '')
+    text = re.sub(r'([ก-งA-D])\s*\.', r'\1.', text)
+    text = re.sub(r'(\d+)\s*\.', r'\1.', text)
+    text = re.sub(r'(\s+)(\(?\d+[\.\)])\s', r'\n\2 ', text)
+    text = re.sub(r'\n{2,}', '\n', text)
+    lines = [line.strip() for line in text.split('\n')]
+    return '\n'.join(lines)
+
+def legacy_split_questions(raw_text):
+    text = re.split(r"={10,}\s*เฉลย\s*={10,}", raw_text, flags=re.DOTALL | re.IGNORECASE)[0]
+    cleaned_text = legacy_clean_and_normalize(text)
+    question_pattern = r'((?:^|\n)\s*(?:ข้อ(?:ที่)?\s*)?\d+(?:[\.\)]|(?<=\()\d+\)))'
+    chunks = re.split(question_pattern, cleaned_text)
+
+    questions = []
+    start_idx = 0
+    if len(chunks) > 0 and not chunks[0].strip():
+        start_idx = 1
+    elif len(chunks) > 0 and not re.match(r'(?:ข้อ\s*\d+|ข้อที่\s*\d+|\d+\.|(?:\(?\d+\)))', chunks[0].strip()):
+        start_idx = 1
+    for i in range(start_idx, len(chunks), 2):
+        if i+1 < len(chunks):
+            questions.append((chunks[i] + chunks[i+1]).strip())
+
+    valid_questions = []
+    for q in questions:
+        q = q.strip()
+        if len(q) < 5: continue
+        if len(re.findall(r'[ก-งA-D]\.', q)) >= 2:
+            valid_questions.append(re.sub(r'(\s+)([ก-งA-D]\.)', r'\n\2', q))
+        elif len(q) > 10:
+            valid_questions.append(q)
+    return valid_questions
+
+# 2. ข้อสอบจำลองหลายรูปแบบ (เลขไทย, ช่องว่างก่อนจุด, tab, CRLF, ตัวเลือกในบรรทัดเดียว, ข้อ/ข้อที่)
+THAI_DIGITS = str.maketrans("0123456789", "๐๑๒๓๔๕๖๗๘๙")
+
+def make_messy_exam(num_questions, seed=0):
+    rng = random.Random(seed)
+    lines = ["คำชี้แจง  ให้นักเรียนเลือกคำตอบที่ถูกต้องที่สุดเพียงคำตอบเดียว", ""]
+    for n in range(1, num_questions + 1):
+        number = str(n).translate(THAI_DIGITS) if rng.random() < 0.3 else str(n)
+        prefix = rng.choice(["", "", "ข้อ ", "ข้อที่ "])
+        dot = rng.choice([".", " .", ")"])
+        stem = f"{prefix}{number}{dot} ข้อใดกล่าวถูกต้องเกี่ยวกับเนื้อหาเรื่องที่ {n}\tมากที่สุด"
+        options = [f"{opt}{rng.choice(['.', ' .'])} คำตอบที่ {i + 1}  ของข้อ {n}" for i, opt in enumerate("กขคง")]
+        if rng.random() < 0.5:
+            lines.append(stem + "   " + "   ".join(options))
+        else:
+            lines.extend([stem] + options)
+        lines.append(rng.choice(["", "  ", ""]))
+    lines.append("=" * 20 + " เฉลย " + "=" * 20)
+    lines.extend(f"{n}. ก" for n in range(1, num_questions + 1))
+    newline = "\r\n" if seed % 2 else "\n"
+    return newline.join(lines)
+
+def best_of(fn, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# 3. เทียบผลลัพธ์และเวลา
+def run_benchmark(sizes, repeat):
+    ok = True
+    for size in sizes:
+        for seed in (0, 1):
+            text = make_messy_exam(size, seed)
+            legacy = legacy_split_questions(text)
+            scanned = split_questions(text)
+            same = legacy == scanned
+            ok = ok and same
+            legacy_time = best_of(legacy_split_questions, text, repeat)
+            scan_time = best_of(split_questions, text, repeat)
+            newline = "CRLF" if seed % 2 else "LF"
+            print(f"{size:>6} questions {newline:<4} {len(text) / 1024:>8.1f} KB | legacy {legacy_time * 1000:>8.2f} ms | "
+                  f"scanner {scan_time * 1000:>8.2f} ms | x{legacy_time / scan_time:.2f} | {len(scanned)} questions, same={same}")
+    return ok
+
+# 4. ตรวจหน้าของแต่ละข้อเมื่ออ่านทีละหน้า (ข้อที่ขึ้นต้นหน้าต้องได้เลขหน้านั้น ไม่ใช่หน้าก่อน)
+def check_page_numbers(num_pages=4):
+    pages = [f"{n}. ข้อใดถูกต้องที่สุดในหน้า {n}\nก. หนึ่ง\nข. สอง\nค. สาม\nง. สี่" for n in range(1, num_pages + 1)]
+    pages[0] = "คำชี้แจง ให้เลือกคำตอบที่ถูกที่สุด\n" + pages[0]
+    got = [q.page for q in iter_questions(pages)]
+    expected = list(range(1, num_pages + 1))
+    print(f"page numbers (1 question/page): {got}, ok={got == expected}")
+    return got == expected
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark question extraction: legacy regex passes vs question_scanner")
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    ok = run_benchmark([int(s) for s in args.sizes.split(",")], args.repeat)
+    sys.exit(0 if check_page_numbers() and ok else 1)
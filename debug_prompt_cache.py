@@ -0,0 +1,51 @@
+import os
+import sys
+
+# 1. เปิด Provider จำลอง (ต้องตั้งก่อน import src.analysis)
+os.environ.setdefault('FAKE_PROVIDER_ENABLED', '1')
+os.environ.setdefault('ANALYSIS_CACHE_ENABLED', '0')
+
+from src.analysis import analyze_question_uncached, build_analysis_prompt, FAKE_PROVIDER
+from src.capabilities import get_context_cache_stats
+from src.fake_provider import get_fake_client
+
+QUESTIONS = [
+    "ข้อใดใช้คำราชาศัพท์ถูกต้อง\nก. พระราชาเสวยพระกระยาหาร\nข. พระราชาทรงกิน\nค. พระราชาเสด็จกิน\nง. พระราชาทรงรับประทาน",
+    "คำในข้อใดเป็นคำประสม\nก. แม่น้ำ\nข. สวยงาม\nค. ใหญ่โต\nง. เล็กน้อย",
+    "ข้อใดเป็นประโยคความซ้อน\nก. ฉันกินข้าว\nข. ฉันเห็นแมวที่วิ่งอยู่\nค. ฝนตกแต่แดดออก\nง. เขาเดิน",
+]
+
+# 2. ทดสอบเส้นทาง context cache: สร้างครั้งแรก แล้วใช้ซ้ำทุกข้อที่เหลือ
+def test_context_cache_reuse():
+    settings = {
+        "provider": FAKE_PROVIDER,
+        "model": "Fake Model",
+        "custom_prompt": "",
+        "language": "th",
+        "batch_mode": False,
+        "failover": False,
+        "hedging": False,
+        "battle_contestants": [],
+    }
+    for i, question in enumerate(QUESTIONS, 1):
+        result = analyze_question_uncached(question, i, settings, rag_context="")
+        print(f"Question {i}: {result.get('bloom_level')} / {result.get('difficulty')}")
+
+    cache_stats = get_context_cache_stats()
+    client_stats = get_fake_client().snapshot()
+    print(f"Context cache: {cache_stats}")
+    print(f"Fake provider: {client_stats}")
+
+    ok = cache_stats["created"] == 1 and client_stats["cached_requests"] == len(QUESTIONS)
+
+    # 3. prefix ของคำขอ (System Prompt + รูปแบบคำตอบ) ต้องเหมือนกันทุกข้อ
+    prompts = [build_analysis_prompt(q, i, settings, rag_context="") for i, q in enumerate(QUESTIONS, 1)]
+    static_prefix = os.path.commonprefix([system + "\n" + user for system, user in prompts])
+    print(f"Shared static prefix: {len(static_prefix)} chars")
+    ok = ok and static_prefix.startswith(prompts[0][0])
+
+    print("Reuse path taken." if ok else "Reuse path NOT taken.")
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if test_context_cache_reuse() else 1)
@@ -0,0 +1,107 @@
+import os
+import sys
+import math
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 1. ใช้ Provider จำลองในเครื่อง และปิด Cache ผลวิเคราะห์ (ต้องตั้งก่อน import src.analysis)
+os.environ.setdefault('FAKE_PROVIDER_ENABLED', '1')
+os.environ.setdefault('ANALYSIS_CACHE_ENABLED', '0')
+
+from src.analysis import extract_questions, analyze_question, get_rag_contexts, FAKE_PROVIDER
+from src.fake_provider import configure_fake_client, FAKE_LATENCY
+from src.ratelimit import get_rate_limit_snapshot
+from src.utils import is_error_response
+
+TOPICS = ["คำราชาศัพท์", "คำประสม", "ประโยคความซ้อน", "สำนวนไทย", "การอ่านจับใจความ", "ฉันทลักษณ์", "คำซ้อน", "การเขียนย่อความ"]
+OPTIONS = ["ก", "ข", "ค", "ง"]
+
+# 2. สร้างข้อสอบจำลองขนาดใหญ่ (รูปแบบเดียวกับไฟล์ข้อสอบจริง: เลขข้อ + ตัวเลือก ก-ง)
+def make_synthetic_exam(num_questions):
+    lines = ["แบบทดสอบวิชาภาษาไทย (ข้อสอบจำลอง)", ""]
+    for n in range(1, num_questions + 1):
+        topic = TOPICS[n % len(TOPICS)]
+        lines.append(f"{n}. ข้อใดเกี่ยวข้องกับเรื่อง{topic}มากที่สุด ชุดที่ {n}")
+        lines.append("   ".join(f"{opt}. ตัวเลือกที่ {i + 1} ของข้อ {n}" for i, opt in enumerate(OPTIONS)))
+        lines.append("")
+    return "\n".join(lines)
+
+def percentile(values, pct):
+    """nearest-rank percentile (แบบเดียวกับ routing.LatencyTracker)"""
+    data = sorted(values)
+    if not data:
+        return 0.0
+    k = min(len(data) - 1, max(0, math.ceil(pct / 100 * len(data)) - 1))
+    return data[k]
+
+# 3. วิ่ง extract_questions -> analyze_question ด้วย thread pool แล้วรายงานผล
+def run_load_test(args):
+    client = configure_fake_client(
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        malformed_rate=args.malformed_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    settings = {
+        "provider": FAKE_PROVIDER,
+        "model": "Fake Model",
+        "custom_prompt": "",
+        "language": "th",
+        "batch_mode": False,
+        "failover": False,
+        "hedging": False,
+        "battle_contestants": [],
+    }
+
+    raw_text = make_synthetic_exam(args.questions)
+    start = time.perf_counter()
+    questions = extract_questions(raw_text)
+    extract_seconds = time.perf_counter() - start
+    rag_contexts = get_rag_contexts(questions, settings)
+
+    latencies = []
+    errors = 0
+
+    def timed(idx):
+        t0 = time.perf_counter()
+        result = analyze_question(questions[idx], idx + 1, settings, rag_contexts[idx])
+        return time.perf_counter() - t0, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(timed, i) for i in range(len(questions))]
+        for future in as_completed(futures):
+            seconds, result = future.result()
+            latencies.append(seconds)
+            if is_error_response(result):
+                errors += 1
+    analyze_seconds = time.perf_counter() - start
+
+    stats = client.snapshot()
+    limiter = get_rate_limit_snapshot(FAKE_PROVIDER)
+    print(f"Questions extracted : {len(questions)} in {extract_seconds * 1000:.1f} ms")
+    print(f"Concurrency         : {args.concurrency}")
+    print(f"Analysis wall time  : {analyze_seconds:.2f} s")
+    print(f"Throughput          : {len(questions) / max(analyze_seconds, 1e-9):.2f} questions/s")
+    print(f"Latency p50/p95/p99 : {percentile(latencies, 50):.3f} / {percentile(latencies, 95):.3f} / {percentile(latencies, 99):.3f} s")
+    print(f"Provider requests   : {stats['requests']} (retries {stats['requests'] - len(questions)})")
+    print(f"Injected 429 / bad  : {stats['rate_limited']} / {stats['malformed']}")
+    print(f"Limiter throttled   : {sum(item['throttled'] for item in limiter)} times, waited {sum(item['total_wait'] for item in limiter):.1f} s")
+    print(f"Failed questions    : {errors}")
+    return errors == 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test: extract_questions -> analyze_question on the local fake provider")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", default=FAKE_LATENCY, help="fixed:S | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA | exponential:MEAN")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.05)
+    parser.add_argument("--malformed-rate", type=float, default=0.02)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    sys.exit(0 if run_load_test(parse_args()) else 1)
@@ -1,15 +1,44 @@
 # -*- coding: utf-8 -*-
 import os
+import io
 import re
 import json
 import time # Fixed missing import
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 import streamlit as st
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig 
 from dotenv import load_dotenv
 
 # Internal Imports
-from .utils import load_prompts, clean_and_normalize, sanitize_analysis, create_error_response
+from .utils import (
+    iter_pdf_pages, extract_text_from_docx,
+    load_prompts, clean_and_normalize, sanitize_analysis, create_error_response,
+    is_error_response, normalize_question_for_key
+)
+from .database import (
+    get_cached_analysis, save_cached_analysis, get_cached_extraction, save_cached_extraction
+)
+from .providers import get_gemini_model, create_gemini_cached_model, get_groq_client, get_openrouter_client
+from .capabilities import context_cache, register_capabilities, is_cache_missing_error, min_cache_tokens
+from .fake_provider import FAKE_PROVIDER, FAKE_PROVIDER_ENABLED, get_fake_client
+from .ratelimit import (
+    get_rate_limiter, parse_retry_after, is_rate_limit_error,
+    DEFAULT_OUTPUT_TOKENS
+)
+from .routing import route_with_failover, call_with_tracking
+from .question_scanner import (
+    ANSWER_KEY, Question, attach_answers, find_question_starts, format_question,
+    parse_answer_key, parse_question, scan_questions, split_into_chunks, trim_span
+)
+from .few_shot import build_few_shot_index, detect_strand, format_few_shot, FEW_SHOT_COUNT
+from .prompt_budget import (
+    estimate_prompt_tokens, get_input_token_budget, fit_sections, record_prompt_tokens,
+    RAG_MAX_CONTEXT_TOKENS
+)
 
 # Load Env
 load_dotenv()
@@ -28,6 +57,13 @@ AI_PROVIDERS = {
             "Gemini 1.5 Pro (แม่นยำ)": "gemini-1.5-pro-latest",
         },
         "api_key": GEMINI_API_KEY,
+        "max_concurrency": int(os.getenv('GEMINI_MAX_CONCURRENCY', '4')),
+        "rpm": int(os.getenv('GEMINI_RPM', '15')),
+        "tpm": int(os.getenv('GEMINI_TPM', '1000000')),
+        "supports_batch": True,
+        "batch_token_budget": int(os.getenv('GEMINI_BATCH_TOKEN_BUDGET', '30000')),
+        "max_output_tokens": int(os.getenv('GEMINI_MAX_OUTPUT_TOKENS', '8192')),
+        "input_token_budget": int(os.getenv('GEMINI_INPUT_TOKEN_BUDGET', '0')),
     },
     "Groq (ฟรี+เร็วมาก)": {
         "models": {
@@ -36,6 +72,13 @@ AI_PROVIDERS = {
             "Mixtral 8x7B": "mixtral-8x7b-32768",
         },
         "api_key": GROQ_API_KEY,
+        "max_concurrency": int(os.getenv('GROQ_MAX_CONCURRENCY', '4')),
+        "rpm": int(os.getenv('GROQ_RPM', '30')),
+        "tpm": int(os.getenv('GROQ_TPM', '6000')),
+        "supports_batch": True,
+        "batch_token_budget": int(os.getenv('GROQ_BATCH_TOKEN_BUDGET', '5000')),
+        "max_output_tokens": int(os.getenv('GROQ_MAX_OUTPUT_TOKENS', '4000')),
+        "input_token_budget": int(os.getenv('GROQ_INPUT_TOKEN_BUDGET', '4000')),
     },
     "OpenRouter (หลายโมเดลฟรี)": {
         "models": {
@@ -44,17 +87,102 @@ AI_PROVIDERS = {
             "Gemma 2 9B (ฟรี)": "google/gemma-2-9b-it:free",
         },
         "api_key": OPENROUTER_API_KEY,
+        "max_concurrency": int(os.getenv('OPENROUTER_MAX_CONCURRENCY', '2')),
+        "rpm": int(os.getenv('OPENROUTER_RPM', '20')),
+        "tpm": int(os.getenv('OPENROUTER_TPM', '0')),
+        "supports_batch": True,
+        "batch_token_budget": int(os.getenv('OPENROUTER_BATCH_TOKEN_BUDGET', '6000')),
+        "max_output_tokens": int(os.getenv('OPENROUTER_MAX_OUTPUT_TOKENS', '4000')),
+        "input_token_budget": int(os.getenv('OPENROUTER_INPUT_TOKEN_BUDGET', '0')),
     },
     "⚔️ Battle Mode (Gemini vs Groq)": {
         "models": {
             "Default (Gemini Flash vs Llama 3)": "battle-mode"
         },
-        "api_key": "BOTH"
+        "api_key": "BOTH",
+        "max_concurrency": int(os.getenv('BATTLE_MAX_CONCURRENCY', '2')),
     }
 }
 
+# Provider จำลองในเครื่อง: ใช้ตรวจเส้นทาง context cache และทดสอบโดยไม่ต้องมี API key
+if FAKE_PROVIDER_ENABLED:
+    AI_PROVIDERS[FAKE_PROVIDER] = {
+        "models": {
+            "Fake Model": "fake-model",
+        },
+        "api_key": "LOCAL",
+        "max_concurrency": int(os.getenv('FAKE_MAX_CONCURRENCY', '8')),
+        "rpm": 0,
+        "tpm": 0,
+        "input_token_budget": 0,
+    }
+register_capabilities(FAKE_PROVIDER, context_cache=True)
+
 DEFAULT_PROVIDER = "Gemini (Google)"
 DEFAULT_MODEL_NAME = "Gemini 2.0 Flash (แนะนำ)"
+DEFAULT_MAX_CONCURRENCY = 4
+
+BATTLE_PROVIDER = "⚔️ Battle Mode (Gemini vs Groq)"
+# ผู้เข้าแข่งขันเริ่มต้นของ Battle Mode: (provider, ชื่อโมเดล) กำหนดเองได้ใน UI (N-way)
+DEFAULT_BATTLE_CONTESTANTS = [
+    ("Gemini (Google)", "Gemini 2.0 Flash (แนะนำ)"),
+    ("Groq (ฟรี+เร็วมาก)", "Llama 3.3 70B (แนะนำ)"),
+]
+
+# Fallback model id เมื่อชื่อโมเดลที่เลือกไม่อยู่ในรายการของ Provider
+DEFAULT_MODEL_IDS = {
+    "Gemini (Google)": "gemini-2.0-flash",
+    "Groq (ฟรี+เร็วมาก)": "llama-3.3-70b-versatile",
+    "OpenRouter (หลายโมเดลฟรี)": "meta-llama/llama-3.2-3b-instruct:free",
+    "⚔️ Battle Mode (Gemini vs Groq)": "battle-mode",
+    FAKE_PROVIDER: "fake-model",
+}
+
+# max output tokens ของคำขอวิเคราะห์ทีละข้อ
+SINGLE_MAX_OUTPUT_TOKENS = 2048
+
+# ปิด Cache ผลวิเคราะห์ได้ด้วย ANALYSIS_CACHE_ENABLED=0
+ANALYSIS_CACHE_ENABLED = os.getenv('ANALYSIS_CACHE_ENABLED', '1').strip() not in ('0', 'false', 'no')
+
+GEMINI_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "bloom_level": {"type": "string"},
+        "reasoning": {"type": "string"},
+        "difficulty": {"type": "string"},
+        "curriculum_standard": {"type": "string"},
+        "correct_option": {"type": "string"},
+        "correct_option_analysis": {"type": "string"},
+        "distractor_analysis": {"type": "string"},
+        "why_good_distractor": {"type": "string"},
+        "is_good_question": {"type": "boolean"},
+        "improvement_suggestion": {"type": "string"}
+    },
+    "required": [
+        "bloom_level", "reasoning", "difficulty", "curriculum_standard",
+        "correct_option", "correct_option_analysis", "distractor_analysis",
+        "why_good_distractor", "is_good_question", "improvement_suggestion"
+    ]
+}
+
+# Batch Mode: หลายข้อต่อหนึ่งคำขอ (คำตอบเป็น {"analyses": [...]})
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '10'))
+# จำนวนตัวอย่าง few-shot สูงสุดต่อหนึ่ง batch
+FEW_SHOT_INDEX_BATCH_LIMIT = 3
+GEMINI_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "analyses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": dict(GEMINI_SCHEMA["properties"], question_id={"type": "integer"}),
+                "required": ["question_id"] + GEMINI_SCHEMA["required"],
+            },
+        }
+    },
+    "required": ["analyses"],
+}
 
 # Constants
 GEMINI_AVAILABLE = len(GEMINI_API_KEY) > 30
@@ -63,113 +191,395 @@ OPENROUTER_AVAILABLE = len(OPENROUTER_API_KEY) > 20
 AVAILABLE_AI_MODELS = AI_PROVIDERS[DEFAULT_PROVIDER]["models"] # Legacy compat
 
 SYSTEM_INSTRUCTION_PROMPT, FEW_SHOT_PROMPT_TEMPLATE = load_prompts()
+# ดัชนีตัวอย่าง few-shot (แยกตามสาระ/ระดับ Bloom) สร้างครั้งเดียวตอน import
+FEW_SHOT_INDEX = build_few_shot_index(FEW_SHOT_PROMPT_TEMPLATE)
 
 # --- Extraction Logic ---
+# AI fallback สำหรับไฟล์ยาว: แบ่งเป็นช่วง (ตัดที่ต้นข้อ/ต้นบรรทัด) แล้วส่งพร้อมกันหลายคำขอ
+AI_EXTRACTION_MODEL_ID = os.getenv('AI_EXTRACTION_MODEL', 'gemini-1.5-flash-latest')
+AI_EXTRACTION_CHUNK_CHARS = int(os.getenv('AI_EXTRACTION_CHUNK_CHARS', '12000'))
+AI_EXTRACTION_OVERLAP_CHARS = int(os.getenv('AI_EXTRACTION_OVERLAP_CHARS', '1500'))
+AI_EXTRACTION_WORKERS = int(os.getenv('AI_EXTRACTION_WORKERS', '4'))
+# เวลารวมสูงสุด (วินาที) ช่วงที่ยังไม่เสร็จเมื่อหมดเวลาจะถูกข้าม
+AI_EXTRACTION_TIMEOUT = float(os.getenv('AI_EXTRACTION_TIMEOUT', '120'))
+AI_EXTRACTION_MAX_OUTPUT_TOKENS = 8192
+AI_EXTRACTION_CACHE_SIZE = 256
+
+AI_EXTRACTION_SYSTEM_PROMPT = """You are an expert exam parser.
+Extract all exam questions from the text the user sends and return them as a JSON list of strings.
+
+Rules:
+1. Capture the full question text including the question number and all options (e.g. "1. Question... A. Opt...").
+2. Do not change the original text, just split it correctly.
+3. The text may be one part of a longer exam: include a question that is cut off at the start or end as it appears.
+4. If there are no clear questions, return an empty list.
+5. Return ONLY raw JSON Array."""
+AI_EXTRACTION_SCHEMA = {"type": "array", "items": {"type": "string"}}
+
+# Cache คำตอบรายช่วง (key = SHA-256 ของ model + ข้อความช่วง) ใช้ซ้ำเมื่อแกะไฟล์เดิม/ช่วงเดิมอีกครั้ง
+_ai_chunk_cache = OrderedDict()
+_ai_chunk_cache_lock = threading.Lock()
+
+def _extract_chunk_with_ai(chunk):
+    """แกะข้อสอบจากข้อความ 1 ช่วง (ผ่าน Cache และ rate limiter ของ Gemini)"""
+    key = hashlib.sha256(f"{AI_EXTRACTION_MODEL_ID}\x1f{chunk}".encode('utf-8')).hexdigest()
+    with _ai_chunk_cache_lock:
+        if key in _ai_chunk_cache:
+            _ai_chunk_cache.move_to_end(key)
+            return _ai_chunk_cache[key]
+
+    questions = request_provider_json(
+        "Gemini (Google)", AI_EXTRACTION_MODEL_ID, AI_EXTRACTION_SYSTEM_PROMPT, f"Text to parse:\n{chunk}",
+        max_output_tokens=AI_EXTRACTION_MAX_OUTPUT_TOKENS, gemini_schema=AI_EXTRACTION_SCHEMA
+    )
+    questions = [str(q).strip() for q in questions if str(q).strip()] if isinstance(questions, list) else []
+    with _ai_chunk_cache_lock:
+        _ai_chunk_cache[key] = questions
+        while len(_ai_chunk_cache) > AI_EXTRACTION_CACHE_SIZE:
+            _ai_chunk_cache.popitem(last=False)
+    return questions
+
+def merge_extracted_questions(chunk_results):
+    """รวมข้อสอบจากทุกช่วงตามลำดับ ตัดข้อซ้ำจากส่วนที่ซ้อนกัน
+
+    ข้อซ้ำ = เลขข้อเดียวกันและข้อความ (หลัง normalize) เดียวกัน ข้อที่ข้อความเหมือนกันแต่คนละเลขข้อ
+    (เช่น "ข้อใดถูกต้อง" ที่ใช้ตัวเลือกชุดเดิม) เป็นคนละข้อ
+    ข้อที่ถูกตัดครึ่งที่ขอบช่วง: เทียบเฉพาะกับข้อจากช่วงก่อนหน้าที่เลขข้อตรงกัน ถ้าข้อความหนึ่งอยู่ในอีกข้อความ เก็บฉบับที่ยาวกว่า
+    """
+    merged, entries, seen = [], [], set()
+    for chunk_no, questions in enumerate(chunk_results):
+        for text in questions:
+            key = normalize_question_for_key(text)
+            number = parse_question(text).number
+            digest = hashlib.sha256(f"{number}\x1f{key}".encode('utf-8')).hexdigest()
+            if not key or digest in seen:
+                continue
+            seen.add(digest)
+            for pos, (other_chunk, other_number, other_key) in enumerate(entries):
+                if other_chunk == chunk_no - 1 and number == other_number and (key in other_key or other_key in key):
+                    if len(key) > len(other_key):
+                        merged[pos], entries[pos] = text, (chunk_no, number, key)
+                    break
+            else:
+                merged.append(text)
+                entries.append((chunk_no, number, key))
+    return merged
+
 def extract_questions_with_ai(raw_text):
-    """Fallback: ให้ AI ช่วยแยกข้อสอบเมื่อ Regex เอาไม่อยู่"""
+    """Fallback: ให้ AI ช่วยแยกข้อสอบเมื่อ Regex เอาไม่อยู่
+
+    ข้อความยาวถูกแบ่งเป็นช่วงที่ซ้อนกันเล็กน้อยแล้วส่งพร้อมกัน (ไม่ตัดทิ้งเกิน 20,000 ตัวอักษรแบบเดิม)
+    ช่วงที่ error หรือไม่เสร็จภายใน AI_EXTRACTION_TIMEOUT ถูกข้าม ผลที่ได้จากช่วงอื่นยังใช้ได้
+    """
     if not GEMINI_AVAILABLE:
         return []
 
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel("gemini-1.5-flash-latest") 
-        
-        prompt = f"""
-        You are an expert exam parser. 
-        Please extract all exam questions from the following text and return them as a JSON list of strings.
-        
-        Rules:
-        1. Capture the full question text including the question number and all options (e.g. "1. Question... A. Opt...").
-        2. Do not change the original text, just split it correctly.
-        3. If there are no clear questions, return an empty list.
-        4. Return ONLY raw JSON Array.
-
-        Text to parse:
-        {raw_text[:20000]} 
-        """
-        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-        questions = json.loads(response.text)
-        
-        if isinstance(questions, list):
-            return [str(q).strip() for q in questions]
-        else:
-            return []
-            
-    except Exception as e:
-        print(f"AI Extraction Failed: {e}")
+    chunks = split_into_chunks(raw_text, AI_EXTRACTION_CHUNK_CHARS, AI_EXTRACTION_OVERLAP_CHARS)
+    if not chunks:
         return []
+    results = [[] for _ in chunks]
+    pool = ThreadPoolExecutor(max_workers=min(AI_EXTRACTION_WORKERS, len(chunks)), thread_name_prefix="ai-extract")
+    futures = {pool.submit(_extract_chunk_with_ai, chunk): i for i, chunk in enumerate(chunks)}
+    try:
+        for future in as_completed(futures, timeout=AI_EXTRACTION_TIMEOUT):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print(f"AI Extraction Failed (chunk {futures[future] + 1}/{len(chunks)}): {e}")
+    except FuturesTimeoutError:
+        pending = sum(1 for future in futures if not future.done())
+        print(f"AI Extraction timed out after {AI_EXTRACTION_TIMEOUT:g}s ({pending}/{len(chunks)} chunks unfinished)")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return merge_extracted_questions(results)
+
+def iter_questions(pages):
+    """Generator ข้อสอบ (Question) ทีละข้อจากข้อความทีละหน้า (เช่นจาก iter_pdf_pages)
+
+    ข้อที่จบแล้ว (มีเลขข้อถัดไปตามมา) ถูกส่งออกทันที โดยไม่ต้องรอหน้าที่เหลือ
+    ใช้กฎแยกข้อ/ตรวจข้อเดียวกับ extract_questions แต่ไม่มี AI fallback และไม่อ่านส่วนเฉลย
+    start/end นับจากข้อความที่ normalize แล้วของทุกหน้าต่อกัน
+    """
+    buffer = ""
+    offset = 0        # ตำแหน่งของ buffer[0] ในข้อความทั้งไฟล์
+    head_page = None  # หน้าที่ข้อแรกใน buffer เริ่ม
+    for page_no, page_text in enumerate(pages, 1):
+        parts = ANSWER_KEY.split(page_text, 1)
+        page_start = len(buffer)
+        buffer += clean_and_normalize(parts[0]) + "\n"
+        starts = find_question_starts(buffer)
+        if starts and head_page is None:
+            # ตัดคำชี้แจงก่อนข้อแรกทิ้ง
+            offset += starts[0]
+            buffer = buffer[starts[0]:]
+            starts = [pos - starts[0] for pos in starts]
+            page_start, head_page = 0, page_no
+        # ข้อสุดท้ายใน buffer อาจต่อไปหน้าถัดไป เก็บไว้ก่อน
+        # เลขข้อต้นหน้าถูกจับตั้งแต่ "\n" ท้ายหน้าก่อน จึงเทียบหน้าจากตำแหน่งหลังตัดช่องว่างหัวข้อ
+        for begin, end in zip(starts, starts[1:]):
+            page = head_page if trim_span(buffer, begin, end)[0] < page_start else page_no
+            question = _make_question(buffer, begin, end, page, offset)
+            if question:
+                yield question
+        if len(starts) > 1:
+            head_page = head_page if trim_span(buffer, starts[-1], len(buffer))[0] < page_start else page_no
+            offset += starts[-1]
+            buffer = buffer[starts[-1]:]
+        if len(parts) > 1:
+            break  # ถึงส่วนเฉลยแล้ว
+    if head_page is not None:
+        question = _make_question(buffer, 0, len(buffer), head_page, offset)
+        if question:
+            yield question
+
+def _make_question(buffer, start, end, page, offset):
+    start, end = trim_span(buffer, start, end)
+    text = format_question(buffer, start, end)
+    return parse_question(text, page, offset + start, offset + end) if text else None
+
+def extract_questions_from_pages(pages, on_question=None):
+    """แยกข้อสอบขณะอ่านทีละหน้า คืน (ข้อความทั้งไฟล์, รายการ Question)
+
+    on_question(questions, pages_read) ถูกเรียกทุกครั้งที่ได้ข้อใหม่ (ใช้แสดงความคืบหน้า)
+    คำตอบจากส่วนเฉลยใส่ให้หลังอ่านครบทุกหน้า
+    ถ้าแยกได้น้อยกว่า 2 ข้อ ใช้ extract_question_items กับข้อความทั้งไฟล์ (มี AI fallback)
+    """
+    pages = iter(pages)
+    read = []
+    def tee():
+        for page_text in pages:
+            read.append(page_text)
+            yield page_text
 
-@st.cache_data(show_spinner=False)
-def extract_questions(raw_text):
-    """สกัดข้อสอบเป็นรายข้อ (ปรับปรุงให้รองรับหลายรูปแบบ: 1., 1), (1), ข้อ 1, ข้อที่ 1)"""
-    # 1. ทำความสะอาดข้อความทั้งหมด
-    text = re.split(r"={10,}\s*เฉลย\s*={10,}", raw_text, flags=re.DOTALL | re.IGNORECASE)[0]
-    cleaned_text = clean_and_normalize(text)
-    
-    # 2. Regex สำหรับจับเลขข้อ (Capturing Group for Split)
-    # จับ: 1. / 1) / (1) / ข้อ 1 / ข้อที่ 1
-    # Note: Wrap in (...) to keep the delimiter in split results
-    question_pattern = r'((?:^|\n)\s*(?:ข้อ(?:ที่)?\s*)?\d+(?:[\.\)]|(?<=\()\d+\)))'
-    chunks = re.split(question_pattern, cleaned_text)
-    
     questions = []
-    
-    # Skip preamble
-    start_idx = 0
-    if len(chunks) > 0 and not chunks[0].strip():
-        start_idx = 1
-    elif len(chunks) > 0 and not re.match(r'(?:ข้อ\s*\d+|ข้อที่\s*\d+|\d+\.|(?:\(?\d+\)))', chunks[0].strip()):
-        start_idx = 1 
-
-    for i in range(start_idx, len(chunks), 2):
-        if i+1 < len(chunks):
-            delim = chunks[i]
-            content = chunks[i+1]
-            full_q = delim + content
-            questions.append(full_q.strip())
-
-    # 3. Validation
-    valid_questions = []
-    extracted_indices = []
-
-    for q in questions:
-        q = q.strip()
-        if len(q) < 5: continue 
-        
-        match_idx = re.match(r'^(\d+)', q)
-        if match_idx:
-            extracted_indices.append(int(match_idx.group(1)))
+    for question in iter_questions(tee()):
+        questions.append(question)
+        if on_question:
+            on_question(questions, len(read))
+    # อ่านหน้าที่เหลือ (เช่นหลังส่วนเฉลย) ให้ครบเพื่อเก็บข้อความทั้งไฟล์
+    read.extend(pages)
+    text = "\n".join(read).strip()
+    if len(questions) < 2:
+        return text, extract_question_items(text)
+    parts = ANSWER_KEY.split(text, 1)
+    if len(parts) > 1:
+        attach_answers(questions, parse_answer_key(parts[1]))
+    return text, questions
 
-        has_std_options = len(re.findall(r'[ก-งA-D]\.', q)) >= 2
-        
-        if has_std_options:
-            q_formatted = re.sub(r'(\s+)([ก-งA-D]\.)', r'\n\2', q)
-            valid_questions.append(q_formatted)
-        else:
-            if len(q) > 10: 
-                valid_questions.append(q)
-    
+# เพิ่มเลขนี้เมื่อกฎการแยกข้อเปลี่ยน (ผลใน Cache การแกะไฟล์ของรุ่นเก่าจะไม่ถูกใช้)
+EXTRACTION_VERSION = 3
+
+def extract_uploaded_file(uploaded_file, on_question=None):
+    """แกะข้อความและข้อสอบจากไฟล์ที่อัปโหลด (PDF/DOCX/TXT) ผ่าน Cache ที่ใช้ SHA-256 ของไฟล์เป็น key
 
+    ไฟล์เดิม (อัปโหลดซ้ำ/rerun/ครูคนอื่นใช้ไฟล์เดียวกัน) ไม่ต้องแกะใหม่
+    คืน dict: raw_text, cleaned_text, questions (ข้อความรายข้อ), items (Question), cached
+    """
+    data = uploaded_file.getvalue() if hasattr(uploaded_file, 'getvalue') else uploaded_file.read()
+    file_hash = hashlib.sha256(data).hexdigest()
+    cached = get_cached_extraction(file_hash, EXTRACTION_VERSION)
+    if cached:
+        items = [Question.from_dict(item) for item in cached["questions"]]
+        return dict(cached, questions=[q.text for q in items], items=items, cached=True)
+
+    file_type = getattr(uploaded_file, 'type', '') or ''
+    text, items = "", None
+    if file_type == "application/pdf":
+        text, items = extract_questions_from_pages(iter_pdf_pages(io.BytesIO(data)), on_question)
+    elif file_type == "text/plain":
+        text = str(data, "utf-8")
+    elif "wordprocessingml" in file_type: # DOCX
+        text = extract_text_from_docx(io.BytesIO(data)) or ""
+    if items is None:
+        items = extract_question_items(text) if text else []
+
+    cleaned_text = clean_and_normalize(ANSWER_KEY.split(text, 1)[0])
+    # เก็บเฉพาะไฟล์ที่แกะได้ตั้งแต่ 2 ข้อ (ต่ำกว่านี้คือ regex แกะไม่สำเร็จและ AI fallback ไม่ได้ทำงานหรือล้มเหลว
+    # ซึ่งอาจสำเร็จเมื่อแกะใหม่ภายหลัง จึงไม่ควรจำผลที่ไม่สมบูรณ์ไว้)
+    if len(items) >= 2:
+        save_cached_extraction(file_hash, EXTRACTION_VERSION, getattr(uploaded_file, 'name', ''), text, cleaned_text, [q.to_dict() for q in items])
+    return {"raw_text": text, "cleaned_text": cleaned_text, "questions": [q.text for q in items], "items": items, "cached": False}
+
+def extract_questions(raw_text):
+    """สกัดข้อสอบเป็นรายข้อ (ปรับปรุงให้รองรับหลายรูปแบบ: 1., 1), ข้อ 1., ข้อที่ 1.)"""
+    return [q.text for q in extract_question_items(raw_text)]
+
+@st.cache_data(show_spinner=False)
+def extract_question_items(raw_text):
+    """สกัดข้อสอบเป็น Question (เลขข้อ, โจทย์, ตัวเลือก, ตำแหน่ง และคำตอบจากส่วนเฉลย)"""
+    # 1-3. ตัดเฉลย ทำความสะอาด และสแกนหาช่วงของแต่ละข้อในรอบเดียว (question_scanner)
+    valid_questions = scan_questions(raw_text)
 
     # --- 4. AI Fallback (Robustness for Complex Formats) ---
     # If Regex found too few questions (< 2) but text is long (> 300 chars), try AI.
     if len(valid_questions) < 2 and len(raw_text) > 300:
         if GEMINI_AVAILABLE:
             st.toast("⚠️ รูปแบบซับซ้อน: กำลังใช้ AI แกะข้อสอบ (รอสักครู่)...", icon="🤖")
-            ai_questions = extract_questions_with_ai(cleaned_text)
+            ai_questions = extract_questions_with_ai(clean_and_normalize(ANSWER_KEY.split(raw_text, 1)[0]))
             if len(ai_questions) > len(valid_questions):
                 st.success(f"🤖 AI แกะได้ {len(ai_questions)} ข้อ!")
-                return ai_questions
+                ai_items = [parse_question(text) for text in ai_questions]
+                parts = ANSWER_KEY.split(raw_text, 1)
+                if len(parts) > 1:
+                    attach_answers(ai_items, parse_answer_key(parts[1]))
+                return ai_items
 
     return valid_questions
 
 # --- Analysis Logic ---
-def build_analysis_prompt(question_text, question_id=1):
+def get_analysis_settings():
+    """อ่านค่าที่ใช้วิเคราะห์จาก session_state ครั้งเดียว (worker thread เข้าถึง session_state ไม่ได้)"""
+    return {
+        "provider": st.session_state.get('selected_provider', DEFAULT_PROVIDER),
+        "model": st.session_state.get('selected_model', DEFAULT_MODEL_NAME),
+        "custom_prompt": (st.session_state.get('custom_prompt', '') or '').strip(),
+        "language": st.session_state.get('language', 'th'),
+        "batch_mode": bool(st.session_state.get('batch_mode', False)),
+        "failover": bool(st.session_state.get('failover', False)),
+        "hedging": bool(st.session_state.get('hedging', False)),
+        "battle_contestants": [list(c) for c in st.session_state.get('battle_contestants', DEFAULT_BATTLE_CONTESTANTS)],
+    }
+
+def resolve_model_id(provider, model_name):
+    """แปลงชื่อโมเดลที่แสดงใน UI เป็น model id ของ Provider"""
+    if provider not in AI_PROVIDERS:
+        provider = DEFAULT_PROVIDER
+    return AI_PROVIDERS[provider]["models"].get(model_name, DEFAULT_MODEL_IDS[provider])
+
+def format_rag_context(sections):
+    """จัดรูปแบบ section หลักสูตรที่ค้นได้เป็นข้อความใน Prompt (None = ยังไม่ได้โหลดหลักสูตร)"""
+    if sections is None:
+        return ""
+    relevant_std = "\n...\n".join(sections) if sections else "No relevant curriculum standard found."
+    return f"\n\n**REFERENCE CURRICULUM:**\n{relevant_std}\n(Use this reference to determine 'curriculum_standard')"
+
+def get_rag_sections(questions):
+    """ค้น section หลักสูตรของทุกข้อในครั้งเดียว (rag_engine.search_sections_many) คืน None รายข้อถ้าไม่มีหลักสูตร"""
+    try:
+        from .rag import rag_engine
+        results = rag_engine.search_sections_many(questions)
+        if results is not None:
+            return results
+    except ImportError:
+        pass # Handle RAG module missing cleanly
+    return [None] * len(questions)
+
+def get_prompt_budget(settings):
+    """(provider ที่ใช้ประมาณ token, งบ input token ต่อคำขอ) ของการตั้งค่านี้ (Battle Mode ใช้ผู้เข้าแข่งขันที่งบน้อยที่สุด)"""
+    provider = settings['provider']
+    if provider == BATTLE_PROVIDER:
+        candidates = [dict(settings, provider=p, model=m) for p, m in get_battle_contestants(settings)]
+        return min((get_prompt_budget(c) for c in candidates), key=lambda item: item[1])
+    if provider not in AI_PROVIDERS:
+        provider = DEFAULT_PROVIDER
+    config = AI_PROVIDERS[provider]
+    model_id = resolve_model_id(provider, settings['model'])
+    return provider, get_input_token_budget(model_id, SINGLE_MAX_OUTPUT_TOKENS, config.get("input_token_budget", 0))
+
+def fit_rag_sections(questions, rag_sections, settings):
+    """ตัด/เลือก section หลักสูตรรายข้อให้ prompt ทั้งหมดไม่เกินงบ token ของ Provider/Model (เก็บ section อันดับต้นไว้ก่อน)
+
+    หลักสูตรได้งบก่อนตัวอย่าง few-shot (build_analysis_prompt ลดตัวอย่างเองถ้าเกินงบ)
+    ข้อที่ค้นเจอแต่ตัดจนไม่เหลือ section คืน None เพื่อไม่ใส่ส่วนอ้างอิง (ไม่ใช่ "ไม่พบหลักสูตรที่เกี่ยวข้อง")
+    """
+    provider, budget = get_prompt_budget(settings)
+    system_prompt, user_template = build_analysis_prompt("", 1, settings, rag_context="")
+    static_tokens = estimate_prompt_tokens(provider, system_prompt, user_template)
+    fitted = []
+    for q_text, sections in zip(questions, rag_sections):
+        if not sections:
+            fitted.append(sections)
+            continue
+        available = budget - static_tokens - estimate_prompt_tokens(provider, q_text) - 60
+        fitted.append(fit_sections(provider, sections, min(RAG_MAX_CONTEXT_TOKENS, available)) or None)
+    return fitted
+
+def get_rag_contexts(questions, settings=None):
+    """ข้อความอ้างอิงหลักสูตรรายข้อของทั้งชุดข้อสอบ (ตัดให้พอดีงบ token ถ้าส่ง settings)"""
+    rag_sections = get_rag_sections(questions)
+    if settings:
+        rag_sections = fit_rag_sections(questions, rag_sections, settings)
+    return [format_rag_context(sections) for sections in rag_sections]
+
+def get_rag_context(question_text, settings=None):
+    """ดึงข้อความอ้างอิงหลักสูตรที่เกี่ยวข้อง (ว่างถ้ายังไม่ได้โหลดหลักสูตร)"""
+    return get_rag_contexts([question_text], settings)[0]
+
+def get_provider_limiter(provider, model_id):
+    """Rate limiter ที่ใช้ร่วมกันทั้ง process ของ Provider/Model (ค่า rpm/tpm จาก AI_PROVIDERS, 0 = ไม่จำกัด)"""
+    config = AI_PROVIDERS.get(provider, {})
+    return get_rate_limiter(provider, model_id, config.get("rpm", 0), config.get("tpm", 0))
+
+def _response_input_tokens(response):
+    """จำนวน input token จริงจาก response (None ถ้า SDK ไม่รายงาน)"""
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        return getattr(usage, 'prompt_tokens', None)
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'prompt_token_count', None)
+
+def _response_token_usage(response):
+    """จำนวน token ที่ใช้จริงจาก response (OpenAI/Groq: usage, Gemini: usage_metadata)"""
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        return getattr(usage, 'total_tokens', 0) or 0
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', 0) or 0
+
+def _required_keys_spec(language):
+    """รายการ keys ที่ต้องมีใน JSON คำตอบ (ใช้ทั้งโหมดทีละข้อและ Batch)"""
+    if language == 'en':
+        valid_difficulty = "Easy, Medium, Hard"
+        valid_options = "A, B, C, D"
+        standard_hint = "cite the code from Reference Curriculum if matched"
+    else:
+        valid_difficulty = "ง่าย, ปานกลาง, ยาก"
+        valid_options = "ก, ข, ค, ง"
+        standard_hint = "ระบุรหัสตัวชี้วัดจาก Reference Curriculum ถ้าตรง"
+    return f"""- bloom_level (String: Remember, Understand, Apply, Analyze, Evaluate, Create)
+- reasoning (String)
+- difficulty (String: {valid_difficulty})
+- curriculum_standard (String: {standard_hint})
+- correct_option (String: {valid_options})
+- correct_option_analysis (String)
+- distractor_analysis (String)
+- why_good_distractor (String)
+- is_good_question (Boolean)
+- improvement_suggestion (String)"""
+
+_few_shot_library = {}
+
+def get_cacheable_few_shot(settings, system_prompt):
+    """ตัวอย่าง few-shot ทั้งชุดสำหรับต่อท้าย System Prompt เมื่อ Provider/Model สร้าง cached content ได้ ("" = ไม่ใช้)
+
+    System Prompt อย่างเดียวสั้นกว่าขั้นต่ำของ cached content (Gemini ~1k จาก 4096 token) จึงไม่เคยถูกแคช
+    รวมตัวอย่างทั้งชุดไว้ใน prefix ทำให้ยาวพอ และส่งครั้งเดียวต่อ TTL แทนการแนบตัวอย่างทุกคำขอ
+    """
+    provider = settings['provider']
+    if provider not in AI_PROVIDERS or settings['custom_prompt'] or FEW_SHOT_COUNT <= 0:
+        return ""
+    model_id = resolve_model_id(provider, settings['model'])
+    min_tokens = min_cache_tokens(provider, model_id)
+    if not context_cache.available(provider, model_id) or estimate_prompt_tokens(provider, system_prompt) >= min_tokens:
+        return ""
+    key = (provider, settings['language'])
+    if key not in _few_shot_library:
+        library = format_few_shot(FEW_SHOT_INDEX.examples, settings['language'])
+        _few_shot_library[key] = (library, estimate_prompt_tokens(provider, library))
+    library, library_tokens = _few_shot_library[key]
+    prefix_tokens = estimate_prompt_tokens(provider, system_prompt) + library_tokens
+    # ต้องยาวถึงขั้นต่ำ และไม่กินงบ input เกินครึ่ง (เผื่อคำถามและหลักสูตร)
+    if not library or prefix_tokens < min_tokens or prefix_tokens > get_prompt_budget(settings)[1] // 2:
+        return ""
+    return library
+
+def build_analysis_prompt(question_text, question_id=1, settings=None, rag_context=None):
     """สร้าง Prompt ที่เป็นมาตรฐานเดียวกันทุก Provider"""
+    settings = settings or get_analysis_settings()
     
     # 1. Get Custom or Default System Prompt
-    custom_prompt = st.session_state.get('custom_prompt', '').strip()
-    language = st.session_state.get('language', 'th')
+    custom_prompt = settings['custom_prompt']
+    language = settings['language']
     
     # Language Instruction
     lang_instruction = "IMPORTANT: Please output your analysis reasoning inside the JSON in Thai language."
@@ -177,14 +587,8 @@ def build_analysis_prompt(question_text, question_id=1):
          lang_instruction = "IMPORTANT: Please output your analysis reasoning inside the JSON in English language."
 
     # --- RAG Injection (Define Before Use) ---
-    rag_context = ""
-    try:
-        from .rag import rag_engine
-        if rag_engine.curriculum_text:
-            relevant_std = rag_engine.search(question_text)
-            rag_context = f"\n\n**REFERENCE CURRICULUM:**\n{relevant_std}\n(Use this reference to determine 'curriculum_standard')"
-    except ImportError:
-        pass # Handle RAG module missing cleanly
+    if rag_context is None:
+        rag_context = get_rag_context(question_text, settings)
 
     if custom_prompt:
          # --- PURE CUSTOM PROMPT MODE ---
@@ -203,106 +607,96 @@ def build_analysis_prompt(question_text, question_id=1):
          # --- DEFAULT MODE (Strict Schema) ---
          system_prompt = SYSTEM_INSTRUCTION_PROMPT + f"\n\n{lang_instruction}"
          
+         # Few-shot: ตัวอย่างทั้งชุดอยู่ใน cached prefix ถ้าทำได้ ไม่เช่นนั้นแนบเฉพาะที่ใกล้เคียงข้อนี้ 1-3 ชุด
+         library = get_cacheable_few_shot(settings, system_prompt)
+         if library:
+             system_prompt += f"\n\n{library}"
+             examples = []
+         else:
+             examples = FEW_SHOT_INDEX.select(question_text, strand=detect_strand(rag_context))
+         # ตัวอย่างสำคัญน้อยกว่าหลักสูตร: ถ้า prompt เกินงบ token ให้ลดตัวอย่างก่อน
+         provider, budget = get_prompt_budget(settings)
+         fixed_tokens = estimate_prompt_tokens(provider, system_prompt, _required_keys_spec(language), question_text, rag_context) + 60
+         while examples and fixed_tokens + estimate_prompt_tokens(provider, format_few_shot(examples, language)) > budget:
+             examples = examples[:-1]
+         few_shot = format_few_shot(examples, language)
+         few_shot = f"{few_shot}\n\n" if few_shot else ""
+         
+         # ส่วนคงที่ (รูปแบบคำตอบ) อยู่ต้นข้อความ ต่อจาก System Prompt เพื่อให้ prefix ซ้ำกันทุกข้อ
+         # ส่วนที่เปลี่ยนตามข้อ (ตัวอย่าง, คำถาม, หลักสูตร) อยู่ท้ายเสมอ
          if language == 'en':
-            valid_difficulty = "Easy, Medium, Hard"
-            valid_options = "A, B, C, D"
-            user_message = f"""Question {question_id}:
-{question_text}
-{rag_context}
+            user_message = f"""Analyze and answer in JSON only (No Markdown text). Required keys: 
+{_required_keys_spec(language)}
 
-Analyze and answer in JSON only (No Markdown text). Required keys: 
-- bloom_level (String: Remember, Understand, Apply, Analyze, Evaluate, Create)
-- reasoning (String)
-- difficulty (String: {valid_difficulty})
-- curriculum_standard (String: cite the code from Reference Curriculum if matched)
-- correct_option (String: {valid_options})
-- correct_option_analysis (String)
-- distractor_analysis (String)
-- why_good_distractor (String)
-- is_good_question (Boolean)
-- improvement_suggestion (String)"""
+{few_shot}Question {question_id}:
+{question_text}
+{rag_context}"""
 
          else:
-            valid_difficulty = "ง่าย, ปานกลาง, ยาก"
-            valid_options = "ก, ข, ค, ง"
-            user_message = f"""คำถามข้อที่ {question_id}:
-{question_text}
-{rag_context}
+            user_message = f"""วิเคราะห์และตอบเป็น JSON เท่านั้น (ไม่ต้องมี Markdown text) โดยมี keys: 
+{_required_keys_spec(language)}
 
-วิเคราะห์และตอบเป็น JSON เท่านั้น (ไม่ต้องมี Markdown text) โดยมี keys: 
-- bloom_level (String: Remember, Understand, Apply, Analyze, Evaluate, Create)
-- reasoning (String)
-- difficulty (String: {valid_difficulty})
-- curriculum_standard (String: ระบุรหัสตัวชี้วัดจาก Reference Curriculum ถ้าตรง)
-- correct_option (String: {valid_options})
-- correct_option_analysis (String)
-- distractor_analysis (String)
-- why_good_distractor (String)
-- is_good_question (Boolean)
-- improvement_suggestion (String)"""
+{few_shot}คำถามข้อที่ {question_id}:
+{question_text}
+{rag_context}"""
 
     return system_prompt, user_message
 
-def analyze_with_gemini(question_text, question_id=1):
+def get_gemini_analysis_model(model_id, system_instruction):
+    """GenerativeModel ที่อ้าง cached content ของ System Prompt ฝั่ง server (ถ้าโมเดลรองรับและยาวพอ)
+    มิฉะนั้นใช้ model ปกติที่ส่ง System Prompt ไปทุกคำขอ"""
+    prefix_tokens = estimate_prompt_tokens("Gemini (Google)", system_instruction)
+    model = context_cache.get_or_create(
+        "Gemini (Google)", model_id, system_instruction, prefix_tokens,
+        lambda ttl: create_gemini_cached_model(GEMINI_API_KEY, model_id, system_instruction, ttl)
+    )
+    return model or get_gemini_model(GEMINI_API_KEY, model_id, system_instruction)
+
+def analyze_with_gemini(question_text, question_id=1, settings=None, rag_context=None):
     """เรียกใช้ Gemini API เพื่อวิเคราะห์ข้อสอบ"""
     if not GEMINI_AVAILABLE:
         return create_error_response("ไม่พบ GEMINI_API_KEY")
 
-    system_instruction, user_message = build_analysis_prompt(question_text, question_id)
+    settings = settings or get_analysis_settings()
+    system_instruction, user_message = build_analysis_prompt(question_text, question_id, settings, rag_context)
 
-    selected_model_name = st.session_state.get('selected_model', DEFAULT_MODEL_NAME)
-    model_id = AVAILABLE_AI_MODELS.get(selected_model_name, "gemini-2.0-flash")
+    model_id = resolve_model_id("Gemini (Google)", settings['model'])
 
-    # Re-configure to ensure key is set
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    model = genai.GenerativeModel(
-        model_id, 
-        system_instruction=system_instruction
-    )
+    # ใช้ cached content ของ System Prompt ถ้าทำได้ (configure/สร้าง model ครั้งเดียวต่อ key)
+    model = get_gemini_analysis_model(model_id, system_instruction)
     
-    GEMINI_SCHEMA = {
-        "type": "object",
-        "properties": {
-            "bloom_level": {"type": "string"},
-            "reasoning": {"type": "string"},
-            "difficulty": {"type": "string"},
-            "curriculum_standard": {"type": "string"},
-            "correct_option": {"type": "string"},
-            "correct_option_analysis": {"type": "string"},
-            "distractor_analysis": {"type": "string"},
-            "why_good_distractor": {"type": "string"},
-            "is_good_question": {"type": "boolean"},
-            "improvement_suggestion": {"type": "string"}
-        },
-        "required": [
-            "bloom_level", "reasoning", "difficulty", "curriculum_standard",
-            "correct_option", "correct_option_analysis", "distractor_analysis",
-            "why_good_distractor", "is_good_question", "improvement_suggestion"
-        ]
-    }
-
     config = GenerationConfig( 
         response_mime_type="application/json", 
-        max_output_tokens=2048,
+        max_output_tokens=SINGLE_MAX_OUTPUT_TOKENS,
         temperature=0.2,
         response_schema=GEMINI_SCHEMA
     )
     
     last_error_message = ""
     max_retries = 3  # Reduced from 5 for faster failure
+    limiter = get_provider_limiter("Gemini (Google)", model_id)
+    input_tokens = estimate_prompt_tokens("Gemini (Google)", system_instruction, user_message)
+    estimated_tokens = input_tokens + DEFAULT_OUTPUT_TOKENS
+    rate_limited = False
 
     for attempt in range(max_retries):
-        if attempt > 0:
+        if attempt > 0 and not rate_limited:
             # Optimized: faster retry (2-6 seconds max instead of 60)
             base_delay = min(6, (2 ** attempt))
             time.sleep(base_delay)
+        rate_limited = False
+
+        # รอโควตาก่อนส่ง แทนการยิงแล้วค่อยโดน 429
+        if not limiter.acquire(estimated_tokens):
+            return create_error_response("Quota Exceeded (Rate Limit)")
             
         try:
             response = model.generate_content(
                 user_message, 
                 generation_config=config, 
             )
+            limiter.record_usage(_response_token_usage(response), estimated_tokens)
+            record_prompt_tokens("Gemini (Google)", model_id, input_tokens, _response_input_tokens(response))
             raw_text = response.text.strip()
         
             cleaned_json = re.sub(r'^```(?:json)?\s*|```$', '', raw_text, flags=re.MULTILINE | re.DOTALL).strip()
@@ -322,43 +716,50 @@ def analyze_with_gemini(question_text, question_id=1):
             if attempt < max_retries - 1: continue
             
         except Exception as e:
-            error_str = str(e).lower()
-            is_rate_limit = any([x in error_str for x in ["429", "quota", "resourceexhausted", "too many requests"]])
-            
-            if is_rate_limit:
+            if is_rate_limit_error(e):
+                # limiter จะหน่วงคำขอถัดไป (ทุก session) ตาม retry delay ที่ server แจ้ง
+                limiter.penalize(parse_retry_after(e), default=min(30, 10 * (attempt + 1)))
+                rate_limited = True
                 if attempt < max_retries - 1:
-                    # Optimized: max 30s instead of 120s
-                    retry_delay = min(30, 10 * (attempt + 1))
-                    time.sleep(retry_delay)
                     continue
                 else:
                     return create_error_response("Quota Exceeded (Rate Limit)")
             else:
                 last_error_message = f"ข้อผิดพลาด: {str(e)}"
+                if is_cache_missing_error(e):
+                    # cached content ฝั่ง server หายไปก่อน TTL: ลบ handle แล้วลองใหม่ด้วย model ปกติ
+                    context_cache.invalidate("Gemini (Google)", model_id, system_instruction)
+                    model = get_gemini_model(GEMINI_API_KEY, model_id, system_instruction)
                 if attempt < max_retries - 1: continue
 
     return create_error_response(last_error_message)
 
-def analyze_with_groq(question_text, question_id=1):
+def analyze_with_groq(question_text, question_id=1, settings=None, rag_context=None):
     """วิเคราะห์ข้อสอบผ่าน Groq API"""
     if not GROQ_AVAILABLE:
         return create_error_response("ไม่พบ GROQ_API_KEY")
     
-    from groq import Groq
-    client = Groq(api_key=GROQ_API_KEY)
+    client = get_groq_client(GROQ_API_KEY)
     
-    selected_model = st.session_state.get('selected_model', 'Llama 3.3 70B (แนะนำ)')
-    model_id = AI_PROVIDERS["Groq (ฟรี+เร็วมาก)"]["models"].get(selected_model, "llama-3.3-70b-versatile")
+    settings = settings or get_analysis_settings()
+    model_id = resolve_model_id("Groq (ฟรี+เร็วมาก)", settings['model'])
     
-    system_prompt, user_message = build_analysis_prompt(question_text, question_id)
+    system_prompt, user_message = build_analysis_prompt(question_text, question_id, settings, rag_context)
     
     max_retries = 3
     last_error = ""
+    limiter = get_provider_limiter("Groq (ฟรี+เร็วมาก)", model_id)
+    input_tokens = estimate_prompt_tokens("Groq (ฟรี+เร็วมาก)", system_prompt, user_message)
+    estimated_tokens = input_tokens + DEFAULT_OUTPUT_TOKENS
+    rate_limited = False
     
     for attempt in range(max_retries):
-        if attempt > 0: time.sleep(attempt * 2)
+        if attempt > 0 and not rate_limited: time.sleep(attempt * 2)
+        rate_limited = False
+        if not limiter.acquire(estimated_tokens):
+            return create_error_response("Groq Error: Quota Exceeded (Rate Limit)")
         try:
-            response = client.chat.completions.create(
+            raw_response = client.chat.completions.with_raw_response.create(
                 model=model_id,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -368,38 +769,47 @@ def analyze_with_groq(question_text, question_id=1):
                 max_tokens=2000,
                 response_format={"type": "json_object"}
             )
+            limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+            limiter.record_usage(_response_token_usage(response), estimated_tokens)
+            record_prompt_tokens("Groq (ฟรี+เร็วมาก)", model_id, input_tokens, _response_input_tokens(response))
             raw_text = response.choices[0].message.content
             analysis = json.loads(raw_text)
             return sanitize_analysis(analysis)
         except Exception as e:
             last_error = str(e)
-            if "429" in last_error: time.sleep(5)
+            if is_rate_limit_error(e):
+                limiter.penalize(parse_retry_after(e), default=5)
+                rate_limited = True
             
     return create_error_response(f"Groq Error: {last_error}")
 
-def analyze_with_openrouter(question_text, question_id=1):
+def analyze_with_openrouter(question_text, question_id=1, settings=None, rag_context=None):
     """วิเคราะห์ข้อสอบผ่าน OpenRouter API"""
     if not OPENROUTER_AVAILABLE:
         return create_error_response("ไม่พบ OPENROUTER_API_KEY")
     
-    import openai
-    client = openai.OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=OPENROUTER_API_KEY
-    )
+    client = get_openrouter_client(OPENROUTER_API_KEY)
     
-    selected_model = st.session_state.get('selected_model', 'Llama 3.2 3B (ฟรี)')
-    model_id = AI_PROVIDERS["OpenRouter (หลายโมเดลฟรี)"]["models"].get(selected_model, "meta-llama/llama-3.2-3b-instruct:free")
+    settings = settings or get_analysis_settings()
+    model_id = resolve_model_id("OpenRouter (หลายโมเดลฟรี)", settings['model'])
     
-    system_prompt, user_message = build_analysis_prompt(question_text, question_id)
+    system_prompt, user_message = build_analysis_prompt(question_text, question_id, settings, rag_context)
     
     max_retries = 3
     last_error = ""
+    limiter = get_provider_limiter("OpenRouter (หลายโมเดลฟรี)", model_id)
+    input_tokens = estimate_prompt_tokens("OpenRouter (หลายโมเดลฟรี)", system_prompt, user_message)
+    estimated_tokens = input_tokens + DEFAULT_OUTPUT_TOKENS
+    rate_limited = False
     
     for attempt in range(max_retries):
-        if attempt > 0: time.sleep(attempt * 2)
+        if attempt > 0 and not rate_limited: time.sleep(attempt * 2)
+        rate_limited = False
+        if not limiter.acquire(estimated_tokens):
+            return create_error_response("OpenRouter Error: Quota Exceeded (Rate Limit)")
         try:
-            response = client.chat.completions.create(
+            raw_response = client.chat.completions.with_raw_response.create(
                 model=model_id,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -408,6 +818,10 @@ def analyze_with_openrouter(question_text, question_id=1):
                 temperature=0.2,
                 max_tokens=2000
             )
+            limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+            limiter.record_usage(_response_token_usage(response), estimated_tokens)
+            record_prompt_tokens("OpenRouter (หลายโมเดลฟรี)", model_id, input_tokens, _response_input_tokens(response))
             raw_text = response.choices[0].message.content
             cleaned = re.sub(r'^```(?:json)?\s*|```$', '', raw_text, flags=re.MULTILINE | re.DOTALL).strip()
             start = cleaned.find('{')
@@ -417,46 +831,515 @@ def analyze_with_openrouter(question_text, question_id=1):
             return sanitize_analysis(analysis)
         except Exception as e:
             last_error = str(e)
-            if "429" in last_error: time.sleep(5)
+            if is_rate_limit_error(e):
+                limiter.penalize(parse_retry_after(e), default=5)
+                rate_limited = True
 
     return create_error_response(f"OpenRouter Error: {last_error}")
 
-def analyze_question(question_text, question_id=1):
-    """Wrapper function"""
-    provider = st.session_state.get('selected_provider', DEFAULT_PROVIDER)
-    
-    if provider == "⚔️ Battle Mode (Gemini vs Groq)":
-        return analyze_with_battle(question_text, question_id)
-    elif provider == "Gemini (Google)":
-        return analyze_with_gemini(question_text, question_id)
-    elif provider == "Groq (ฟรี+เร็วมาก)":
-        return analyze_with_groq(question_text, question_id)
-    elif provider == "OpenRouter (หลายโมเดลฟรี)":
-        return analyze_with_openrouter(question_text, question_id)
-    else:
-        return analyze_with_gemini(question_text, question_id)
+def analyze_with_fake(question_text, question_id=1, settings=None, rag_context=None):
+    """วิเคราะห์ด้วย Provider จำลองในเครื่อง (ผ่านเส้นทาง context cache แบบเดียวกับ Gemini)"""
+    settings = settings or get_analysis_settings()
+    model_id = resolve_model_id(FAKE_PROVIDER, settings['model'])
+    system_prompt, user_message = build_analysis_prompt(question_text, question_id, settings, rag_context)
 
-def analyze_with_battle(question_text, question_id=1):
-    """เปรียบเทียบผลลัพธ์จาก 2 โมเดล (Gemini vs Groq)"""
-    # 1. Analyze with Gemini
-    res_gemini = analyze_with_gemini(question_text, question_id)
-    
-    # 2. Analyze with Groq (Llama 3)
-    # Force use of default Groq model even if not selected
-    res_groq = analyze_with_groq(question_text, question_id)
-    
-    # 3. Create a merged/comparison result
-    # We will return Gemini's result as structure but append Battle Info
-    
-    battle_result = res_gemini.copy()
-    battle_result["battle_info"] = {
-        "model_a": "Gemini 2.0 Flash",
-        "result_a": res_gemini,
-        "model_b": "Llama 3.3 70B (Groq)",
-        "result_b": res_groq
+    client = get_fake_client()
+    cached = context_cache.get_or_create(
+        FAKE_PROVIDER, model_id, system_prompt, estimate_prompt_tokens(FAKE_PROVIDER, system_prompt),
+        lambda ttl: client.create_cached_content(model_id, system_prompt, ttl)
+    )
+
+    # retry/rate limit แบบเดียวกับ Groq เพื่อใช้วัดผลการปรับ concurrency/retry โดยไม่ต้องใช้เครือข่าย
+    max_retries = 3
+    last_error = ""
+    limiter = get_provider_limiter(FAKE_PROVIDER, model_id)
+    input_tokens = estimate_prompt_tokens(FAKE_PROVIDER, system_prompt, user_message)
+    estimated_tokens = input_tokens + DEFAULT_OUTPUT_TOKENS
+    rate_limited = False
+
+    for attempt in range(max_retries):
+        if attempt > 0 and not rate_limited: time.sleep(attempt * 2)
+        rate_limited = False
+        if not limiter.acquire(estimated_tokens):
+            return create_error_response("Fake Provider Error: Quota Exceeded (Rate Limit)")
+        try:
+            if cached is not None:
+                response = client.generate(model_id, user_message, cached_content=cached)
+            else:
+                response = client.generate(model_id, user_message, system_instruction=system_prompt)
+            limiter.record_usage(_response_token_usage(response), estimated_tokens)
+            record_prompt_tokens(FAKE_PROVIDER, model_id, input_tokens, _response_input_tokens(response))
+            analysis = json.loads(_extract_json_text(response.text))
+            return sanitize_analysis(analysis)
+        except Exception as e:
+            last_error = str(e)
+            if is_rate_limit_error(e):
+                limiter.penalize(parse_retry_after(e), default=5)
+                rate_limited = True
+            elif cached is not None and is_cache_missing_error(e):
+                context_cache.invalidate(FAKE_PROVIDER, model_id, system_prompt)
+                cached = None
+
+    return create_error_response(f"Fake Provider Error: {last_error}")
+
+# ฟังก์ชันวิเคราะห์รายข้อของแต่ละ Provider (ใช้เลือก Provider และทำ failover)
+PROVIDER_HANDLERS = {
+    "Gemini (Google)": analyze_with_gemini,
+    "Groq (ฟรี+เร็วมาก)": analyze_with_groq,
+    "OpenRouter (หลายโมเดลฟรี)": analyze_with_openrouter,
+}
+if FAKE_PROVIDER_ENABLED:
+    PROVIDER_HANDLERS[FAKE_PROVIDER] = analyze_with_fake
+
+def make_analysis_cache_key(question_text, settings, rag_context=None):
+    """สร้าง key ของ Cache จากข้อสอบ + provider + model id + system prompt + RAG context + ภาษา"""
+    provider = settings['provider']
+    system_prompt, _ = build_analysis_prompt(question_text, 1, settings, rag_context="")
+    if rag_context is None:
+        rag_context = get_rag_context(question_text, settings)
+    parts = [
+        normalize_question_for_key(question_text),
+        provider,
+        resolve_model_id(provider, settings['model']),
+        system_prompt,
+        rag_context,
+        settings['language'],
+    ]
+    if provider == BATTLE_PROVIDER:
+        parts += [f"{p}={resolve_model_id(p, m)}" for p, m in get_battle_contestants(settings)]
+    return hashlib.sha256("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+def _lookup_cached_analysis(question_text, settings, rag_context=None):
+    """คืน (cache_key, ผลวิเคราะห์ใน Cache หรือ None)"""
+    if not ANALYSIS_CACHE_ENABLED:
+        return None, None
+    try:
+        cache_key = make_analysis_cache_key(question_text, settings, rag_context)
+        return cache_key, get_cached_analysis(cache_key)
+    except Exception as e:
+        print(f"Analysis cache lookup failed: {e}")
+        return None, None
+
+def _store_cached_analysis(cache_key, settings, analysis):
+    """บันทึกผลลง Cache (ข้ามผลที่ error)"""
+    if not cache_key or is_error_response(analysis) or analysis.get('analyzed_by'):
+        # ผลจาก Provider สำรองไม่ตรงกับ Provider/Model ใน cache key จึงไม่เก็บ
+        return
+    contestants = (analysis.get('battle_info') or {}).get('contestants', [])
+    if any(is_error_response(entry['result']) for entry in contestants):
+        return
+    try:
+        provider = settings['provider']
+        save_cached_analysis(cache_key, provider, resolve_model_id(provider, settings['model']), analysis)
+    except Exception as e:
+        print(f"Analysis cache write failed: {e}")
+
+def analyze_question(question_text, question_id=1, settings=None, rag_context=None):
+    """Wrapper function (ตรวจ Cache ก่อนเรียก AI)
+
+    rag_context: ข้อความอ้างอิงหลักสูตรที่ค้นไว้แล้ว (None = ค้นเองทีละข้อ)
+    """
+    settings = settings or get_analysis_settings()
+    if rag_context is None:
+        rag_context = get_rag_context(question_text, settings)
+    cache_key, cached = _lookup_cached_analysis(question_text, settings, rag_context)
+    if cached:
+        return cached
+
+    analysis = analyze_question_uncached(question_text, question_id, settings, rag_context)
+    _store_cached_analysis(cache_key, settings, analysis)
+    return analysis
+
+def analyze_question_uncached(question_text, question_id=1, settings=None, rag_context=None):
+    """เลือก Provider ตามการตั้งค่า แล้ววิเคราะห์ข้อสอบ (ไม่ผ่าน Cache)
+
+    ถ้าเปิด failover/hedging จะสลับไป Provider อื่นที่มี API Key เมื่อตัวหลักล้มเหลว
+    หรือถูกตัดวงจร (circuit breaker) และติดป้าย analyzed_by ในผลลัพธ์
+    """
+    settings = settings or get_analysis_settings()
+    provider = settings['provider']
+
+    if provider == BATTLE_PROVIDER:
+        return analyze_with_battle(question_text, question_id, settings, rag_context)
+    if provider not in PROVIDER_HANDLERS:
+        provider = "Gemini (Google)"
+
+    def call_provider(name):
+        if name == provider:
+            provider_settings = settings
+        else:
+            provider_settings = dict(settings, provider=name, model=next(iter(AI_PROVIDERS[name]["models"])))
+        return PROVIDER_HANDLERS[name](question_text, question_id, provider_settings, rag_context)
+
+    if not (settings.get('failover') or settings.get('hedging')):
+        return call_with_tracking(provider, lambda: call_provider(provider), is_error_response)
+
+    chain = get_failover_chain(provider)
+    used, result = route_with_failover(chain, call_provider, is_error_response, hedging=settings.get('hedging', False))
+    if isinstance(result, Exception) or result is None:
+        return create_error_response(f"All providers failed: {result}")
+    if used != provider and not is_error_response(result):
+        result['analyzed_by'] = used
+    return result
+
+def get_failover_chain(provider):
+    """ลำดับ Provider ที่จะลอง: ตัวที่เลือกก่อน ตามด้วยตัวอื่นที่มี API Key (ปรับลำดับผ่าน env FAILOVER_ORDER)"""
+    available = {
+        "Gemini (Google)": GEMINI_AVAILABLE,
+        "Groq (ฟรี+เร็วมาก)": GROQ_AVAILABLE,
+        "OpenRouter (หลายโมเดลฟรี)": OPENROUTER_AVAILABLE,
     }
-    battle_result["improvement_suggestion"] = f"**Gemini:** {res_gemini.get('improvement_suggestion')}\n\n---\n\n**Llama 3:** {res_groq.get('improvement_suggestion')}"
-    
+    order = list(PROVIDER_HANDLERS)
+    preferred = [p.strip().lower() for p in os.getenv('FAILOVER_ORDER', '').split(',') if p.strip()]
+    if preferred:
+        rank = lambda name: next((i for i, key in enumerate(preferred) if name.lower().startswith(key)), len(preferred))
+        order.sort(key=rank)
+    return [provider] + [p for p in order if p != provider and available.get(p)]
+
+# --- Batch Mode (หลายข้อต่อหนึ่งคำขอ) ---
+def supports_batch(settings):
+    """Provider ที่เลือกรองรับ Batch Mode และผู้ใช้เปิดไว้หรือไม่"""
+    config = AI_PROVIDERS.get(settings['provider'], {})
+    return bool(settings.get('batch_mode')) and config.get("supports_batch", False)
+
+def plan_batches(questions, rag_contexts, settings):
+    """แบ่งข้อสอบเป็นกลุ่มอัตโนมัติตามงบ token ของ Provider (input budget + max output)"""
+    config = AI_PROVIDERS.get(settings['provider'], {})
+    system_prompt, _ = build_analysis_prompt("", 1, settings, rag_context="")
+    input_budget = config.get("batch_token_budget", 0) - estimate_prompt_tokens(settings['provider'], system_prompt) - 300
+    max_per_batch = min(MAX_BATCH_SIZE, config.get("max_output_tokens", 0) // DEFAULT_OUTPUT_TOKENS)
+
+    batches, current, used = [], [], 0
+    for idx, q_text in enumerate(questions):
+        cost = estimate_prompt_tokens(settings['provider'], q_text, rag_contexts[idx]) + 20
+        if current and (used + cost > input_budget or len(current) >= max_per_batch):
+            batches.append(current)
+            current, used = [], 0
+        current.append(idx)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def build_batch_prompt(items, settings):
+    """สร้าง Prompt สำหรับหลายข้อ items = [(question_id, question_text, rag_sections), ...]
+
+    section หลักสูตรที่ซ้ำกันระหว่างข้อถูกส่งครั้งเดียวในบล็อกอ้างอิง แล้วแต่ละข้ออ้างด้วยเลข [R1], [R2], ...
+    """
+    language = settings['language']
+    system_prompt, _ = build_analysis_prompt("", 1, settings, rag_context="")
+    # ตัวอย่างทั้งชุดอยู่ใน System Prompt แล้ว (cached prefix) ไม่ต้องแนบซ้ำ
+    library = _few_shot_library.get((settings['provider'], language), ("",))[0]
+    few_shot_cached = bool(library) and system_prompt.endswith(library)
+
+    from .rag import dedupe_sections
+    label = "Question" if language == 'en' else "คำถามข้อที่"
+    unique_sections, refs = dedupe_sections([sections for _, _, sections in items])
+    blocks = []
+    for (q_id, q_text, sections), q_refs in zip(items, refs):
+        block = f"### {label} {q_id}:\n{q_text}"
+        if q_refs:
+            block += "\n(Reference: " + ", ".join(f"[R{i + 1}]" for i in q_refs) + ")"
+        blocks.append(block)
+    questions_block = "\n\n".join(blocks)
+    if unique_sections:
+        references = "\n\n".join(f"[R{i + 1}] {section}" for i, section in enumerate(unique_sections))
+        questions_block = f"""**REFERENCE CURRICULUM:**
+{references}
+(Use the referenced sections to determine 'curriculum_standard')
+
+{questions_block}"""
+    if not settings['custom_prompt'] and not few_shot_cached:
+        # ตัวอย่างที่ใกล้เคียงที่สุดของแต่ละข้อ รวมแล้วไม่เกิน 3 ชุด
+        examples = []
+        for _, q_text, sections in items:
+            for example in FEW_SHOT_INDEX.select(q_text, k=1, strand=detect_strand(sections[0] if sections else "")):
+                if example not in examples:
+                    examples.append(example)
+        few_shot = format_few_shot(examples[:FEW_SHOT_INDEX_BATCH_LIMIT], language)
+        if few_shot:
+            questions_block = f"{few_shot}\n\n{questions_block}"
+
+    # รูปแบบคำตอบ (คงที่) ขึ้นก่อน จำนวนข้อและเนื้อหาข้อสอบ (เปลี่ยนทุก batch) อยู่ท้าย
+    if language == 'en':
+        user_message = f"""Analyze each of the following questions independently.
+Answer in JSON only (No Markdown text) as {{"analyses": [...]}} with exactly one item per question, in the same order. Each item has keys:
+- question_id (Integer: the question number given below)
+{_required_keys_spec(language)}
+
+{len(items)} questions:
+
+{questions_block}"""
+    else:
+        user_message = f"""วิเคราะห์ข้อสอบต่อไปนี้แยกกันทีละข้อ
+ตอบเป็น JSON เท่านั้น (ไม่ต้องมี Markdown text) ในรูปแบบ {{"analyses": [...]}} โดยมี 1 รายการต่อ 1 ข้อ ตามลำดับเดิม แต่ละรายการมี keys:
+- question_id (Integer: เลขข้อตามที่ระบุด้านล่าง)
+{_required_keys_spec(language)}
+
+ข้อสอบ {len(items)} ข้อ:
+
+{questions_block}"""
+    return system_prompt, user_message
+
+def _extract_json_text(raw_text):
+    """ตัด Markdown fence และข้อความรอบนอกออก เหลือเฉพาะ JSON object/array"""
+    cleaned = re.sub(r'^```(?:json)?\s*|```$', '', raw_text or "", flags=re.MULTILINE | re.DOTALL).strip()
+    starts = [i for i in (cleaned.find('{'), cleaned.find('[')) if i != -1]
+    if not starts:
+        raise ValueError("Could not find valid JSON structure.")
+    start = min(starts)
+    end = cleaned.rfind('}' if cleaned[start] == '{' else ']')
+    if end <= start:
+        raise ValueError("Could not find valid JSON structure.")
+    return cleaned[start:end+1]
+
+def request_provider_json(provider, model_id, system_prompt, user_message, max_output_tokens=2048, gemini_schema=None, max_retries=3):
+    """ส่งคำขอไปยัง Provider (ผ่าน client pool + rate limiter) แล้วคืน JSON ที่ parse แล้ว (raise เมื่อไม่สำเร็จ)"""
+    limiter = get_provider_limiter(provider, model_id)
+    input_tokens = estimate_prompt_tokens(provider, system_prompt, user_message)
+    estimated_tokens = input_tokens + max_output_tokens // 2
+    last_error = None
+    rate_limited = False
+    use_context_cache = True
+
+    for attempt in range(max_retries):
+        if attempt > 0 and not rate_limited:
+            time.sleep(min(6, 2 ** attempt))
+        rate_limited = False
+        if not limiter.acquire(estimated_tokens):
+            raise RuntimeError("Quota Exceeded (Rate Limit)")
+        try:
+            if provider == "Gemini (Google)":
+                if use_context_cache:
+                    model = get_gemini_analysis_model(model_id, system_prompt)
+                else:
+                    model = get_gemini_model(GEMINI_API_KEY, model_id, system_prompt)
+                config = GenerationConfig(
+                    response_mime_type="application/json",
+                    max_output_tokens=max_output_tokens,
+                    temperature=0.2,
+                    response_schema=gemini_schema
+                )
+                response = model.generate_content(user_message, generation_config=config)
+                raw_text = response.text
+            else:
+                if provider == "Groq (ฟรี+เร็วมาก)":
+                    client = get_groq_client(GROQ_API_KEY)
+                    extra = {"response_format": {"type": "json_object"}}
+                else:
+                    client = get_openrouter_client(OPENROUTER_API_KEY)
+                    extra = {}
+                raw_response = client.chat.completions.with_raw_response.create(
+                    model=model_id,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_message}
+                    ],
+                    temperature=0.2,
+                    max_tokens=max_output_tokens,
+                    **extra
+                )
+                limiter.update_from_headers(raw_response.headers)
+                response = raw_response.parse()
+                raw_text = response.choices[0].message.content
+            limiter.record_usage(_response_token_usage(response), estimated_tokens)
+            record_prompt_tokens(provider, model_id, input_tokens, _response_input_tokens(response))
+            return json.loads(_extract_json_text(raw_text))
+        except Exception as e:
+            last_error = e
+            if is_rate_limit_error(e):
+                limiter.penalize(parse_retry_after(e), default=min(30, 10 * (attempt + 1)))
+                rate_limited = True
+            elif provider == "Gemini (Google)" and is_cache_missing_error(e):
+                context_cache.invalidate(provider, model_id, system_prompt)
+                use_context_cache = False
+
+    raise last_error
+
+def _is_valid_batch_item(item):
+    """รายการในคำตอบ Batch ใช้ได้หรือไม่ (ต้องเป็น object และมีระดับ Bloom)"""
+    return isinstance(item, dict) and str(item.get("bloom_level", "")).strip() not in ("", "null", "None")
+
+def analyze_questions_batch(items, settings):
+    """วิเคราะห์หลายข้อในคำขอเดียว items = [(question_id, question_text, rag_sections), ...]
+
+    คืน dict {question_id: analysis} เฉพาะข้อที่ได้ผลถูกต้อง ข้อที่หายไป/ผิดรูปแบบให้ผู้เรียก fallback เอง
+    """
+    provider = settings['provider']
+    config = AI_PROVIDERS.get(provider, {})
+    model_id = resolve_model_id(provider, settings['model'])
+    system_prompt, user_message = build_batch_prompt(items, settings)
+
+    try:
+        data = request_provider_json(
+            provider, model_id, system_prompt, user_message,
+            max_output_tokens=config.get("max_output_tokens", 2048),
+            gemini_schema=GEMINI_BATCH_SCHEMA
+        )
+    except Exception as e:
+        print(f"Batch analysis failed ({len(items)} questions): {e}")
+        return {}
+
+    analyses = data.get("analyses", []) if isinstance(data, dict) else data
+    if not isinstance(analyses, list):
+        return {}
+
+    expected_ids = [q_id for q_id, _, _ in items]
+    results = {}
+    for position, item in enumerate(analyses):
+        if not _is_valid_batch_item(item):
+            continue
+        try:
+            q_id = int(item.get("question_id"))
+        except (TypeError, ValueError):
+            # ไม่มีเลขข้อ: จับคู่ตามลำดับเฉพาะเมื่อจำนวนรายการตรงกัน
+            q_id = expected_ids[position] if len(analyses) == len(items) else None
+        if q_id in expected_ids and q_id not in results:
+            results[q_id] = sanitize_analysis(item)
+    return results
+
+def _analyze_batch_group(indices, questions, rag_contexts, rag_sections, settings, numbers):
+    """งานของ worker หนึ่งตัวใน Batch Mode: ตรวจ Cache → ส่ง batch → fallback ทีละข้อเฉพาะข้อที่ล้มเหลว"""
+    results = {}
+    pending = []
+    for idx in indices:
+        cache_key, cached = _lookup_cached_analysis(questions[idx], settings, rag_contexts[idx])
+        if cached:
+            results[idx] = cached
+        else:
+            pending.append((idx, cache_key))
+
+    if pending:
+        batch_results = {}
+        if len(pending) > 1:
+            batch_items = [(numbers[idx], questions[idx], rag_sections[idx]) for idx, _ in pending]
+            batch_results = analyze_questions_batch(batch_items, settings)
+        for idx, cache_key in pending:
+            analysis = batch_results.get(numbers[idx])
+            if analysis is None:
+                analysis = analyze_question_uncached(questions[idx], numbers[idx], settings, rag_contexts[idx])
+            _store_cached_analysis(cache_key, settings, analysis)
+            results[idx] = analysis
+    return results
+
+def get_provider_concurrency(provider, settings=None):
+    """จำนวนคำขอพร้อมกันสูงสุดของ Provider (ตั้งค่าผ่าน env เช่น GEMINI_MAX_CONCURRENCY)
+
+    Battle Mode ยิงทุกโมเดลพร้อมกันต่อข้อ จึงจำกัดจำนวนข้อพร้อมกันด้วยค่าต่ำสุดของผู้เข้าแข่งขัน
+    """
+    limit = AI_PROVIDERS.get(provider, {}).get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+    if provider == BATTLE_PROVIDER and settings:
+        for contestant, _ in get_battle_contestants(settings):
+            limit = min(limit, AI_PROVIDERS.get(contestant, {}).get("max_concurrency", DEFAULT_MAX_CONCURRENCY))
+    return max(1, limit)
+
+def analyze_questions_parallel(questions, settings=None, on_result=None, max_workers=None, question_numbers=None):
+    """วิเคราะห์ข้อสอบหลายข้อพร้อมกัน (Thread Pool) โดยคืนผลตามลำดับข้อเดิม
+
+    on_result(index, analysis, completed, total) ถูกเรียกใน thread ของผู้เรียก
+    ทุกครั้งที่วิเคราะห์เสร็จหนึ่งข้อ จึงอัปเดต progress bar ของ Streamlit ได้โดยตรง
+    question_numbers ใช้เมื่อวิเคราะห์เฉพาะบางข้อ (เช่น resume) เพื่อให้เลขข้อใน Prompt ตรงกับต้นฉบับ
+    """
+    settings = settings or get_analysis_settings()
+    total = len(questions)
+    results = [None] * total
+    if total == 0:
+        return results
+    numbers = question_numbers or list(range(1, total + 1))
+
+    workers = max_workers or get_provider_concurrency(settings['provider'], settings)
+    workers = max(1, min(workers, total))
+
+    def finish(idx, analysis):
+        if not analysis:
+            analysis = create_error_response("Analysis returned None")
+        results[idx] = analysis
+        completed = sum(1 for r in results if r is not None)
+        if on_result:
+            on_result(idx, analysis, completed, total)
+
+    # ค้นหลักสูตรของทั้งชุดข้อสอบในครั้งเดียวก่อนกระจายงาน
+    rag_sections = fit_rag_sections(questions, get_rag_sections(questions), settings)
+    rag_contexts = [format_rag_context(sections) for sections in rag_sections]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analyze") as pool:
+        if supports_batch(settings):
+            futures = {
+                pool.submit(_analyze_batch_group, group, questions, rag_contexts, rag_sections, settings, numbers): group
+                for group in plan_batches(questions, rag_contexts, settings)
+            }
+            for future in as_completed(futures):
+                try:
+                    group_results = future.result()
+                except Exception as e:
+                    group_results = {idx: create_error_response(f"ข้อผิดพลาด: {e}") for idx in futures[future]}
+                for idx in sorted(group_results):
+                    finish(idx, group_results[idx])
+        else:
+            futures = {
+                pool.submit(analyze_question, q_text, numbers[i], settings, rag_contexts[i]): i
+                for i, q_text in enumerate(questions)
+            }
+            for future in as_completed(futures):
+                try:
+                    analysis = future.result()
+                except Exception as e:
+                    analysis = create_error_response(f"ข้อผิดพลาด: {e}")
+                finish(futures[future], analysis)
+
+    return results
+
+def get_battle_contestants(settings):
+    """รายชื่อ (provider, ชื่อโมเดล) ที่แข่งกันใน Battle Mode (ข้ามรายการที่ไม่รู้จัก)"""
+    contestants = [
+        (provider, model) for provider, model in settings.get('battle_contestants') or DEFAULT_BATTLE_CONTESTANTS
+        if provider in PROVIDER_HANDLERS
+    ]
+    return contestants or list(DEFAULT_BATTLE_CONTESTANTS)
+
+def analyze_with_battle(question_text, question_id=1, settings=None, rag_context=None):
+    """เปรียบเทียบผลลัพธ์จากหลายโมเดลพร้อมกัน (N-way, ค่าเริ่มต้น Gemini vs Groq)
+
+    แต่ละโมเดลผ่าน rate limiter ของ Provider ตัวเอง เวลาต่อข้อจึงเท่ากับโมเดลที่ช้าที่สุด ไม่ใช่ผลรวม
+    """
+    settings = settings or get_analysis_settings()
+    contestants = get_battle_contestants(settings)
+
+    def run(provider, model):
+        contestant_settings = dict(settings, provider=provider, model=model)
+        return call_with_tracking(
+            provider,
+            lambda: PROVIDER_HANDLERS[provider](question_text, question_id, contestant_settings, rag_context),
+            is_error_response
+        )
+
+    results = [None] * len(contestants)
+    with ThreadPoolExecutor(max_workers=len(contestants), thread_name_prefix="battle") as pool:
+        futures = {pool.submit(run, provider, model): i for i, (provider, model) in enumerate(contestants)}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result() or create_error_response("Analysis returned None")
+            except Exception as e:
+                results[futures[future]] = create_error_response(f"ข้อผิดพลาด: {e}")
+
+    entries = [
+        {"model": f"{model} ({provider.split(' ')[0]})", "result": result}
+        for (provider, model), result in zip(contestants, results)
+    ]
+
+    # ใช้ผลของโมเดลแรกที่สำเร็จเป็นโครงหลัก แล้วแนบผลทุกโมเดลไว้ใน battle_info
+    base = next((r for r in results if not is_error_response(r)), results[0])
+    battle_result = base.copy()
+    battle_result["battle_info"] = {"contestants": entries}
+    if len(entries) >= 2:
+        battle_result["battle_info"].update({
+            "model_a": entries[0]["model"], "result_a": entries[0]["result"],
+            "model_b": entries[1]["model"], "result_b": entries[1]["result"],
+        })
+    if not is_error_response(base):
+        battle_result["improvement_suggestion"] = "\n\n---\n\n".join(
+            f"**{entry['model']}:** {entry['result'].get('improvement_suggestion')}" for entry in entries
+        )
     return battle_result
 
 # --- Generation Logic ---
@@ -480,13 +1363,11 @@ Level: {bloom_level}
     try:
         raw_text = ""
         if provider == "Gemini (Google)" and GEMINI_AVAILABLE:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel("gemini-2.0-flash")
+            model = get_gemini_model(GEMINI_API_KEY, "gemini-2.0-flash")
             response = model.generate_content(prompt)
             raw_text = response.text
         elif provider == "Groq (ฟรี+เร็วมาก)" and GROQ_AVAILABLE:
-            from groq import Groq
-            client = Groq(api_key=GROQ_API_KEY)
+            client = get_groq_client(GROQ_API_KEY)
             response = client.chat.completions.create(
                 model="llama-3.3-70b-versatile",
                 messages=[{"role": "user", "content": prompt}],
@@ -494,8 +1375,7 @@ Level: {bloom_level}
             )
             raw_text = response.choices[0].message.content
         elif provider == "OpenRouter (หลายโมเดลฟรี)" and OPENROUTER_AVAILABLE:
-            import openai
-            client = openai.OpenAI(base_url="https://openrouter.ai/api/v1", api_key=OPENROUTER_API_KEY)
+            client = get_openrouter_client(OPENROUTER_API_KEY)
             response = client.chat.completions.create(
                 model="meta-llama/llama-3.2-3b-instruct:free",
                 messages=[{"role": "user", "content": prompt}],
@@ -533,13 +1413,11 @@ def improve_question_with_ai(question_text, suggestion):
     
     try:
         if provider == "Gemini (Google)" and GEMINI_AVAILABLE:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel("gemini-2.0-flash")
+            model = get_gemini_model(GEMINI_API_KEY, "gemini-2.0-flash")
             response = model.generate_content(prompt)
             return response.text, None
         elif provider == "Groq (ฟรี+เร็วมาก)" and GROQ_AVAILABLE:
-            from groq import Groq
-            client = Groq(api_key=GROQ_API_KEY)
+            client = get_groq_client(GROQ_API_KEY)
             response = client.chat.completions.create(
                 model="llama-3.3-70b-versatile",
                 messages=[{"role": "user", "content": prompt}],
@@ -547,8 +1425,7 @@ def improve_question_with_ai(question_text, suggestion):
             )
             return response.choices[0].message.content, None
         elif provider == "OpenRouter (หลายโมเดลฟรี)" and OPENROUTER_AVAILABLE:
-            import openai
-            client = openai.OpenAI(base_url="https://openrouter.ai/api/v1", api_key=OPENROUTER_API_KEY)
+            client = get_openrouter_client(OPENROUTER_API_KEY)
             response = client.chat.completions.create(
                 model="meta-llama/llama-3.2-3b-instruct:free",
                 messages=[{"role": "user", "content": prompt}],
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import hashlib
+import threading
+
+# ความสามารถของแต่ละ Provider ในการลดต้นทุนของ prefix ที่ซ้ำ (System Prompt จาก Prompt.txt)
+#   context_cache: SDK สร้าง cached content ฝั่ง server ได้ (ส่ง prefix ครั้งเดียวแล้วอ้างด้วย handle)
+#   prefix_cache:  server แคช prefix ให้อัตโนมัติถ้าคำขอขึ้นต้นเหมือนกัน (จัดส่วนคงที่ไว้หน้าเสมอ)
+#   min_cache_tokens: prefix ต้องยาวอย่างน้อยกี่ token จึงจะสร้าง cached content ได้
+
+# อายุของ cached content ฝั่ง server (วินาที) และสร้างใหม่ก่อนหมดอายุกี่วินาที
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', '3600'))
+CONTEXT_CACHE_REFRESH_MARGIN = 60
+# Gemini ไม่รับ cached content ที่สั้นกว่าขั้นต่ำ (ค่าขั้นต่ำต่างกันตามรุ่นโมเดล ค่าที่ไม่ระบุใช้ GEMINI_MIN_CACHE_TOKENS)
+GEMINI_MIN_CACHE_TOKENS = int(os.getenv('GEMINI_MIN_CACHE_TOKENS', '4096'))
+GEMINI_MIN_CACHE_TOKENS_BY_MODEL = {
+    "gemini-2.0-flash": 4096,
+    "gemini-1.5-flash-latest": 4096,
+    "gemini-1.5-pro-latest": 4096,
+}
+CONTEXT_CACHE_ENABLED = os.getenv('CONTEXT_CACHE_ENABLED', '1').strip() not in ('0', 'false', 'no')
+
+PROVIDER_CAPABILITIES = {
+    "Gemini (Google)": {
+        "context_cache": True, "prefix_cache": True, "min_cache_tokens": GEMINI_MIN_CACHE_TOKENS,
+        "min_cache_tokens_by_model": GEMINI_MIN_CACHE_TOKENS_BY_MODEL,
+    },
+    "Groq (ฟรี+เร็วมาก)": {"context_cache": False, "prefix_cache": True, "min_cache_tokens": 0},
+    "OpenRouter (หลายโมเดลฟรี)": {"context_cache": False, "prefix_cache": True, "min_cache_tokens": 0},
+}
+
+def register_capabilities(provider, context_cache=False, prefix_cache=True, min_cache_tokens=0):
+    """ลงทะเบียนความสามารถของ Provider เพิ่มเติม (เช่น Provider จำลอง)"""
+    PROVIDER_CAPABILITIES[provider] = {
+        "context_cache": context_cache,
+        "prefix_cache": prefix_cache,
+        "min_cache_tokens": min_cache_tokens,
+    }
+
+def supports_context_cache(provider):
+    return CONTEXT_CACHE_ENABLED and PROVIDER_CAPABILITIES.get(provider, {}).get("context_cache", False)
+
+def min_cache_tokens(provider, model_id):
+    """ความยาว prefix ขั้นต่ำ (token) ที่สร้าง cached content ได้ของโมเดลนี้"""
+    capabilities = PROVIDER_CAPABILITIES.get(provider, {})
+    return capabilities.get("min_cache_tokens_by_model", {}).get(model_id, capabilities.get("min_cache_tokens", 0))
+
+
+# สร้างไม่สำเร็จด้วยเหตุชั่วคราว (429/เครือข่าย/key หมดอายุ): รอก่อนลองใหม่ เริ่มกี่วินาทีและนานสุดกี่วินาที
+CONTEXT_CACHE_RETRY_BASE = float(os.getenv('CONTEXT_CACHE_RETRY_BASE', '30'))
+CONTEXT_CACHE_RETRY_MAX = 600
+
+# ข้อความ error ที่แปลว่าโมเดลนี้ใช้ cached content ไม่ได้จริง (ไม่ใช่ปัญหาชั่วคราว)
+_UNSUPPORTED_MARKERS = ("not supported", "unsupported", "does not support", "too short", "too small", "min_total_token_count")
+
+def is_cache_unsupported_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in _UNSUPPORTED_MARKERS)
+
+def is_cache_missing_error(error):
+    """server ไม่พบ cached content ที่อ้าง (ถูกลบ/หมดอายุก่อน TTL ฝั่งเรา)"""
+    message = str(error).lower()
+    return ("404" in message or "not found" in message) and ("cachedcontent" in message or "cached content" in message)
+
+
+class ContextCacheRegistry:
+    """เก็บ handle ของ cached content ต่อ (provider, model, prefix) ใช้ร่วมกันทั้ง process"""
+
+    def __init__(self):
+        self._entries = {}
+        self._unsupported = set()
+        self._retry_at = {}   # (provider, model_id) -> (เวลาที่ลองสร้างใหม่ได้, จำนวนครั้งที่ล้มเหลวติดกัน)
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "reused": 0, "skipped": 0, "failed": 0, "invalidated": 0}
+
+    @staticmethod
+    def _key(provider, model_id, prefix):
+        return (provider, model_id, hashlib.sha256(prefix.encode('utf-8')).hexdigest())
+
+    def _skip(self):
+        with self._lock:
+            self.stats["skipped"] += 1
+        return None
+
+    def get_or_create(self, provider, model_id, prefix, prefix_tokens, create, ttl=None):
+        """คืน handle ที่สร้างไว้แล้ว หรือเรียก create(ttl) เพื่อสร้างใหม่ (None = ให้ผู้เรียกส่ง prefix แบบปกติ)"""
+        min_tokens = min_cache_tokens(provider, model_id)
+        ttl = ttl or CONTEXT_CACHE_TTL
+        model_key = (provider, model_id)
+        if not supports_context_cache(provider) or model_key in self._unsupported or prefix_tokens < min_tokens:
+            return self._skip()
+
+        key = self._key(provider, model_id, prefix)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - CONTEXT_CACHE_REFRESH_MARGIN > time.monotonic():
+                self.stats["reused"] += 1
+                return entry[0]
+            if self._retry_at.get(model_key, (0, 0))[0] > time.monotonic():
+                self.stats["skipped"] += 1
+                return None
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # สร้างภายใต้ lock ของ key นี้เท่านั้น (thread อื่นที่ใช้ prefix เดียวกันรอ ส่วน model/prefix อื่นไม่ถูกบล็อก)
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[1] - CONTEXT_CACHE_REFRESH_MARGIN > time.monotonic():
+                    self.stats["reused"] += 1
+                    return entry[0]
+                if model_key in self._unsupported or self._retry_at.get(model_key, (0, 0))[0] > time.monotonic():
+                    self.stats["skipped"] += 1
+                    return None
+            try:
+                handle = create(ttl)
+            except Exception as e:
+                with self._lock:
+                    self.stats["failed"] += 1
+                    if is_cache_unsupported_error(e):
+                        print(f"Context cache unsupported for {provider} / {model_id}: {e}")
+                        self._unsupported.add(model_key)
+                    else:
+                        failures = self._retry_at.get(model_key, (0, 0))[1] + 1
+                        delay = min(CONTEXT_CACHE_RETRY_MAX, CONTEXT_CACHE_RETRY_BASE * 2 ** (failures - 1))
+                        print(f"Context cache creation failed for {provider} / {model_id} (retry in {delay:g}s): {e}")
+                        self._retry_at[model_key] = (time.monotonic() + delay, failures)
+                return None
+            with self._lock:
+                self._entries[key] = (handle, time.monotonic() + ttl)
+                self._retry_at.pop(model_key, None)
+                self.stats["created"] += 1
+            return handle
+
+    def available(self, provider, model_id):
+        """โมเดลนี้น่าจะสร้าง/ใช้ cached content ได้ตอนนี้ (ไม่ถูกระบุว่าไม่รองรับ และไม่อยู่ในช่วงรอลองใหม่)"""
+        model_key = (provider, model_id)
+        with self._lock:
+            return (supports_context_cache(provider) and model_key not in self._unsupported
+                    and self._retry_at.get(model_key, (0, 0))[0] <= time.monotonic())
+
+    def invalidate(self, provider, model_id, prefix):
+        """ลบ handle ที่ server แจ้งว่าไม่พบแล้ว (คำขอถัดไปจะสร้างใหม่)"""
+        with self._lock:
+            if self._entries.pop(self._key(provider, model_id, prefix), None) is not None:
+                self.stats["invalidated"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unsupported.clear()
+            self._retry_at.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries))
+
+
+context_cache = ContextCacheRegistry()
+
+def get_context_cache_stats():
+    """จำนวนครั้งที่สร้าง/ใช้ซ้ำ/ข้าม cached content (สำหรับ UI และสคริปต์ตรวจสอบ)"""
+    return context_cache.snapshot()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import threading
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+# โฟลเดอร์เก็บหลักสูตรและดัชนีที่สร้างแล้ว (อยู่รอดหลัง restart / cold start)
+CURRICULUM_STORE_DIR = os.getenv('CURRICULUM_STORE_DIR', 'curricula_index')
+STORE_VERSION = 1
+
+# ไฟล์ในโฟลเดอร์ของแต่ละหลักสูตร
+META_FILE = "meta.json"        # ชื่อ, ตัวตัดคำ, avgdl, จำนวน section
+VOCAB_FILE = "vocab.json"      # {term: [start, end, idf]} ช่วงใน postings
+TEXT_FILE = "text.bin"         # ข้อความดิบ (UTF-8)
+OFFSETS_FILE = "sections.npy"  # int64 (n, 2): ช่วง byte ของแต่ละ section ใน text.bin
+DOCS_FILE = "postings_doc.npy" # int32: section id เรียงตาม term
+TF_FILE = "postings_tf.npy"    # int32: ความถี่ของ term ใน section
+DOC_LEN_FILE = "doc_len.npy"   # int32: จำนวนคำของแต่ละ section
+ACTIVE_FILE = "active.json"    # หลักสูตรที่เลือกใช้งาน (อยู่ที่ราก CURRICULUM_STORE_DIR)
+
+def curriculum_dir(name, store_dir=None):
+    """โฟลเดอร์ของหลักสูตร (ตั้งชื่อจาก hash เพราะชื่อหลักสูตรอาจเป็นภาษาไทย/มีอักขระพิเศษ)"""
+    slug = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(store_dir or CURRICULUM_STORE_DIR, slug)
+
+def _section_offsets(text, sections):
+    """ตำแหน่ง byte ของแต่ละ section ในข้อความดิบ (section เป็นข้อความย่อยของ text ตามลำดับ)"""
+    offsets = []
+    cursor = byte_cursor = 0
+    for section in sections:
+        start = text.find(section, cursor)
+        if start < 0:
+            raise ValueError("section is not a substring of the curriculum text")
+        byte_start = byte_cursor + len(text[cursor:start].encode('utf-8'))
+        byte_end = byte_start + len(section.encode('utf-8'))
+        offsets.append((byte_start, byte_end))
+        cursor, byte_cursor = start + len(section), byte_end
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2)
+
+def save_curriculum(name, text, sections, index, store_dir=None):
+    """บันทึกหลักสูตร + ดัชนี BM25 ลงดิสก์ (เขียนโฟลเดอร์ชั่วคราวแล้ว rename เพื่อไม่ให้ไฟล์ครึ่ง ๆ กลาง ๆ)"""
+    target = curriculum_dir(name, store_dir)
+    tmp = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+    os.makedirs(tmp, exist_ok=True)
+
+    with open(os.path.join(tmp, TEXT_FILE), 'wb') as f:
+        f.write(text.encode('utf-8'))
+    np.save(os.path.join(tmp, OFFSETS_FILE), _section_offsets(text, sections))
+
+    vocab = {}
+    docs, tfs = [], []
+    for term in sorted(index["postings"]):
+        plist = index["postings"][term]
+        vocab[term] = [len(docs), len(docs) + len(plist), index["idf"][term]]
+        docs.extend(doc_id for doc_id, _ in plist)
+        tfs.extend(tf for _, tf in plist)
+    np.save(os.path.join(tmp, DOCS_FILE), np.array(docs, dtype=np.int32))
+    np.save(os.path.join(tmp, TF_FILE), np.array(tfs, dtype=np.int32))
+    np.save(os.path.join(tmp, DOC_LEN_FILE), np.array(index["doc_len"], dtype=np.int32))
+    with open(os.path.join(tmp, VOCAB_FILE), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f, ensure_ascii=False, separators=(',', ':'))
+    with open(os.path.join(tmp, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump({
+            "version": STORE_VERSION,
+            "name": name,
+            "tokenizer": index["tokenizer"],
+            "avgdl": index["avgdl"],
+            "n_sections": len(sections),
+        }, f, ensure_ascii=False)
+
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(tmp, target)
+    return target
+
+def _embeddings_path(name, embedder_name, store_dir=None):
+    slug = hashlib.sha1(embedder_name.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(curriculum_dir(name, store_dir), f"embeddings-{slug}.npy")
+
+def save_embeddings(name, embedder_name, matrix, store_dir=None):
+    """บันทึก embedding matrix (float32) ของ section ไว้ในโฟลเดอร์ของหลักสูตร"""
+    path = _embeddings_path(name, embedder_name, store_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}.npy"
+    np.save(tmp, np.ascontiguousarray(matrix, dtype=np.float32))
+    os.replace(tmp, path)
+
+def load_embeddings(name, embedder_name, store_dir=None):
+    """โหลด embedding matrix ผ่าน mmap (None ถ้ายังไม่เคยสร้าง)"""
+    path = _embeddings_path(name, embedder_name, store_dir)
+    if not os.path.isfile(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+def save_active_name(name, store_dir=None):
+    """จำหลักสูตรที่เลือกใช้งานไว้ข้าม restart"""
+    store_dir = store_dir or CURRICULUM_STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, ACTIVE_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"active": name}, f, ensure_ascii=False)
+
+def load_active_name(store_dir=None):
+    try:
+        with open(os.path.join(store_dir or CURRICULUM_STORE_DIR, ACTIVE_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f).get("active")
+    except (OSError, ValueError):
+        return None
+
+def delete_curriculum(name, store_dir=None):
+    """ลบหลักสูตรออกจากดิสก์"""
+    shutil.rmtree(curriculum_dir(name, store_dir), ignore_errors=True)
+
+def list_stored_curricula(store_dir=None):
+    """อ่านเฉพาะ meta.json ของทุกหลักสูตรบนดิสก์ คืน [(path, meta)] (เร็ว ไม่โหลดดัชนี)"""
+    store_dir = store_dir or CURRICULUM_STORE_DIR
+    if not os.path.isdir(store_dir):
+        return []
+    stored = []
+    for entry in sorted(os.listdir(store_dir)):
+        path = os.path.join(store_dir, entry)
+        meta_path = os.path.join(path, META_FILE)
+        if '.tmp-' in entry or not os.path.isfile(meta_path):
+            continue
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Skipping broken curriculum index {path}: {e}")
+            continue
+        if meta.get("version") == STORE_VERSION:
+            stored.append((path, meta))
+    return stored
+
+
+class _SectionView(Sequence):
+    """รายการ section ที่อ่านจากข้อความดิบผ่าน mmap ตามช่วง byte"""
+
+    def __init__(self, text_map, offsets):
+        self._text = text_map
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self._offsets[i]
+        return self._text[int(start):int(end)].decode('utf-8')
+
+
+class _PostingsView:
+    """postings บนดิสก์ในรูปแบบเดียวกับ dict ของดัชนีในหน่วยความจำ (get(term) -> [(section_id, tf)])"""
+
+    def __init__(self, vocab, docs, tfs):
+        self._vocab = vocab
+        self._docs = docs
+        self._tfs = tfs
+
+    def get(self, term, default=None):
+        span = self._vocab.get(term)
+        if span is None:
+            return default
+        start, end = span[0], span[1]
+        return list(zip(self._docs[start:end].tolist(), self._tfs[start:end].tolist()))
+
+    def __contains__(self, term):
+        return term in self._vocab
+
+    def __iter__(self):
+        return iter(self._vocab)
+
+    def __len__(self):
+        return len(self._vocab)
+
+
+class StoredCurriculum(Mapping):
+    """หลักสูตรบนดิสก์ที่โหลดแบบ lazy: เปิด mmap เมื่อถูกใช้ครั้งแรก (หลาย process ใช้ page cache ร่วมกัน)
+
+    ใช้แทน dict {"text", "sections", "index"} ของ MultiSubjectRAG ได้โดยตรง
+    """
+
+    _KEYS = ("text", "sections", "index")
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded is None:
+                with open(os.path.join(self.path, TEXT_FILE), 'rb') as f:
+                    # ไฟล์ว่าง mmap ไม่ได้
+                    text_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+                with open(os.path.join(self.path, VOCAB_FILE), 'r', encoding='utf-8') as f:
+                    vocab = json.load(f)
+                load = lambda name: np.load(os.path.join(self.path, name), mmap_mode='r')
+                self._loaded = {
+                    "text_map": text_map,
+                    "sections": _SectionView(text_map, load(OFFSETS_FILE)),
+                    "index": {
+                        "tokenizer": self.meta["tokenizer"],
+                        "postings": _PostingsView(vocab, load(DOCS_FILE), load(TF_FILE)),
+                        "idf": {term: span[2] for term, span in vocab.items()},
+                        "doc_len": load(DOC_LEN_FILE),
+                        "avgdl": self.meta["avgdl"],
+                    },
+                }
+            return self._loaded
+
+    def __getitem__(self, key):
+        if key not in self._KEYS:
+            raise KeyError(key)
+        loaded = self._load()
+        if key == "text":
+            return loaded["text_map"][:].decode('utf-8')
+        return loaded[key]
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+    @property
+    def is_loaded(self):
+        return self._loaded is not None
@@ -2,6 +2,10 @@
 import sqlite3
 import json
 import os
+import hmac
+import secrets
+import time
+import threading
 from datetime import datetime
 
 DB_Name = "exams.db"
@@ -42,6 +46,7 @@ def save_exam_result(filename, results, summary):
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (filename, timestamp, total, good, summary, raw_json))
         conn.commit()
+        return c.lastrowid
 
 def get_recent_exams(limit=20):
     """ดึงประวัติล่าสุด"""
@@ -121,7 +126,8 @@ def add_to_question_bank(question_text, analysis, subject="", source_filename=""
             analysis.get('difficulty', ''),
             subject,
             analysis.get('curriculum_standard', ''),
-            analysis.get('correct_option', ''),
+            # คำตอบจากส่วนเฉลยของไฟล์แม่นกว่าคำตอบที่ AI เลือก
+            analysis.get('answer_key') or analysis.get('correct_option', ''),
             datetime.now().isoformat(),
             source_filename
         ))
@@ -179,3 +185,437 @@ def get_question_bank_stats():
         by_subject = {row[0]: row[1] for row in c.fetchall()}
         
         return {"total": total, "by_bloom": by_bloom, "by_subject": by_subject}
+
+# =====================================================
+# ANALYSIS CACHE - Reuse AI Results for Identical Questions
+# =====================================================
+
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', '5000'))
+ANALYSIS_CACHE_TTL_DAYS = float(os.getenv('ANALYSIS_CACHE_TTL_DAYS', '90'))
+
+_cache_stats_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+def _bump_cache_stat(name, amount=1):
+    with _cache_stats_lock:
+        _cache_stats[name] += amount
+
+def init_analysis_cache():
+    """สร้างตาราง Cache ผลวิเคราะห์ (key = hash ของข้อสอบ + provider + model + prompt + ภาษา)"""
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                cache_key TEXT PRIMARY KEY,
+                provider TEXT,
+                model_id TEXT,
+                analysis TEXT,
+                created_at REAL,
+                last_used REAL,
+                hit_count INTEGER DEFAULT 0
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache (last_used)')
+        conn.commit()
+
+def get_cached_analysis(cache_key):
+    """ดึงผลวิเคราะห์จาก Cache (คืน None ถ้าไม่มีหรือหมดอายุ)"""
+    init_analysis_cache()
+    now = time.time()
+    min_created = now - ANALYSIS_CACHE_TTL_DAYS * 86400
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT analysis, created_at FROM analysis_cache WHERE cache_key = ?', (cache_key,))
+        row = c.fetchone()
+        
+        if not row or row[1] < min_created:
+            _bump_cache_stat("misses")
+            return None
+        
+        c.execute('UPDATE analysis_cache SET last_used = ?, hit_count = hit_count + 1 WHERE cache_key = ?', (now, cache_key))
+        conn.commit()
+    
+    _bump_cache_stat("hits")
+    return json.loads(row[0])
+
+def save_cached_analysis(cache_key, provider, model_id, analysis):
+    """บันทึกผลวิเคราะห์ลง Cache แล้วตัดรายการเก่า (TTL + LRU)"""
+    init_analysis_cache()
+    now = time.time()
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR REPLACE INTO analysis_cache
+            (cache_key, provider, model_id, analysis, created_at, last_used, hit_count)
+            VALUES (?, ?, ?, ?, ?, ?, 0)
+        ''', (cache_key, provider, model_id, json.dumps(analysis, ensure_ascii=False), now, now))
+        conn.commit()
+    
+    _bump_cache_stat("writes")
+    evict_analysis_cache()
+
+def evict_analysis_cache(max_entries=None, ttl_days=None):
+    """ลบรายการที่หมดอายุ และรายการที่ใช้ล่าสุดนานที่สุดเมื่อเกินจำนวนสูงสุด"""
+    max_entries = ANALYSIS_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    ttl_days = ANALYSIS_CACHE_TTL_DAYS if ttl_days is None else ttl_days
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM analysis_cache WHERE created_at < ?', (time.time() - ttl_days * 86400,))
+        removed = c.rowcount
+        
+        c.execute('''
+            DELETE FROM analysis_cache WHERE cache_key IN (
+                SELECT cache_key FROM analysis_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (max_entries,))
+        removed += c.rowcount
+        conn.commit()
+    
+    if removed > 0:
+        _bump_cache_stat("evictions", removed)
+    return removed
+
+def clear_analysis_cache():
+    """ลบ Cache ผลวิเคราะห์ทั้งหมด"""
+    init_analysis_cache()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM analysis_cache')
+        conn.commit()
+
+def get_analysis_cache_stats():
+    """สถิติ Cache (hit/miss ของ process นี้ + จำนวนรายการใน DB)"""
+    init_analysis_cache()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM analysis_cache')
+        entries = c.fetchone()[0]
+    
+    with _cache_stats_lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["entries"] = entries
+    stats["hit_rate"] = round(stats["hits"] / lookups * 100, 1) if lookups else 0.0
+    return stats
+
+# =====================================================
+# EXTRACTION CACHE - Reuse Extracted Text/Questions for Identical Uploads
+# =====================================================
+
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_MB', '200')) * 1024 * 1024
+
+def init_extraction_cache():
+    """สร้างตาราง Cache การแกะไฟล์ (key = SHA-256 ของไฟล์ที่อัปโหลด)"""
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                file_hash TEXT PRIMARY KEY,
+                extractor_version INTEGER,
+                filename TEXT,
+                raw_text TEXT,
+                cleaned_text TEXT,
+                questions TEXT,       -- JSON list ของข้อสอบที่แยกแล้ว
+                size_bytes INTEGER,
+                created_at REAL,
+                last_used REAL,
+                hit_count INTEGER DEFAULT 0
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_extraction_cache_last_used ON extraction_cache (last_used)')
+        conn.commit()
+
+def get_cached_extraction(file_hash, extractor_version):
+    """ดึงผลการแกะไฟล์จาก Cache (None ถ้าไม่มีหรือแกะด้วยตัวแยกข้อรุ่นเก่า)"""
+    init_extraction_cache()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT raw_text, cleaned_text, questions FROM extraction_cache
+            WHERE file_hash = ? AND extractor_version = ?
+        ''', (file_hash, extractor_version))
+        row = c.fetchone()
+        if not row:
+            return None
+        
+        c.execute('UPDATE extraction_cache SET last_used = ?, hit_count = hit_count + 1 WHERE file_hash = ?', (time.time(), file_hash))
+        conn.commit()
+    return {"raw_text": row[0], "cleaned_text": row[1], "questions": json.loads(row[2])}
+
+def save_cached_extraction(file_hash, extractor_version, filename, raw_text, cleaned_text, questions):
+    """บันทึกผลการแกะไฟล์ลง Cache แล้วตัดรายการที่ใช้นานที่สุดเมื่อเกินขนาดรวม"""
+    init_extraction_cache()
+    questions_json = json.dumps(questions, ensure_ascii=False)
+    size = sum(len(part.encode('utf-8')) for part in (raw_text, cleaned_text, questions_json))
+    now = time.time()
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR REPLACE INTO extraction_cache
+            (file_hash, extractor_version, filename, raw_text, cleaned_text, questions, size_bytes, created_at, last_used, hit_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        ''', (file_hash, extractor_version, filename, raw_text, cleaned_text, questions_json, size, now, now))
+        conn.commit()
+    
+    evict_extraction_cache()
+
+def evict_extraction_cache(max_bytes=None):
+    """ลบรายการที่ใช้ล่าสุดนานที่สุดจนขนาดรวมไม่เกิน max_bytes (เก็บรายการล่าสุดไว้เสมอ)"""
+    max_bytes = EXTRACTION_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT file_hash, size_bytes FROM extraction_cache ORDER BY last_used DESC')
+        total, stale = 0, []
+        for i, (file_hash, size) in enumerate(c.fetchall()):
+            total += size or 0
+            if i > 0 and total > max_bytes:
+                stale.append((file_hash,))
+        if stale:
+            c.executemany('DELETE FROM extraction_cache WHERE file_hash = ?', stale)
+            conn.commit()
+    return len(stale)
+
+def clear_extraction_cache():
+    """ลบ Cache การแกะไฟล์ทั้งหมด"""
+    init_extraction_cache()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM extraction_cache')
+        conn.commit()
+
+# =====================================================
+# ANALYSIS JOBS - Background Jobs with Per-Question Tasks
+# =====================================================
+
+def init_job_tables():
+    """สร้างตารางงานวิเคราะห์เบื้องหลัง (1 job = 1 ไฟล์, 1 task = 1 ข้อ)"""
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        # WAL: ให้ UI อ่านสถานะได้ระหว่างที่ worker เขียนผล
+        c.execute('PRAGMA journal_mode=WAL')
+        
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT,
+                status TEXT,          -- queued / running / done / failed
+                settings TEXT,        -- JSON ของค่าที่ใช้วิเคราะห์ (provider, model, prompt, ภาษา)
+                total_questions INTEGER,
+                created_at TEXT,
+                updated_at TEXT,
+                error TEXT,
+                exam_id INTEGER,      -- id ในตาราง exams เมื่อบันทึกประวัติแล้ว
+                access_token TEXT     -- token ใน URL (?job=&key=) ที่ใช้กลับมาติดตาม job หลัง reload
+            )
+        ''')
+        # DB ที่สร้างก่อนมีคอลัมน์ access_token
+        columns = {row[1] for row in c.execute('PRAGMA table_info(analysis_jobs)')}
+        if 'access_token' not in columns:
+            c.execute('ALTER TABLE analysis_jobs ADD COLUMN access_token TEXT')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_tasks (
+                job_id INTEGER,
+                question_index INTEGER,
+                question_text TEXT,
+                status TEXT,          -- pending / running / done / error
+                result TEXT,
+                updated_at TEXT,
+                answer_key TEXT,      -- คำตอบจากส่วนเฉลยของไฟล์ (NULL ถ้าไม่มี)
+                PRIMARY KEY (job_id, question_index)
+            )
+        ''')
+        # DB ที่สร้างก่อนมีคอลัมน์ answer_key
+        columns = {row[1] for row in c.execute('PRAGMA table_info(analysis_tasks)')}
+        if 'answer_key' not in columns:
+            c.execute('ALTER TABLE analysis_tasks ADD COLUMN answer_key TEXT')
+        conn.commit()
+
+def create_job(filename, questions, settings, answer_keys=None):
+    """สร้าง job ใหม่พร้อม task รายข้อ คืน job_id (answer_keys: คำตอบจากส่วนเฉลยรายข้อ ถ้ามี)"""
+    init_job_tables()
+    now = datetime.now().isoformat()
+    
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            INSERT INTO analysis_jobs (filename, status, settings, total_questions, created_at, updated_at, access_token)
+            VALUES (?, 'queued', ?, ?, ?, ?, ?)
+        ''', (filename, json.dumps(settings, ensure_ascii=False), len(questions), now, now, secrets.token_urlsafe(16)))
+        job_id = c.lastrowid
+        
+        answer_keys = answer_keys or [None] * len(questions)
+        c.executemany('''
+            INSERT INTO analysis_tasks (job_id, question_index, question_text, status, updated_at, answer_key)
+            VALUES (?, ?, ?, 'pending', ?, ?)
+        ''', [(job_id, i, q, now, answer) for i, (q, answer) in enumerate(zip(questions, answer_keys))])
+        conn.commit()
+    return job_id
+
+def get_job(job_id):
+    """ดึงข้อมูล job (settings แปลงเป็น dict แล้ว)"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('SELECT * FROM analysis_jobs WHERE id = ?', (job_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job['settings'] = json.loads(job['settings'] or '{}')
+        return job
+
+def get_job_tasks(job_id):
+    """ดึง task ทั้งหมดของ job เรียงตามลำดับข้อ (result แปลงเป็น dict แล้ว)"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('SELECT * FROM analysis_tasks WHERE job_id = ? ORDER BY question_index', (job_id,))
+        tasks = []
+        for row in c.fetchall():
+            task = dict(row)
+            task['result'] = json.loads(task['result']) if task['result'] else None
+            tasks.append(task)
+        return tasks
+
+def get_job_access_token(job_id):
+    """token ของ job สำหรับใส่ใน URL (สร้างให้ job เก่าที่ยังไม่มี)"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT access_token FROM analysis_jobs WHERE id = ?', (job_id,))
+        row = c.fetchone()
+        if not row:
+            return None
+        if row[0]:
+            return row[0]
+        token = secrets.token_urlsafe(16)
+        c.execute('UPDATE analysis_jobs SET access_token = ? WHERE id = ?', (token, job_id))
+        conn.commit()
+        return token
+
+def verify_job_access(job_id, token):
+    """token จาก URL ตรงกับของ job หรือไม่ (กันการเปิดดู job ของคนอื่นด้วยการเดาเลข job)"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT access_token FROM analysis_jobs WHERE id = ?', (job_id,))
+        row = c.fetchone()
+    return bool(row and row[0] and token) and hmac.compare_digest(row[0], token)
+
+def update_job_status(job_id, status, error=None, exam_id=None):
+    """อัปเดตสถานะ job"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE analysis_jobs
+            SET status = ?, error = COALESCE(?, error), exam_id = COALESCE(?, exam_id), updated_at = ?
+            WHERE id = ?
+        ''', (status, error, exam_id, datetime.now().isoformat(), job_id))
+        conn.commit()
+
+def mark_tasks_running(job_id, question_indices):
+    """ทำเครื่องหมายว่า task กำลังประมวลผล"""
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        now = datetime.now().isoformat()
+        c.executemany('''
+            UPDATE analysis_tasks SET status = 'running', updated_at = ?
+            WHERE job_id = ? AND question_index = ?
+        ''', [(now, job_id, i) for i in question_indices])
+        conn.commit()
+
+def save_task_result(job_id, question_index, result, status='done'):
+    """บันทึกผลวิเคราะห์รายข้อทันทีที่เสร็จ (checkpoint)"""
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE analysis_tasks SET status = ?, result = ?, updated_at = ?
+            WHERE job_id = ? AND question_index = ?
+        ''', (status, json.dumps(result, ensure_ascii=False), datetime.now().isoformat(), job_id, question_index))
+        c.execute('UPDATE analysis_jobs SET updated_at = ? WHERE id = ?', (datetime.now().isoformat(), job_id))
+        conn.commit()
+
+def get_unfinished_jobs():
+    """job ที่ยังไม่เสร็จ (queued/running) เช่น ค้างจาก process ที่ crash ไป"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM analysis_jobs WHERE status IN ('queued', 'running') ORDER BY id")
+        return [row[0] for row in c.fetchall()]
+
+def reset_interrupted_tasks(job_id):
+    """คืน task ที่ค้างสถานะ running (process ตายกลางคัน) กลับเป็น pending"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('''
+            UPDATE analysis_tasks SET status = 'pending', updated_at = ?
+            WHERE job_id = ? AND status = 'running'
+        ''', (datetime.now().isoformat(), job_id))
+        conn.commit()
+        return c.rowcount
+
+def update_exam_result(exam_id, results, summary):
+    """เขียนทับผลวิเคราะห์ของชุดข้อสอบเดิม (ใช้หลัง resume ข้อที่ล้มเหลว)"""
+    init_db()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        good = sum(1 for r in results if r.get('is_good_question'))
+        c.execute('''
+            UPDATE exams SET timestamp = ?, total_questions = ?, good_questions = ?, summary = ?, raw_results = ?
+            WHERE id = ?
+        ''', (datetime.now().isoformat(), len(results), good, summary, json.dumps(results, ensure_ascii=False), exam_id))
+        conn.commit()
+        return c.rowcount > 0
+
+def get_job_task_counts(job_id):
+    """จำนวน task แยกตามสถานะ เช่น {'done': 56, 'error': 3, 'pending': 1}"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT status, COUNT(*) FROM analysis_tasks WHERE job_id = ? GROUP BY status', (job_id,))
+        return {row[0]: row[1] for row in c.fetchall()}
+
+def get_job_id_for_exam(exam_id):
+    """job ที่สร้างผลของชุดข้อสอบนี้ (None ถ้าเป็นประวัติเก่าที่ไม่มี task รายข้อ)"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute('SELECT id FROM analysis_jobs WHERE exam_id = ? ORDER BY id DESC LIMIT 1', (exam_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+
+def get_incomplete_jobs(limit=10):
+    """job ที่ยังไม่มีผลในประวัติ (ค้าง/ล้มเหลว) ล่าสุดก่อน"""
+    init_job_tables()
+    with sqlite3.connect(DB_Name) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, filename, status, total_questions, updated_at, error FROM analysis_jobs
+            WHERE status != 'done' ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+        return [dict(row) for row in c.fetchall()]
+
+def requeue_job_tasks(job_id, statuses=('pending', 'running', 'error')):
+    """ตั้ง task ที่ยังไม่เสร็จ/ล้มเหลวกลับเป็น pending แล้วคืนจำนวนที่ต้องทำใหม่"""
+    init_job_tables()
+    placeholders = ','.join('?' for _ in statuses)
+    with sqlite3.connect(DB_Name) as conn:
+        c = conn.cursor()
+        c.execute(f'''
+            UPDATE analysis_tasks SET status = 'pending', updated_at = ?
+            WHERE job_id = ? AND status IN ({placeholders})
+        ''', (datetime.now().isoformat(), job_id, *statuses))
+        conn.commit()
+        return c.rowcount
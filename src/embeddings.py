@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+
+import numpy as np
+
+from .tokenizer import get_tokenizer
+
+# --- Optional Imports ---
+try:
+    from sentence_transformers import SentenceTransformer
+    SENTENCE_TRANSFORMERS_AVAILABLE = True
+except ImportError:
+    SENTENCE_TRANSFORMERS_AVAILABLE = False
+
+# ตัวแปลงเป็นเวกเตอร์: "hashing" (ไม่ต้องโหลดโมเดล) หรือชื่อโมเดล sentence-transformers ที่มีในเครื่อง
+RAG_EMBEDDER = os.getenv('RAG_EMBEDDER', 'hashing').strip()
+HASHING_DIM = int(os.getenv('RAG_HASHING_DIM', '2048'))
+
+
+class HashingEmbedder:
+    """Hashing vectorizer: นับ token ลง bucket ด้วย crc32 (ค่าคงที่ข้าม process ต่างจาก hash())
+    แล้ว normalize เป็นเวกเตอร์หนึ่งหน่วย ทำให้ cosine = dot product"""
+
+    def __init__(self, dim=HASHING_DIM, tokenizer=None):
+        self.dim = dim
+        self.tokenizer, self._tokenize = get_tokenizer(tokenizer)
+        self.name = f"hashing-{dim}-{self.tokenizer}"
+        self._buckets = {}
+
+    def _bucket(self, token):
+        cached = self._buckets.get(token)
+        if cached is None:
+            h = zlib.crc32(token.encode('utf-8'))
+            # บิตบนสุดใช้เป็นเครื่องหมาย ลดการชนกันของ bucket แบบหักล้าง
+            cached = (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+            if len(self._buckets) < 500000:
+                self._buckets[token] = cached
+        return cached
+
+    def embed(self, texts):
+        """คืน float32 matrix (len(texts), dim) แบบต่อเนื่องในหน่วยความจำ"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in self._tokenize(text or ""):
+                col, sign = self._bucket(token)
+                matrix[row, col] += sign
+        # ถ่วงน้ำหนักแบบ sublinear tf แล้ว L2 normalize
+        np.copysign(np.log1p(np.abs(matrix)), matrix, out=matrix)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return np.ascontiguousarray(matrix)
+
+
+class SentenceTransformerEmbedder:
+    """โมเดล embedding ขนาดเล็กที่รันบน CPU (ต้องดาวน์โหลดโมเดลไว้ในเครื่องก่อน)"""
+
+    def __init__(self, model_name):
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.name = f"st-{model_name}"
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=64, normalize_embeddings=True, convert_to_numpy=True)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+
+_embedders = {}
+
+def get_embedder(name=None, tokenizer=None):
+    """ดึง embedder ตามชื่อ (ใช้ hashing ถ้าไม่มี sentence-transformers หรือโหลดโมเดลไม่ได้)"""
+    name = name or RAG_EMBEDDER
+    key = (name, tokenizer)
+    if key not in _embedders:
+        embedder = None
+        if name != "hashing":
+            if SENTENCE_TRANSFORMERS_AVAILABLE:
+                try:
+                    embedder = SentenceTransformerEmbedder(name)
+                except Exception as e:
+                    print(f"Embedding model '{name}' unavailable, using hashing vectorizer: {e}")
+            else:
+                print("sentence-transformers not installed, using hashing vectorizer")
+        _embedders[key] = embedder or HashingEmbedder(tokenizer=tokenizer)
+    return _embedders[key]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import math
+import time
+import uuid
+import json
+import random
+import hashlib
+import threading
+from collections import Counter
+
+# Provider จำลองในเครื่อง (ไม่ใช้เครือข่าย/API key) เปิดใน UI ด้วย FAKE_PROVIDER_ENABLED=1
+FAKE_PROVIDER = "🧪 Local Fake (ออฟไลน์)"
+FAKE_PROVIDER_ENABLED = os.getenv('FAKE_PROVIDER_ENABLED', '0').strip() in ('1', 'true', 'yes')
+
+# การกระจายของเวลาตอบ (วินาที): fixed:S | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA | exponential:MEAN
+FAKE_LATENCY = os.getenv('FAKE_LATENCY', 'lognormal:0.15:0.5')
+# สัดส่วนคำขอที่ตอบ 429 และที่ตอบ JSON เสีย (0-1)
+FAKE_RATE_LIMIT_RATE = float(os.getenv('FAKE_RATE_LIMIT_RATE', '0'))
+FAKE_MALFORMED_RATE = float(os.getenv('FAKE_MALFORMED_RATE', '0'))
+# Retry-After (วินาที) ที่แจ้งมากับ 429
+FAKE_RETRY_AFTER = float(os.getenv('FAKE_RETRY_AFTER', '1'))
+FAKE_SEED = int(os.getenv('FAKE_SEED', '0'))
+
+_BLOOM_LEVELS = ["Remember", "Understand", "Apply", "Analyze", "Evaluate", "Create"]
+_DIFFICULTIES = ["ง่าย", "ปานกลาง", "ยาก"]
+_OPTIONS = ["ก", "ข", "ค", "ง"]
+
+
+def parse_latency(spec):
+    """แปลง spec ของ FAKE_LATENCY เป็นฟังก์ชัน rng -> วินาที"""
+    kind, _, args = (spec or "fixed:0").partition(':')
+    values = [float(v) for v in args.split(':') if v]
+    kind = kind.strip().lower()
+    if kind == "fixed":
+        return lambda rng: values[0] if values else 0.0
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeRateLimitError(Exception):
+    """429 จำลอง (ข้อความมี retry in Ns แบบเดียวกับ Gemini ให้ parse_retry_after อ่านได้)"""
+
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"429 Too Many Requests (fake): retry in {retry_after:g}s")
+
+
+class FakeUsage:
+    """usage แบบเดียวกับ OpenAI/Groq (prompt_tokens = token ที่ถูกคิดเงินจริง ไม่รวมส่วนที่แคชไว้)"""
+
+    def __init__(self, prompt_tokens, completion_tokens, cached_tokens=0):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+
+
+class FakeResponse:
+    def __init__(self, text, usage):
+        self.text = text
+        self.usage = usage
+
+
+class FakeCachedContent:
+    """cached content ฝั่ง "server" ของ Provider จำลอง (แบบเดียวกับ caching.CachedContent ของ Gemini)"""
+
+    def __init__(self, model, system_instruction, ttl):
+        self.name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        self.model = model
+        self.system_instruction = system_instruction
+        self.expire_time = time.monotonic() + ttl
+
+
+class FakeLLMClient:
+    """client จำลองที่ตอบ JSON ผลวิเคราะห์ครบทุก key และนับว่าคำขอใช้ prefix ซ้ำหรือไม่
+
+    - ส่ง cached_content: นับเป็น cached_requests (system instruction ไม่ถูกคิด token)
+    - ส่ง system_instruction ตรง ๆ: นับ prefix_hits เมื่อ prefix เดียวกันเคยถูกส่งมาแล้ว
+
+    เวลาตอบ, 429 และ JSON เสีย สุ่มจาก seed + ข้อความ + ครั้งที่ส่งข้อความนั้น
+    ผลจึงเหมือนเดิมทุกรอบไม่ว่า thread จะส่งคำขอในลำดับใด
+    """
+
+    def __init__(self, latency=None, rate_limit_rate=None, malformed_rate=None, retry_after=None, seed=None):
+        self.latency = parse_latency(latency or FAKE_LATENCY)
+        self.rate_limit_rate = FAKE_RATE_LIMIT_RATE if rate_limit_rate is None else rate_limit_rate
+        self.malformed_rate = FAKE_MALFORMED_RATE if malformed_rate is None else malformed_rate
+        self.retry_after = FAKE_RETRY_AFTER if retry_after is None else retry_after
+        self.seed = FAKE_SEED if seed is None else seed
+        self._lock = threading.Lock()
+        self._cached_contents = {}
+        self._seen_prefixes = set()
+        self._attempts = Counter()
+        self.stats = {
+            "requests": 0, "cached_requests": 0, "prefix_hits": 0, "caches_created": 0,
+            "rate_limited": 0, "malformed": 0,
+        }
+
+    def create_cached_content(self, model, system_instruction, ttl):
+        cached = FakeCachedContent(model, system_instruction, ttl)
+        with self._lock:
+            self._cached_contents[cached.name] = cached
+            self.stats["caches_created"] += 1
+        return cached
+
+    def generate(self, model, user_message, system_instruction=None, cached_content=None):
+        """คืน FakeResponse ที่ผลลัพธ์ขึ้นกับข้อความคำถามเท่านั้น (ทำซ้ำได้)"""
+        digest = hashlib.sha256(user_message.encode('utf-8')).hexdigest()
+        cached_tokens = 0
+        with self._lock:
+            self.stats["requests"] += 1
+            self._attempts[digest] += 1
+            rng = random.Random(f"{self.seed}:{digest}:{self._attempts[digest]}")
+            if cached_content is not None:
+                stored = self._cached_contents.get(cached_content.name)
+                if stored is None or stored.expire_time < time.monotonic() or stored.model != model:
+                    raise RuntimeError(f"404 CachedContent not found: {cached_content.name}")
+                self.stats["cached_requests"] += 1
+                cached_tokens = len(stored.system_instruction) // 2
+            elif system_instruction:
+                prefix = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+                if prefix in self._seen_prefixes:
+                    self.stats["prefix_hits"] += 1
+                    cached_tokens = len(system_instruction) // 2
+                self._seen_prefixes.add(prefix)
+
+        time.sleep(max(0.0, self.latency(rng)))
+        if rng.random() < self.rate_limit_rate:
+            with self._lock:
+                self.stats["rate_limited"] += 1
+            raise FakeRateLimitError(self.retry_after)
+
+        text = json.dumps(fake_analysis(user_message), ensure_ascii=False)
+        if rng.random() < self.malformed_rate:
+            with self._lock:
+                self.stats["malformed"] += 1
+            # ตัด JSON กลางคัน เหมือนคำตอบที่ถูกตัดด้วย max_tokens
+            text = text[:rng.randint(1, len(text) - 2)]
+        prompt_tokens = (len(system_instruction or "") + len(user_message)) // 2
+        return FakeResponse(text, FakeUsage(prompt_tokens, len(text) // 2, cached_tokens))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+def fake_analysis(user_message):
+    """ผลวิเคราะห์ที่ตรง schema โดยเลือกค่าจาก hash ของข้อความ"""
+    digest = hashlib.sha256(user_message.encode('utf-8')).digest()
+    return {
+        "bloom_level": _BLOOM_LEVELS[digest[0] % len(_BLOOM_LEVELS)],
+        "reasoning": "ผลวิเคราะห์จาก Provider จำลอง",
+        "difficulty": _DIFFICULTIES[digest[1] % len(_DIFFICULTIES)],
+        "curriculum_standard": "-",
+        "correct_option": _OPTIONS[digest[2] % len(_OPTIONS)],
+        "correct_option_analysis": "-",
+        "distractor_analysis": "-",
+        "why_good_distractor": "-",
+        "is_good_question": bool(digest[3] % 2),
+        "improvement_suggestion": "-",
+    }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_fake_client():
+    """client จำลองตัวเดียวทั้ง process (แบบเดียวกับ providers.get_groq_client)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FakeLLMClient()
+        return _client
+
+def configure_fake_client(**options):
+    """แทนที่ client จำลองด้วยค่าที่กำหนดเอง (latency, rate_limit_rate, malformed_rate, retry_after, seed)"""
+    global _client
+    with _client_lock:
+        _client = FakeLLMClient(**options)
+        return _client
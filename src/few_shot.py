@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import math
+from collections import Counter
+
+from .tokenizer import ngram_tokenize
+
+# จำนวนตัวอย่าง (few-shot) ที่แนบต่อคำขอ (0 = ปิด)
+FEW_SHOT_COUNT = max(0, min(3, int(os.getenv('FEW_SHOT_COUNT', '2'))))
+# ความคล้ายขั้นต่ำ (cosine) ของตัวอย่างลำดับที่ 2 เป็นต้นไป
+FEW_SHOT_MIN_SIMILARITY = 0.05
+
+_EXAMPLE_JSON = re.compile(r'\{\{(.*?)\}\}', re.DOTALL)
+_STRAND = re.compile(r'ท\s*([1-5])\.(\d)')
+_FIELD = re.compile(r'"(\w+)"\s*:\s*"([^"]*)"')
+
+
+class FewShotExample:
+    """ตัวอย่างการวิเคราะห์หนึ่งชุดจาก Prompt.txt (เกณฑ์ของระดับ + JSON คำตอบ)"""
+
+    def __init__(self, criteria, answer, fields):
+        self.criteria = criteria
+        self.answer = answer
+        self.bloom_level = fields.get("bloom_level", "")
+        self.difficulty = fields.get("difficulty", "")
+        match = _STRAND.search(fields.get("curriculum_standard", "") or criteria)
+        self.strand = f"ท {match.group(1)}.{match.group(2)}" if match else None
+        self.search_text = " ".join([criteria, fields.get("question_text", ""), fields.get("reasoning", ""), fields.get("correct_option_analysis", "")])
+        self.vector = None
+
+    def format(self):
+        header = f"{self.strand or ''} · {self.bloom_level} · {self.difficulty}".strip(" ·")
+        text = f"[{header}]\n"
+        if self.criteria:
+            text += self.criteria + "\n"
+        return text + self.answer
+
+
+def _parse_fields(body):
+    try:
+        data = json.loads("{" + body + "}")
+        return {k: str(v) for k, v in data.items()}
+    except ValueError:
+        # JSON ในไฟล์บางชุดไม่สมบูรณ์ อ่านเฉพาะ field ที่เป็นข้อความ
+        return dict(_FIELD.findall(body))
+
+def _criteria_before(text):
+    """หัวข้อระดับ Bloom และเกณฑ์ (บรรทัด *) ที่อยู่ก่อน JSON ของตัวอย่าง"""
+    lines = []
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("**") and re.match(r'\*\*\d\.\d\.\d', line):
+            lines = [line.strip("*").strip()]
+        elif line.startswith("*") and lines:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+class FewShotIndex:
+    """ดัชนีตัวอย่างแยกตามสาระ (ท 1.1 … ท 5.1) และระดับ Bloom พร้อมเวกเตอร์ TF-IDF สำหรับหาตัวอย่างที่ใกล้เคียง"""
+
+    def __init__(self, examples):
+        self.examples = examples
+        self.by_strand = {}
+        self.by_bloom = {}
+        for i, example in enumerate(examples):
+            self.by_strand.setdefault(example.strand, []).append(i)
+            self.by_bloom.setdefault(example.bloom_level, []).append(i)
+
+        docs = [Counter(ngram_tokenize(example.search_text)) for example in examples]
+        df = Counter(term for doc in docs for term in doc)
+        n = len(docs)
+        self.idf = {term: math.log(1 + n / count) for term, count in df.items()}
+        for example, doc in zip(examples, docs):
+            example.vector = self._weigh(doc)
+        # ตัวอย่างที่ยาวที่สุด FEW_SHOT_COUNT ชุด (ใช้จองงบ token ของ prompt)
+        self.reserve_text = "\n\n".join(sorted((e.format() for e in examples), key=len, reverse=True)[:FEW_SHOT_COUNT])
+
+    def _weigh(self, counts):
+        vector = {term: (1 + math.log(tf)) * self.idf.get(term, 0.0) for term, tf in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        return {term: v / norm for term, v in vector.items() if v}
+
+    def select(self, question_text, k=None, strand=None, bloom_level=None):
+        """ตัวอย่างที่คล้ายคำถามที่สุด k ชุด (จำกัดเฉพาะสาระ/ระดับ Bloom ที่ระบุถ้ามีตัวอย่าง)"""
+        k = FEW_SHOT_COUNT if k is None else k
+        if k <= 0 or not self.examples or not question_text:
+            return []
+        candidates = range(len(self.examples))
+        if strand in self.by_strand:
+            candidates = self.by_strand[strand]
+        if bloom_level in self.by_bloom:
+            same_level = set(self.by_bloom[bloom_level])
+            narrowed = [i for i in candidates if i in same_level]
+            candidates = narrowed or candidates
+
+        query = self._weigh(Counter(ngram_tokenize(question_text)))
+        scored = sorted(
+            ((sum(w * self.examples[i].vector.get(term, 0.0) for term, w in query.items()), i) for i in candidates),
+            reverse=True
+        )
+        picked = []
+        for score, i in scored:
+            if picked and score < FEW_SHOT_MIN_SIMILARITY:
+                break
+            picked.append(self.examples[i])
+            if len(picked) >= k:
+                break
+        return picked
+
+
+def parse_few_shot_examples(template):
+    """แยกตัวอย่างแต่ละชุดจาก FEW_SHOT_PROMPT_TEMPLATE (JSON ในไฟล์ใช้ {{ }} แทนปีกกา)"""
+    examples = []
+    cursor = 0
+    for match in _EXAMPLE_JSON.finditer(template or ""):
+        body = match.group(1)
+        fields = _parse_fields(body)
+        if fields.get("bloom_level"):
+            criteria = _criteria_before(template[cursor:match.start()])
+            examples.append(FewShotExample(criteria, "{" + body.rstrip() + "\n}", fields))
+        cursor = match.end()
+    return examples
+
+def build_few_shot_index(template):
+    return FewShotIndex(parse_few_shot_examples(template))
+
+def detect_strand(text):
+    """สาระ (เช่น 'ท 4.1') ที่พบครั้งแรกในข้อความ เช่น จากข้อความอ้างอิงหลักสูตร"""
+    match = _STRAND.search(text or "")
+    return f"ท {match.group(1)}.{match.group(2)}" if match else None
+
+def format_few_shot(examples, language='th'):
+    """ข้อความตัวอย่างสำหรับใส่ใน Prompt"""
+    if not examples:
+        return ""
+    title = "Similar analysis examples:" if language == 'en' else "ตัวอย่างการวิเคราะห์ที่ใกล้เคียง:"
+    return title + "\n\n" + "\n\n".join(example.format() for example in examples)
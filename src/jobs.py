@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .analysis import analyze_questions_parallel, AI_PROVIDERS, get_provider_concurrency
+from .routing import configure_hedge_pool
+from .utils import create_error_response, create_pending_response, is_error_response, apply_answer_key
+from .database import (
+    create_job, get_job, get_job_tasks, update_job_status, mark_tasks_running,
+    save_task_result, get_unfinished_jobs, reset_interrupted_tasks, save_exam_result,
+    update_exam_result, requeue_job_tasks
+)
+
+# จำนวน job (ไฟล์) ที่ประมวลผลพร้อมกันต่อ process (แต่ละ job ยังกระจายข้อสอบเป็น thread pool ของตัวเอง)
+JOB_WORKERS = int(os.getenv('ANALYSIS_JOB_WORKERS', '2'))
+
+# Worker pool ระดับ process: ทำงานต่อแม้ browser ปิดหรือ websocket หลุด
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="analysis-job")
+# Hedge pool รับคำขอหลัก + hedge ของทุก job พร้อมกัน: ขนาด = job × concurrency รวมของทุก Provider
+configure_hedge_pool(JOB_WORKERS * sum(get_provider_concurrency(name) for name in AI_PROVIDERS))
+_active_jobs = set()
+_lock = threading.Lock()
+_resumed = False
+
+def submit_analysis_job(filename, questions, settings, answer_keys=None):
+    """สร้าง job ใน DB แล้วส่งเข้าคิว worker คืน job_id
+
+    answer_keys: คำตอบจากส่วนเฉลยรายข้อ ใช้ตรวจ correct_option ของแต่ละข้อเมื่อวิเคราะห์เสร็จ
+    """
+    job_id = create_job(filename, questions, settings, answer_keys)
+    _schedule(job_id)
+    return job_id
+
+def _schedule(job_id):
+    with _lock:
+        if job_id in _active_jobs:
+            return
+        _active_jobs.add(job_id)
+    _executor.submit(_run_job, job_id)
+
+def _run_job(job_id):
+    """ประมวลผล task ที่ยังไม่เสร็จของ job (บันทึกผลรายข้อลง DB ทันทีที่เสร็จ)"""
+    try:
+        job = get_job(job_id)
+        if not job:
+            return
+        update_job_status(job_id, 'running')
+
+        tasks = [task for task in get_job_tasks(job_id) if task['status'] in ('pending', 'running')]
+        if tasks:
+            indices = [task['question_index'] for task in tasks]
+            mark_tasks_running(job_id, indices)
+
+            def on_result(pos, analysis, completed, total):
+                status = 'error' if is_error_response(analysis) else 'done'
+                analysis = apply_answer_key(analysis, tasks[pos].get('answer_key'))
+                save_task_result(job_id, indices[pos], analysis, status)
+
+            analyze_questions_parallel(
+                [task['question_text'] for task in tasks],
+                job['settings'],
+                on_result=on_result,
+                question_numbers=[i + 1 for i in indices]
+            )
+
+        _finish_job(job)
+    except Exception as e:
+        print(f"Analysis job {job_id} failed: {e}")
+        update_job_status(job_id, 'failed', error=str(e))
+    finally:
+        with _lock:
+            _active_jobs.discard(job_id)
+
+def _finish_job(job):
+    """รวมผลทุกข้อตามลำดับ บันทึกลงประวัติ (exams) แล้วปิด job"""
+    tasks = get_job_tasks(job['id'])
+    results = [task['result'] or create_error_response("Analysis returned None") for task in tasks]
+    summary_text = f"Analyzed {len(results)} questions using {job['settings'].get('provider', '')}"
+    if job.get('exam_id') and update_exam_result(job['exam_id'], results, summary_text):
+        exam_id = job['exam_id']
+    else:
+        exam_id = save_exam_result(job['filename'], results, summary_text)
+    update_job_status(job['id'], 'done', exam_id=exam_id)
+
+def resume_job(job_id):
+    """วิเคราะห์ซ้ำเฉพาะข้อที่ยังไม่เสร็จหรือล้มเหลว (ข้อที่สำเร็จแล้วใช้ผลเดิม) คืนจำนวนข้อที่ต้องทำ
+
+    แม้ไม่เหลือข้อให้ทำ (เช่น job ล้มเหลวตอนบันทึกประวัติ) ก็ยังส่งเข้าคิวเพื่อให้ _finish_job ปิด job ได้
+    """
+    if is_job_active(job_id):
+        return 0
+    remaining = requeue_job_tasks(job_id)
+    update_job_status(job_id, 'queued')
+    _schedule(job_id)
+    return remaining
+
+def get_job_progress(job_id):
+    """สถานะ job สำหรับ UI: status, completed/total และผลลัพธ์ (ข้อที่ยังไม่เสร็จเป็น placeholder)"""
+    job = get_job(job_id)
+    if not job:
+        return None
+    tasks = get_job_tasks(job_id)
+    finished = [task for task in tasks if task['status'] in ('done', 'error')]
+    return {
+        "id": job_id,
+        "filename": job['filename'],
+        "status": job['status'],
+        "error": job['error'],
+        "total": len(tasks),
+        "completed": len(finished),
+        "errors": sum(1 for task in tasks if task['status'] == 'error'),
+        "questions": [task['question_text'] for task in tasks],
+        "results": [task['result'] if task in finished and task['result'] else create_pending_response() for task in tasks],
+        "is_active": is_job_active(job_id),
+    }
+
+def is_job_active(job_id):
+    """job นี้กำลังอยู่ในคิว/ประมวลผลใน process นี้หรือไม่"""
+    with _lock:
+        return job_id in _active_jobs
+
+def resume_unfinished_jobs():
+    """เรียกครั้งเดียวต่อ process: ทำ job ที่ค้างจาก process ก่อน (crash/restart) ต่อจากข้อล่าสุดที่เสร็จ"""
+    global _resumed
+    with _lock:
+        if _resumed:
+            return []
+        _resumed = True
+
+    resumed = []
+    for job_id in get_unfinished_jobs():
+        reset_interrupted_tasks(job_id)
+        _schedule(job_id)
+        resumed.append(job_id)
+    return resumed
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from collections import deque
+
+# จำนวนตัวอักษรต่อ token โดยประมาณของแต่ละตระกูล tokenizer (ascii, ไทย/อื่น ๆ)
+# Gemini (SentencePiece) ตัดภาษาไทยได้ยาวกว่า tokenizer ของ Llama/Mistral/Gemma ที่ผ่าน Groq/OpenRouter
+CHARS_PER_TOKEN = {
+    "Gemini (Google)": (4.0, 2.5),
+    "Groq (ฟรี+เร็วมาก)": (4.0, 1.2),
+    "OpenRouter (หลายโมเดลฟรี)": (4.0, 1.2),
+}
+DEFAULT_CHARS_PER_TOKEN = (4.0, 1.5)
+
+# Context window (input + output) ของแต่ละ model id
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-2.0-flash": 1048576,
+    "gemini-1.5-flash-latest": 1048576,
+    "gemini-1.5-pro-latest": 2097152,
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-8b-instant": 131072,
+    "mixtral-8x7b-32768": 32768,
+    "meta-llama/llama-3.2-3b-instruct:free": 8192,
+    "mistralai/mistral-7b-instruct:free": 32768,
+    "google/gemma-2-9b-it:free": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# เผื่อความคลาดเคลื่อนของการประมาณ token
+CONTEXT_SAFETY_MARGIN = 0.9
+
+# token สูงสุดของข้อความอ้างอิงหลักสูตรต่อข้อ (แม้ context window จะใหญ่)
+RAG_MAX_CONTEXT_TOKENS = int(os.getenv('RAG_MAX_CONTEXT_TOKENS', '800'))
+# section ที่ถูกตัดต้องเหลืออย่างน้อยกี่ token จึงจะใส่ (สั้นกว่านี้ไม่มีประโยชน์)
+MIN_SECTION_TOKENS = 40
+
+def estimate_prompt_tokens(provider, *texts):
+    """ประมาณจำนวน token ตาม tokenizer ของ Provider"""
+    ascii_ratio, other_ratio = CHARS_PER_TOKEN.get(provider, DEFAULT_CHARS_PER_TOKEN)
+    total = 0.0
+    for text in texts:
+        if not text:
+            continue
+        ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+        total += ascii_chars / ascii_ratio + (len(text) - ascii_chars) / other_ratio
+    return int(total) + 1
+
+def get_input_token_budget(model_id, max_output_tokens, cap=0):
+    """งบ token ฝั่ง input ต่อคำขอ = context window - output ที่จองไว้ (และไม่เกิน cap ถ้ากำหนด)"""
+    window = MODEL_CONTEXT_WINDOWS.get(model_id, DEFAULT_CONTEXT_WINDOW)
+    budget = int(window * CONTEXT_SAFETY_MARGIN) - max_output_tokens
+    if cap > 0:
+        budget = min(budget, cap)
+    return max(0, budget)
+
+def _truncate_to_tokens(provider, text, max_tokens):
+    """ตัดข้อความให้เหลือไม่เกิน max_tokens (ตัดที่ขึ้นบรรทัดใหม่ถ้าทำได้)"""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_prompt_tokens(provider, text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text[:lo]
+    newline = cut.rfind('\n')
+    if newline > len(cut) // 2:
+        cut = cut[:newline]
+    return cut.rstrip() + " …"
+
+def fit_sections(provider, sections, max_tokens):
+    """เลือก section ตามลำดับความเกี่ยวข้องให้พอดีงบ token (section สุดท้ายอาจถูกตัดท้าย)"""
+    if sections is None:
+        return None
+    fitted = []
+    remaining = max_tokens
+    for section in sections:
+        cost = estimate_prompt_tokens(provider, section) + 2
+        if cost <= remaining:
+            fitted.append(section)
+            remaining -= cost
+            continue
+        if remaining >= MIN_SECTION_TOKENS:
+            fitted.append(_truncate_to_tokens(provider, section, remaining - 2))
+        break
+    return fitted
+
+
+# --- รายงานจำนวน token ฝั่ง input ต่อคำขอ ---
+_lock = threading.Lock()
+_recent = deque(maxlen=200)
+_totals = {}
+
+def record_prompt_tokens(provider, model_id, estimated, actual=None):
+    """บันทึกจำนวน token ของ prompt หนึ่งคำขอ (actual จาก usage ของ response ถ้ามี)"""
+    with _lock:
+        _recent.append({"provider": provider, "model": model_id, "estimated": estimated, "actual": actual})
+        stats = _totals.setdefault((provider, model_id), {"requests": 0, "estimated": 0, "actual": 0, "actual_requests": 0})
+        stats["requests"] += 1
+        stats["estimated"] += estimated
+        if actual:
+            stats["actual"] += actual
+            stats["actual_requests"] += 1
+
+def get_prompt_token_stats():
+    """สรุป input token ต่อ Provider/Model: จำนวนคำขอ, ค่าเฉลี่ยที่ประมาณ/ที่ใช้จริง และคำขอล่าสุด"""
+    with _lock:
+        summary = []
+        for (provider, model_id), stats in _totals.items():
+            summary.append({
+                "provider": provider,
+                "model": model_id,
+                "requests": stats["requests"],
+                "avg_estimated": round(stats["estimated"] / stats["requests"]),
+                "avg_actual": round(stats["actual"] / stats["actual_requests"]) if stats["actual_requests"] else None,
+            })
+        return {"summary": summary, "recent": list(_recent)}
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+import google.generativeai as genai
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# จำนวน GenerativeModel ที่เก็บไว้สูงสุด (แยกตาม model id + system instruction)
+MAX_GEMINI_MODELS = 32
+
+# Registry ระดับ process: client หนึ่งตัวต่อ provider + key ใช้ connection pool ร่วมกันทุก session
+_lock = threading.Lock()
+_clients = {}
+_gemini_models = OrderedDict()
+_gemini_configured_key = None
+
+def _ensure_gemini_configured(api_key):
+    """เรียก genai.configure เฉพาะครั้งแรก/เมื่อ key เปลี่ยน (configure ใหม่ = สร้าง gRPC channel ใหม่)"""
+    global _gemini_configured_key
+    if _gemini_configured_key != api_key:
+        genai.configure(api_key=api_key)
+        _gemini_configured_key = api_key
+        _gemini_models.clear()
+
+def get_gemini_model(api_key, model_id, system_instruction=None):
+    """ดึง GenerativeModel ที่สร้างไว้แล้วสำหรับ model id + system instruction นี้"""
+    instruction_hash = hashlib.sha256((system_instruction or "").encode('utf-8')).hexdigest()
+    key = (model_id, instruction_hash)
+    with _lock:
+        _ensure_gemini_configured(api_key)
+        model = _gemini_models.get(key)
+        if model is None:
+            if system_instruction:
+                model = genai.GenerativeModel(model_id, system_instruction=system_instruction)
+            else:
+                model = genai.GenerativeModel(model_id)
+            _gemini_models[key] = model
+            while len(_gemini_models) > MAX_GEMINI_MODELS:
+                _gemini_models.popitem(last=False)
+        else:
+            _gemini_models.move_to_end(key)
+        return model
+
+def create_gemini_cached_model(api_key, model_id, system_instruction, ttl):
+    """สร้าง cached content ของ system instruction ฝั่ง server แล้วคืน GenerativeModel ที่อ้างถึงมัน
+    (raise ถ้าโมเดลไม่รองรับหรือ instruction สั้นกว่าขั้นต่ำ)"""
+    from google.generativeai import caching
+    with _lock:
+        _ensure_gemini_configured(api_key)
+    cached = caching.CachedContent.create(
+        model=f"models/{model_id}",
+        system_instruction=system_instruction,
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return genai.GenerativeModel.from_cached_content(cached_content=cached)
+
+def get_groq_client(api_key):
+    """Groq client ตัวเดียวต่อ key (thread-safe, ใช้ HTTP keep-alive ร่วมกัน)"""
+    key = ("groq", api_key)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from groq import Groq
+            client = Groq(api_key=api_key)
+            _clients[key] = client
+        return client
+
+def get_openrouter_client(api_key):
+    """OpenAI-compatible client ของ OpenRouter ตัวเดียวต่อ key"""
+    key = ("openrouter", api_key)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            import openai
+            client = openai.OpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key)
+            _clients[key] = client
+        return client
+
+def reset_clients():
+    """ปิดและล้าง client ทั้งหมด (เช่น หลังเปลี่ยน API key)"""
+    global _gemini_configured_key
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception:
+                pass
+        _clients.clear()
+        _gemini_models.clear()
+        _gemini_configured_key = None
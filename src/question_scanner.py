@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import re
+from bisect import bisect_left
+
+# เลขไทย -> เลขอารบิก (str.replace เฉพาะเลขที่พบ เร็วกว่า str.translate มากกับข้อความภาษาไทย
+# เพราะ translate ต้อง lookup ทีละตัวอักษรเมื่อข้อความไม่ใช่ ASCII)
+_THAI_DIGITS = [(chr(0x0E50 + i), str(i)) for i in range(10)]
+
+_MULTI_SPACE = re.compile(r' {2,}')
+# ตัวเลือก/เลขข้อให้ติดกับจุด (ก . -> ก., 1 . -> 1.) จับเฉพาะที่มีช่องว่างคั่นจริง
+_MARK_DOT = re.compile(r'(?<=[ก-งA-D\d])\s+\.')
+# ขึ้นบรรทัดใหม่ก่อนเลขข้อที่อยู่กลางบรรทัด ("text. 2. text" -> "text.\n2. text")
+_QUESTION_BREAK = re.compile(r'\s+(\(?\d+[\.\)])\s')
+_BLANK_LINES = re.compile(r'\n{2,}')
+
+# จับเลขข้อต้นบรรทัด: 1. / 1) / ข้อ 1. / ข้อที่ 1.
+# แยก pattern ต้นข้อความออกจากกลางข้อความ ทำให้ regex ค้นจาก \n ได้เร็วแทนการลอง ^ ทุกตำแหน่ง
+QUESTION_START = re.compile(r'\n\s*(?:ข้อ(?:ที่)?\s*)?\d+[\.\)]')
+_QUESTION_AT_TOP = re.compile(r'\s*(?:ข้อ(?:ที่)?\s*)?\d+[\.\)]')
+# เส้นคั่นส่วนเฉลยท้ายไฟล์ (ไม่นำมาแยกเป็นข้อสอบ)
+ANSWER_KEY_PATTERN = r"={10,}\s*เฉลย\s*={10,}"
+ANSWER_KEY = re.compile(ANSWER_KEY_PATTERN, re.DOTALL | re.IGNORECASE)
+
+_OPTION_MARK = re.compile(r'[ก-งA-D]\.')
+_OPTION_BREAK = re.compile(r'\s+(?=[ก-งA-D]\.)')
+
+# ส่วนประกอบของข้อที่แยกแล้ว: เลขข้อหัวข้อ และตัวเลือกต้นบรรทัด (format_question จัดให้ขึ้นบรรทัดใหม่แล้ว)
+_QUESTION_NUMBER = re.compile(r'(?:ข้อ(?:ที่)?\s*)?\(?(\d+)[\.\)]\s*')
+_OPTION_LINE = re.compile(r'([ก-งA-D])\.\s*')
+# รายการในส่วนเฉลย: "1. ก", "1) ข", "ข้อ 3 = ค", "4.(ง)", "5 - A" (ตัวเลือกต้องไม่ใช่ต้นคำ เช่น "ข้อ")
+_ANSWER_ENTRY = re.compile(r'(?:ข้อ(?:ที่)?\s*)?(\d+)\s*[\.\)]?\s*[:=\-]?\s*\(?([ก-งA-Da-d])(?![ก-๙A-Za-z])')
+
+
+def normalize_thai_digits(text):
+    """แปลงเลขไทย (๐-๙) เป็นเลขอารบิก (ใช้ทั้งตอนแกะข้อสอบและใน tokenizer ของ RAG)"""
+    if not text:
+        return ""
+    for thai, arabic in _THAI_DIGITS:
+        if thai in text:
+            text = text.replace(thai, arabic)
+    return text
+
+
+def normalize_exam_text(text):
+    """ทำความสะอาดข้อความข้อสอบด้วย pattern ที่ compile ไว้แล้ว (แทนที่เฉพาะตัวอักษรที่พบจริง)"""
+    if not text:
+        return ""
+    text = normalize_thai_digits(text)
+    if '\t' in text:
+        text = text.replace('\t', ' ')
+    text = _MULTI_SPACE.sub(' ', text)
+    if '\r' in text:
+        text = text.replace('\r', '')
+    text = _MARK_DOT.sub('.', text)
+    text = _QUESTION_BREAK.sub(r'\n\1 ', text)
+    text = _BLANK_LINES.sub('\n', text)
+    return '\n'.join([line.strip() for line in text.split('\n')])
+
+def find_question_starts(buffer):
+    """ตำแหน่งเริ่มของเลขข้อทุกข้อใน buffer"""
+    top = _QUESTION_AT_TOP.match(buffer)
+    starts = [0] if top else []
+    starts.extend(m.start() for m in QUESTION_START.finditer(buffer, top.end() if top else 0))
+    return starts
+
+def scan_question_spans(buffer):
+    """ช่วง (start, end) ของแต่ละข้อใน buffer ที่ normalize แล้ว (ตัดช่องว่างหัวท้าย ไม่คัดลอกข้อความ)
+
+    ข้อความก่อนเลขข้อแรก (คำชี้แจง) ไม่ถูกนับเป็นข้อ
+    """
+    starts = find_question_starts(buffer)
+    return [trim_span(buffer, start, end) for start, end in zip(starts, starts[1:] + [len(buffer)])]
+
+def trim_span(buffer, start, end):
+    """เลื่อน start/end ให้ไม่รวมช่องว่างหัวท้าย"""
+    while start < end and buffer[start].isspace():
+        start += 1
+    while end > start and buffer[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def format_question(buffer, start=0, end=None):
+    """ข้อความข้อสอบของช่วง start..end โดยจัดตัวเลือกให้ขึ้นบรรทัดใหม่ (None = สั้นเกินไป/ไม่ใช่ข้อสอบ)"""
+    end = len(buffer) if end is None else end
+    if start == 0 and end == len(buffer):
+        # ช่วงที่ไม่ได้มาจาก scan_question_spans อาจยังมีช่องว่างหัวท้าย
+        buffer = buffer.strip()
+        end = len(buffer)
+    if end - start < 5:
+        return None
+    first = _OPTION_MARK.search(buffer, start, end)
+    if first and _OPTION_MARK.search(buffer, first.end(), end):
+        return _OPTION_BREAK.sub('\n', buffer[start:end])
+    return buffer[start:end] if end - start > 10 else None
+
+class Question:
+    """ข้อสอบที่แยกแล้ว 1 ข้อ (ใช้ __slots__ เพราะไฟล์ใหญ่มีได้หลายพันข้อ)
+
+    number: เลขข้อตามไฟล์ (None ถ้าไม่มี), stem: โจทย์, options: {"ก": "...", ...}
+    text: ข้อความเต็มที่จัดรูปแล้ว (ส่งให้ AI/บันทึกลง DB), page: หน้าที่ข้อเริ่ม (PDF, เริ่มที่ 1)
+    start/end: ตำแหน่งในข้อความที่ normalize แล้ว, answer: ตัวเลือกจากส่วนเฉลย (None ถ้าไม่มี)
+    """
+
+    __slots__ = ("number", "stem", "options", "text", "page", "start", "end", "answer")
+
+    def __init__(self, number, stem, options, text, page=None, start=None, end=None, answer=None):
+        self.number = number
+        self.stem = stem
+        self.options = options
+        self.text = text
+        self.page = page
+        self.start = start
+        self.end = end
+        self.answer = answer
+
+    def __repr__(self):
+        return f"Question(number={self.number!r}, options={len(self.options)}, page={self.page!r}, answer={self.answer!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Question) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+def parse_question(text, page=None, start=None, end=None):
+    """แยกเลขข้อ โจทย์ และตัวเลือกจากข้อความที่ format_question จัดรูปแล้ว"""
+    match = _QUESTION_NUMBER.match(text)
+    number = int(match.group(1)) if match else None
+    body = text[match.end():] if match else text
+    stem_lines, options, current = [], {}, None
+    for line in body.split('\n'):
+        option = _OPTION_LINE.match(line)
+        if option and option.group(1) not in options:
+            current = option.group(1)
+            options[current] = line[option.end():]
+        elif current:
+            options[current] += '\n' + line
+        else:
+            stem_lines.append(line)
+    if len(options) < 2:
+        # ตัวเลือกเดียวมักเป็นส่วนหนึ่งของโจทย์ (เช่น "ก. ในโจทย์") ไม่ใช่ชุดตัวเลือก
+        stem_lines, options = body.split('\n'), {}
+    return Question(number, '\n'.join(stem_lines).strip(), options, text, page, start, end)
+
+def parse_answer_key(text):
+    """อ่านส่วนเฉลยเป็น {เลขข้อ: ตัวเลือก} (รายการแรกของแต่ละข้อเป็นคำตอบ)"""
+    answers = {}
+    for match in _ANSWER_ENTRY.finditer(normalize_exam_text(text)):
+        answers.setdefault(int(match.group(1)), match.group(2).upper())
+    return answers
+
+_OPTION_ORDER = {**{letter: i for i, letter in enumerate("กขคง")}, **{letter: i for i, letter in enumerate("ABCD")}}
+_OPTION_VALUE = re.compile(r'(?<![ก-๙A-Za-z])([ก-งA-Da-d])(?![ก-๙A-Za-z])')
+
+def option_index(value):
+    """ลำดับตัวเลือก (0-3) จากค่าเช่น "ค", "ค. 15 บาท", "ตัวเลือก ข", "B" (ก-ง เทียบเท่า A-D) None ถ้าอ่านไม่ได้"""
+    for match in _OPTION_VALUE.finditer(str(value or "")):
+        index = _OPTION_ORDER.get(match.group(1).upper())
+        if index is not None:
+            return index
+    return None
+
+def attach_answers(questions, answer_key):
+    """ใส่คำตอบจากส่วนเฉลยให้แต่ละข้อตามเลขข้อ คืนจำนวนข้อที่มีเฉลย"""
+    attached = 0
+    for question in questions:
+        question.answer = answer_key.get(question.number)
+        attached += question.answer is not None
+    return attached
+
+def scan_questions(raw_text):
+    """แยกข้อสอบเป็น Question พร้อมตำแหน่งในข้อความ และคำตอบจากส่วนเฉลย (ถ้ามี)"""
+    parts = ANSWER_KEY.split(raw_text, 1)
+    buffer = normalize_exam_text(parts[0])
+    questions = []
+    for start, end in scan_question_spans(buffer):
+        text = format_question(buffer, start, end)
+        if text:
+            questions.append(parse_question(text, start=start, end=end))
+    if len(parts) > 1:
+        attach_answers(questions, parse_answer_key(parts[1]))
+    return questions
+
+def split_into_chunks(text, max_chars, overlap=0):
+    """แบ่งข้อความยาวเป็นช่วงละไม่เกิน max_chars ตัวอักษร
+
+    ตัดที่ต้นข้อถ้ามี (รองลงมาคือต้นบรรทัด) และให้ช่วงถัดไปเริ่มย้อนหลังจุดตัดไม่เกิน overlap ตัวอักษร
+    (เริ่มที่ต้นข้อ/ต้นบรรทัดเช่นกัน) เพื่อไม่ให้ข้อที่คร่อมจุดตัดหายไป
+    """
+    if len(text) <= max_chars:
+        return [text] if text.strip() else []
+    starts = find_question_starts(text)
+    chunks, begin = [], 0
+    while len(text) - begin > max_chars:
+        limit = begin + max_chars
+        # จุดตัด: ต้นข้อสุดท้าย (หรือต้นบรรทัดสุดท้าย) ในครึ่งหลังของช่วง
+        i = bisect_left(starts, limit + 1) - 1
+        cut = starts[i] if i >= 0 and starts[i] > begin + max_chars // 2 else text.rfind('\n', begin + max_chars // 2, limit)
+        cut = cut if cut > begin else limit
+        chunks.append(text[begin:cut])
+        if overlap <= 0:
+            begin = cut
+            continue
+        # ช่วงถัดไป: ต้นข้อ (หรือต้นบรรทัด) แรกที่ห่างจากจุดตัดไม่เกิน overlap
+        lo = max(begin + 1, cut - overlap)
+        i = bisect_left(starts, lo)
+        nxt = starts[i] if i < len(starts) and starts[i] < cut else text.find('\n', lo, cut)
+        begin = nxt if nxt > 0 else lo
+    chunks.append(text[begin:])
+    return chunks
+
+def split_questions(raw_text):
+    """แยกข้อสอบด้วยกฎ (ไม่มี AI fallback): ตัดส่วนเฉลย -> normalize -> สแกนช่วงของแต่ละข้อ"""
+    buffer = normalize_exam_text(ANSWER_KEY.split(raw_text, 1)[0])
+    questions = []
+    for start, end in scan_question_spans(buffer):
+        question = format_question(buffer, start, end)
+        if question:
+            questions.append(question)
+    return questions
@@ -1,21 +1,187 @@
+import os
 import re
+import math
+import threading
+import heapq
+from collections import Counter
+
+import numpy as np
+
+from .tokenizer import get_tokenizer, is_tokenizer_available
+from .embeddings import get_embedder
+from .curriculum_store import (
+    save_curriculum, delete_curriculum, list_stored_curricula, StoredCurriculum,
+    save_active_name, load_active_name, save_embeddings, load_embeddings
+)
+
+# ค่าพารามิเตอร์ BM25 (k1: ความอิ่มตัวของความถี่คำ, b: การปรับตามความยาว section)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# วิธีค้นหา: lexical (BM25) | dense (embedding) | hybrid (รวมคะแนนทั้งสองแบบ)
+RAG_RETRIEVAL = os.getenv('RAG_RETRIEVAL', 'lexical').strip().lower()
+# น้ำหนักของคะแนน dense ในโหมด hybrid (ที่เหลือเป็น BM25 ที่ normalize แล้ว)
+HYBRID_ALPHA = float(os.getenv('RAG_HYBRID_ALPHA', '0.5'))
+
+# Federated search: ค้นทุกหลักสูตรที่โหลดไว้ โดย router ใส่หลักสูตรที่ active ไว้เสมอ
+# (ปิดด้วย RAG_FEDERATED=0 เพื่อค้นเฉพาะหลักสูตรที่ active)
+RAG_FEDERATED = os.getenv('RAG_FEDERATED', '1').strip() not in ('0', 'false', 'no')
+# Router: ค้นต่อข้อไม่เกินกี่หลักสูตร และต้องได้คะแนนอย่างน้อยกี่เท่าของหลักสูตรที่ดีที่สุด
+ROUTER_MAX_CURRICULA = int(os.getenv('RAG_ROUTER_MAX_CURRICULA', '2'))
+ROUTER_MIN_RATIO = float(os.getenv('RAG_ROUTER_MIN_RATIO', '0.7'))
+
+def tokenize(text, tokenizer=None):
+    """ตัดคำสำหรับทำดัชนีและค้นหา (ตัวตัดคำเดียวกันทั้งตอนสร้างดัชนีและตอนค้นหา)"""
+    return get_tokenizer(tokenizer)[1](text)
+
+def build_index(sections, tokenizer=None):
+    """สร้าง inverted index สำหรับ BM25: postings {term: [(section_id, tf), ...]}, idf และความยาวแต่ละ section"""
+    tokenizer, tokenize_fn = get_tokenizer(tokenizer)
+    postings = {}
+    doc_len = []
+    for doc_id, section in enumerate(sections):
+        terms = Counter(tokenize_fn(section))
+        doc_len.append(sum(terms.values()))
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append((doc_id, tf))
+
+    n_docs = len(sections)
+    idf = {
+        term: math.log(1 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+        for term, plist in postings.items()
+    }
+    return {
+        "tokenizer": tokenizer,
+        "postings": postings,
+        "idf": idf,
+        "doc_len": doc_len,
+        "avgdl": (sum(doc_len) / n_docs) if n_docs else 0.0,
+    }
+
+def bm25_scores(index, query_terms):
+    """คะแนน BM25 ของ section ที่มีคำค้นอย่างน้อยหนึ่งคำ (อ่านเฉพาะ postings ของคำค้น)"""
+    scores = {}
+    doc_len = index["doc_len"]
+    avgdl = index["avgdl"] or 1.0
+    for term in set(query_terms):
+        plist = index["postings"].get(term)
+        if not plist:
+            continue
+        idf = index["idf"][term]
+        for doc_id, tf in plist:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[doc_id] / avgdl)
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+    return scores
+
+def index_tokenizer(index):
+    """ฟังก์ชันตัดคำที่ใช้สร้างดัชนีนี้ (ตัดคำค้นด้วยตัวอื่นจะได้คำที่ไม่ตรงกับ postings จึงไม่ fallback)"""
+    name = index["tokenizer"]
+    if not is_tokenizer_available(name):
+        raise ValueError(f"Index was built with tokenizer '{name}', which is not available here; rebuild the index")
+    return get_tokenizer(name)[1]
+
+def bm25_scores_many(index, queries):
+    """คะแนน BM25 ของหลายคำถามพร้อมกัน: ตัดคำแต่ละคำถามครั้งเดียว และคำนวณ postings ของแต่ละคำครั้งเดียวทั้งชุด"""
+    tokenize_fn = index_tokenizer(index)
+    query_terms = {query: set(tokenize_fn(query)) for query in set(queries)}
+    term_scores = {}
+    for terms in query_terms.values():
+        for term in terms:
+            if term not in term_scores:
+                term_scores[term] = bm25_scores(index, [term])
+
+    scores_by_query = {}
+    for query, terms in query_terms.items():
+        scores = {}
+        for term in terms:
+            for doc_id, score in term_scores[term].items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        scores_by_query[query] = scores
+    return [scores_by_query[query] for query in queries]
+
+def dedupe_sections(sections_per_query):
+    """รวม section ที่ซ้ำกันระหว่างคำถาม คืน (section ที่ไม่ซ้ำตามลำดับที่พบ, เลขอ้างอิงของแต่ละคำถาม)"""
+    unique = []
+    positions = {}
+    refs = []
+    for sections in sections_per_query:
+        query_refs = []
+        for section in sections or []:
+            if section not in positions:
+                positions[section] = len(unique)
+                unique.append(section)
+            query_refs.append(positions[section])
+        refs.append(query_refs)
+    return unique, refs
 
 class MultiSubjectRAG:
     """ระบบ RAG สำหรับหลายวิชา - สามารถเก็บหลักสูตรหลายไฟล์"""
     
-    def __init__(self):
-        self.curricula = {}  # {name: {"text": str, "sections": list}}
-        self.active_name = None
+    def __init__(self, tokenizer=None, store_dir=None, persist=True, retrieval=None, embedder=None, federated=None):
+        self.tokenizer = tokenizer  # None = ใช้ค่าจาก env RAG_TOKENIZER
+        self.retrieval = retrieval or RAG_RETRIEVAL
+        self.embedder = embedder  # None = ใช้ค่าจาก env RAG_EMBEDDER
+        self.federated = RAG_FEDERATED if federated is None else federated
+        self._embeddings = {}  # {name: float32 matrix (sections, dim)}
+        self._centroids = {}  # {name: เวกเตอร์เฉลี่ยของ section (ใช้ route ในโหมด dense)}
+        self.store_dir = store_dir  # None = CURRICULUM_STORE_DIR
+        self.persist = persist
+        self._curricula = {}  # {name: {"text": str, "sections": list, "index": dict}} หรือ StoredCurriculum
+        self._active_name = None
+        self._discovered = not persist
+        self._lock = threading.Lock()
+    
+    def _discover(self):
+        """ลงทะเบียนหลักสูตรที่บันทึกไว้บนดิสก์ (อ่านแค่ meta, ดัชนีโหลดเมื่อค้นหาครั้งแรก)"""
+        if self._discovered:
+            return
+        with self._lock:
+            if self._discovered:
+                return
+            for path, meta in list_stored_curricula(self.store_dir):
+                self._curricula.setdefault(meta["name"], StoredCurriculum(path, meta))
+            if not self._active_name and self._curricula:
+                saved = load_active_name(self.store_dir)
+                self._active_name = saved if saved in self._curricula else next(iter(self._curricula))
+            self._discovered = True
+    
+    @property
+    def curricula(self):
+        self._discover()
+        return self._curricula
+    
+    @property
+    def active_name(self):
+        self._discover()
+        return self._active_name
+    
+    @active_name.setter
+    def active_name(self, name):
+        self._active_name = name
+        if self.persist and name:
+            try:
+                save_active_name(name, self.store_dir)
+            except OSError as e:
+                print(f"Curriculum selection save failed: {e}")
         
     def add_curriculum(self, name, text):
-        """เพิ่มหลักสูตรใหม่"""
+        """เพิ่มหลักสูตรใหม่ (สร้างดัชนีแล้วบันทึกลงดิสก์)"""
         sections = re.split(r'(?=\n(?:[ก-ฮ]\s*\d+\.\d+|[A-Z]\s*\d+\.\d+))', text)
         sections = [s.strip() for s in sections if len(s.strip()) > 20]
         
+        index = build_index(sections, self.tokenizer)
+        self._embeddings.pop(name, None)
+        self._centroids.pop(name, None)
         self.curricula[name] = {
             "text": text,
-            "sections": sections
+            "sections": sections,
+            "index": index
         }
+        if self.persist:
+            try:
+                save_curriculum(name, text, sections, index, self.store_dir)
+            except Exception as e:
+                print(f"Curriculum index save failed: {e}")
         
         # Auto-select if first one
         if not self.active_name:
@@ -27,6 +193,10 @@ class MultiSubjectRAG:
         """ลบหลักสูตร"""
         if name in self.curricula:
             del self.curricula[name]
+            self._embeddings.pop(name, None)
+            self._centroids.pop(name, None)
+            if self.persist:
+                delete_curriculum(name, self.store_dir)
             if self.active_name == name:
                 self.active_name = list(self.curricula.keys())[0] if self.curricula else None
                 
@@ -53,29 +223,204 @@ class MultiSubjectRAG:
             return self.curricula[self.active_name]["sections"]
         return []
         
-    def search(self, query, top_k=2):
-        """ค้นหาจากหลักสูตรที่ active อยู่"""
-        if not self.active_name or self.active_name not in self.curricula:
-            return "No curriculum selected."
-            
-        sections = self.curricula[self.active_name]["sections"]
-        if not sections:
-            return "Curriculum has no sections."
-            
-        scores = []
-        query_words = set(re.findall(r'\w+', query.lower()))
+    def _get_index(self, name):
+        """ดัชนี BM25 ของหลักสูตร สร้างใหม่ถ้าตัวตัดคำที่ใช้ตอนสร้างไม่มีในเครื่องนี้ (เช่น ดัชนี newmm แต่ไม่ได้ติดตั้ง pythainlp)"""
+        index = self.curricula[name]["index"]
+        if not is_tokenizer_available(index["tokenizer"]):
+            print(f"Curriculum '{name}' was indexed with tokenizer '{index['tokenizer']}', which is not available here; rebuilding the index")
+            self.add_curriculum(name, self.curricula[name]["text"])
+            index = self.curricula[name]["index"]
+        return index
+    
+    def _get_embedder(self, name):
+        return get_embedder(self.embedder, self._get_index(name)["tokenizer"])
+    
+    def get_embeddings(self, name):
+        """embedding matrix ของทุก section (สร้างครั้งแรกที่ใช้ แล้วเก็บไว้ในหน่วยความจำ/ดิสก์)"""
+        matrix = self._embeddings.get(name)
+        if matrix is not None:
+            return matrix
+        with self._lock:
+            matrix = self._embeddings.get(name)
+            if matrix is None:
+                embedder = self._get_embedder(name)
+                if self.persist:
+                    matrix = load_embeddings(name, embedder.name, self.store_dir)
+                if matrix is None:
+                    matrix = embedder.embed(list(self.curricula[name]["sections"]))
+                    if self.persist:
+                        try:
+                            save_embeddings(name, embedder.name, matrix, self.store_dir)
+                        except OSError as e:
+                            print(f"Curriculum embeddings save failed: {e}")
+                self._embeddings[name] = matrix
+        return matrix
+    
+    def _embed_queries(self, name, queries, query_vectors=None):
+        """เวกเตอร์ของคำถามด้วย embedder ของหลักสูตรนี้ (query_vectors: cache ต่อการค้นหนึ่งครั้ง ใช้ซ้ำข้ามหลักสูตร)"""
+        embedder = self._get_embedder(name)
+        if query_vectors is None or not queries:
+            return embedder.embed(queries)
+        missing = [query for query in dict.fromkeys(queries) if (embedder.name, query) not in query_vectors]
+        if missing:
+            for query, vector in zip(missing, embedder.embed(missing)):
+                query_vectors[(embedder.name, query)] = vector
+        return np.stack([query_vectors[(embedder.name, query)] for query in queries])
+    
+    def _rank_many(self, name, queries, top_k, query_vectors=None):
+        """section ที่ดีที่สุด top_k ของทุกคำถาม คืน [[(section_id, score), ...], ...]
         
-        for section in sections:
-            score = sum(1 for word in query_words if word in section.lower())
-            scores.append((score, section))
-            
-        scores.sort(key=lambda x: x[0], reverse=True)
-        results = [s[1] for s in scores[:top_k] if s[0] > 0]
+        โหมด dense/hybrid แปลงทุกคำถามเป็นเวกเตอร์พร้อมกันแล้วคูณ matrix ครั้งเดียว
+        """
+        index = self._get_index(name)
+        mode = self.retrieval
+        lexical = []
+        if mode != "dense":
+            lexical = bm25_scores_many(index, queries)
+        if mode not in ("dense", "hybrid"):
+            return [
+                [(doc_id, score) for doc_id, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1]) if score > 0]
+                for scores in lexical
+            ]
         
-        if not results:
-            return "No relevant curriculum standard found."
-            
-        return "\n...\n".join(results)
+        sections_matrix = self.get_embeddings(name)
+        query_matrix = self._embed_queries(name, queries, query_vectors)
+        dense = query_matrix @ sections_matrix.T  # (queries, sections) cosine similarity
+        if mode == "hybrid":
+            alpha = HYBRID_ALPHA
+            dense *= alpha
+            for row, scores in enumerate(lexical):
+                if not scores:
+                    continue
+                best = max(scores.values()) or 1.0
+                doc_ids = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+                values = np.fromiter(scores.values(), dtype=np.float32, count=len(scores))
+                dense[row, doc_ids] += (1 - alpha) * values / best
+        
+        k = min(top_k, dense.shape[1])
+        if k <= 0:
+            return [[] for _ in queries]
+        top = np.argpartition(-dense, k - 1, axis=1)[:, :k]
+        ranked = []
+        for row, candidates in enumerate(top):
+            candidates = candidates[np.argsort(-dense[row, candidates])]
+            ranked.append([(int(doc_id), float(dense[row, doc_id])) for doc_id in candidates if dense[row, doc_id] > 0])
+        return ranked
+    
+    def _get_centroid(self, name):
+        centroid = self._centroids.get(name)
+        if centroid is None:
+            centroid = np.asarray(self.get_embeddings(name), dtype=np.float32).mean(axis=0)
+            centroid /= np.linalg.norm(centroid) or 1.0
+            self._centroids[name] = centroid
+        return centroid
+    
+    def route(self, queries, names=None, query_vectors=None):
+        """Router ขั้นแรก: เลือกหลักสูตรที่น่าจะเกี่ยวข้องของแต่ละคำถาม คืน [[(name, router_score), ...], ...]
+        
+        โหมด dense ใช้ cosine กับ centroid ของหลักสูตร โหมดอื่นใช้สัดส่วนคำค้นที่พบในคลังคำของหลักสูตร
+        (ไม่ใช้ IDF เพราะจะให้คะแนนหลักสูตรที่คำค้นพบได้ยากสูงกว่าหลักสูตรที่ครอบคลุมเนื้อหานั้นจริง)
+        หลักสูตรที่ active ถูกใส่ในผลของทุกข้อเสมอ (ต้นทุนต่อข้อ = จำนวนหลักสูตร × จำนวนคำค้น ไม่ขึ้นกับจำนวน section)
+        โหมด dense แปลงคำถามเป็นเวกเตอร์ครั้งเดียวแล้วใช้ซ้ำทุกหลักสูตรที่ใช้ embedder เดียวกัน
+        """
+        names = [name for name in (names or self.curricula) if self.curricula[name]["sections"]]
+        if len(names) <= 1:
+            return [[(name, 1.0) for name in names] for _ in queries]
+        
+        scores = np.zeros((len(queries), len(names)), dtype=np.float32)
+        if self.retrieval == "dense":
+            query_vectors = {} if query_vectors is None else query_vectors
+            for col, name in enumerate(names):
+                scores[:, col] = self._embed_queries(name, queries, query_vectors) @ self._get_centroid(name)
+        else:
+            term_cache = {}
+            for col, name in enumerate(names):
+                index = self._get_index(name)
+                tokenize_fn = index_tokenizer(index)
+                vocabulary = index["postings"]
+                for row, query in enumerate(queries):
+                    key = (index["tokenizer"], query)
+                    if key not in term_cache:
+                        term_cache[key] = set(tokenize_fn(query))
+                    terms = term_cache[key]
+                    if terms:
+                        scores[row, col] = sum(1 for term in terms if term in vocabulary) / len(terms)
+        
+        active = names.index(self.active_name) if self.active_name in names else None
+        routes = []
+        for row in scores:
+            order = np.argsort(-row)[:ROUTER_MAX_CURRICULA]
+            best = row[order[0]]
+            route = [(names[col], float(row[col])) for col in order if best > 0 and row[col] >= best * ROUTER_MIN_RATIO]
+            if active is not None and all(name != names[active] for name, _ in route):
+                route.append((names[active], float(row[active]) if best > 0 else 1.0))
+            routes.append(route)
+        return routes
+    
+    def _search_federated(self, queries, top_k):
+        """ค้นเฉพาะหลักสูตรที่ router เลือกของแต่ละข้อ แล้วรวมผลด้วยคะแนนที่ normalize ต่อหลักสูตร"""
+        query_vectors = {}  # เวกเตอร์คำถามที่ใช้ร่วมกันระหว่าง router และทุกหลักสูตร
+        routes = self.route(queries, query_vectors=query_vectors)
+        by_curriculum = {}
+        for row, route in enumerate(routes):
+            for name, _ in route:
+                by_curriculum.setdefault(name, []).append(row)
+        
+        candidates = [[] for _ in queries]
+        for name, rows in by_curriculum.items():
+            sections = self.curricula[name]["sections"]
+            ranked = self._rank_many(name, [queries[row] for row in rows], top_k, query_vectors)
+            for row, hits in zip(rows, ranked):
+                if not hits:
+                    continue
+                route = dict(routes[row])
+                weight = route[name] / (max(route.values()) or 1.0)
+                best = hits[0][1] or 1.0
+                candidates[row].extend((weight * score / best, sections[doc_id]) for doc_id, score in hits)
+        
+        results = []
+        for hits in candidates:
+            hits.sort(key=lambda item: item[0], reverse=True)
+            picked = []
+            for _, section in hits:
+                if section not in picked:
+                    picked.append(section)
+                if len(picked) >= top_k:
+                    break
+            results.append(picked)
+        return results
+        
+    def search_sections_many(self, queries, top_k=2):
+        """section ที่เกี่ยวข้องของหลายคำถาม (None ถ้ายังไม่ได้โหลดหลักสูตร)
+        
+        federated: ค้นทุกหลักสูตรที่โหลดไว้ผ่าน router, ไม่เช่นนั้นค้นเฉพาะหลักสูตรที่ active
+        """
+        queries = list(queries)
+        if self.federated and len(self.curricula) > 1:
+            return self._search_federated(queries, top_k)
+        name = self.active_name
+        if not name or name not in self.curricula:
+            return None
+        sections = self.curricula[name]["sections"]
+        if not sections:
+            return [[] for _ in queries]
+        return [[sections[doc_id] for doc_id, _ in ranked] for ranked in self._rank_many(name, queries, top_k)]
+    
+    def search_many(self, questions, top_k=2):
+        """ค้นหาหลายคำถามในครั้งเดียว (ใช้ตัดคำ/คะแนนร่วมกันทั้งชุดข้อสอบ) คืนข้อความอ้างอิงรายข้อ"""
+        results = self.search_sections_many(questions, top_k)
+        if results is None:
+            return ["No curriculum selected."] * len(questions)
+        if not (self.federated and len(self.curricula) > 1) and not self.curricula[self.active_name]["sections"]:
+            return ["Curriculum has no sections."] * len(questions)
+        return [
+            "\n...\n".join(sections) if sections else "No relevant curriculum standard found."
+            for sections in results
+        ]
+        
+    def search(self, query, top_k=2):
+        """ค้นหาจากหลักสูตรที่โหลดไว้ (ดู search_sections_many)"""
+        return self.search_many([query], top_k)[0]
 
 # Singleton Global Instance
 rag_engine = MultiSubjectRAG()
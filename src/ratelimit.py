@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import threading
+
+from .prompt_budget import estimate_prompt_tokens
+
+# ประมาณ token ของคำตอบ JSON หนึ่งข้อ (ใช้จองโควตา TPM ก่อนส่งคำขอ)
+DEFAULT_OUTPUT_TOKENS = 800
+# รอโควตานานสุดกี่วินาทีก่อนยอมแพ้
+DEFAULT_MAX_WAIT = 180
+
+def estimate_tokens(*texts):
+    """ประมาณจำนวน token แบบหยาบ (อัตราส่วนกลางของ prompt_budget เมื่อไม่ระบุ Provider)"""
+    return estimate_prompt_tokens(None, *texts)
+
+def _parse_duration(value):
+    """แปลงค่าเวลาใน header เช่น '20', '7.66s', '2m59.56s', '150ms' เป็นวินาที"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = re.fullmatch(r'(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?', value)
+    if not match or not any(match.groups()):
+        return None
+    h, m, s, ms = (float(g) if g else 0.0 for g in match.groups())
+    return h * 3600 + m * 60 + s + ms / 1000
+
+def _get_headers(obj):
+    """ดึง headers จาก response/exception ของ SDK (openai, groq ใช้ httpx)"""
+    headers = getattr(obj, 'headers', None)
+    if headers is None:
+        response = getattr(obj, 'response', None)
+        headers = getattr(response, 'headers', None)
+    return headers or {}
+
+def parse_retry_after(error):
+    """อ่านเวลาที่ต้องรอจาก Retry-After / x-ratelimit-reset-* หรือจากข้อความ error ของ Gemini"""
+    headers = _get_headers(error)
+    for name in ('retry-after', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        seconds = _parse_duration(headers.get(name))
+        if seconds is not None:
+            return seconds
+
+    error_str = str(error)
+    match = re.search(r'retry[_ ]delay\s*\{\s*seconds:\s*(\d+)', error_str, flags=re.IGNORECASE)
+    if not match:
+        match = re.search(r'retry in\s*(\d+(?:\.\d+)?)\s*s', error_str, flags=re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+def is_rate_limit_error(error):
+    """ตรวจว่าเป็น error จากการเกินโควตา (429) หรือไม่"""
+    if getattr(error, 'status_code', None) == 429:
+        return True
+    error_str = str(error).lower()
+    return any(x in error_str for x in ["429", "quota", "resourceexhausted", "resource exhausted", "too many requests", "rate limit"])
+
+
+class TokenBucket:
+    """Token bucket แบบ thread-safe ภายนอก (ผู้เรียกต้องถือ lock เอง)"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.capacity <= 0
+
+    def refill(self, now):
+        if self.unlimited:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """วินาทีที่ต้องรอจนมีโควตาพอสำหรับ amount"""
+        if self.unlimited:
+            return 0.0
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        if not self.unlimited:
+            self.level -= amount
+
+
+class ProviderRateLimiter:
+    """จำกัดคำขอต่อนาที (RPM) และ token ต่อนาที (TPM) ของ Provider/Model หนึ่งตัว ใช้ร่วมกันทั้ง process"""
+
+    def __init__(self, name, rpm=0, tpm=0):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.blocked_until = 0.0
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens=0, max_wait=DEFAULT_MAX_WAIT):
+        """รอจนมีโควตาแล้วจองไว้ คืน False ถ้ารอเกิน max_wait"""
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    wait = max(
+                        self.blocked_until - now,
+                        self.requests.wait_time(1),
+                        self.tokens.wait_time(estimated_tokens),
+                    )
+                    if wait <= 0:
+                        self.requests.consume(1)
+                        self.tokens.consume(estimated_tokens)
+                        self.total_wait += now - start
+                        return True
+                if now - start + wait > max_wait:
+                    return False
+                time.sleep(min(wait, 1.0))
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def record_usage(self, actual_tokens, estimated_tokens):
+        """ปรับโควตา TPM ตาม token ที่ใช้จริง (จาก usage ของ response)"""
+        if not actual_tokens:
+            return
+        with self._lock:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def penalize(self, retry_after=None, default=10):
+        """หยุดส่งคำขอชั่วคราวหลังโดน 429 (ใช้ Retry-After ถ้ามี)"""
+        delay = retry_after if retry_after is not None else default
+        with self._lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            # โควตาที่เหลือตาม local bucket ไม่ตรงกับ server แล้ว
+            self.requests.level = min(self.requests.level, 0)
+
+    def update_from_headers(self, headers):
+        """ซิงก์โควตาคงเหลือกับ header x-ratelimit-* ของ response (ถ้ามี)"""
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if remaining is None or bucket.unlimited:
+                    continue
+                try:
+                    bucket.refill(now)
+                    bucket.level = min(bucket.level, float(remaining))
+                except ValueError:
+                    continue
+                if float(remaining) <= 0:
+                    reset = _parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                    if reset:
+                        self.blocked_until = max(self.blocked_until, now + reset)
+
+    def snapshot(self):
+        """สถานะโควตาปัจจุบัน (สำหรับแสดงใน UI)"""
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "name": self.name,
+                "rpm_limit": int(self.requests.capacity),
+                "rpm_available": None if self.requests.unlimited else max(0, int(self.requests.level)),
+                "tpm_limit": int(self.tokens.capacity),
+                "tpm_available": None if self.tokens.unlimited else max(0, int(self.tokens.level)),
+                "blocked_for": round(max(0.0, self.blocked_until - now), 1),
+                "waiting": self.waiting,
+                "throttled": self.throttled,
+                "total_wait": round(self.total_wait, 1),
+            }
+
+
+# Registry ระดับ process (แชร์ระหว่างทุก Streamlit session ใน instance เดียวกัน)
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider, model_id, rpm=0, tpm=0):
+    """ดึง (หรือสร้าง) rate limiter ของ provider + model"""
+    key = (provider, model_id)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = ProviderRateLimiter(f"{provider} / {model_id}", rpm, tpm)
+            _limiters[key] = limiter
+        return limiter
+
+def get_rate_limit_snapshot(provider=None):
+    """สถานะโควตาของทุก limiter (หรือเฉพาะ provider ที่ระบุ)"""
+    with _limiters_lock:
+        items = list(_limiters.items())
+    return [limiter.snapshot() for (p, _), limiter in items if provider is None or p == provider]
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Circuit Breaker: ล้มเหลวติดกันกี่ครั้งจึงตัดวงจร และพักกี่วินาทีก่อนลองใหม่
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '3'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '60'))
+
+# Hedging: ถ้ายังไม่มีสถิติพอ ให้รอกี่วินาทีก่อนยิง Provider สำรอง
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '20'))
+HEDGE_MIN_SAMPLES = 5
+LATENCY_WINDOW = 100
+
+
+class CircuitBreaker:
+    """ตัดวงจร Provider ที่ล้มเหลวติดกัน (closed → open → half-open → closed)"""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """อนุญาตให้ส่งคำขอหรือไม่ (half-open ปล่อยผ่านทีละหนึ่งคำขอเพื่อทดสอบ)"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.half_open_trial:
+                self.half_open_trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.half_open_trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.half_open_trial = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """เก็บเวลาตอบของคำขอที่สำเร็จล่าสุด เพื่อคำนวณ p95 สำหรับ hedging"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            data = sorted(self.samples)
+        if not data:
+            return None
+        k = min(len(data) - 1, max(0, math.ceil(pct / 100 * len(data)) - 1))
+        return data[k]
+
+    def __len__(self):
+        with self._lock:
+            return len(self.samples)
+
+
+_lock = threading.Lock()
+_breakers = {}
+_latencies = {}
+# Pool สำหรับคำขอ hedge (คำขอที่แพ้จะทำงานจนจบในเบื้องหลัง) สร้างครั้งแรกที่ใช้
+# ขนาดมาจาก HEDGE_WORKERS หรือ configure_hedge_pool (concurrency รวมของ Provider)
+HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', '0'))
+_hedge_pool_size = 8
+_hedge_executor = None
+
+def configure_hedge_pool(workers):
+    """กำหนดขนาด hedge pool ตามจำนวนคำขอพร้อมกันสูงสุดของทั้ง process (มีผลก่อนสร้าง pool เท่านั้น)"""
+    global _hedge_pool_size
+    with _lock:
+        _hedge_pool_size = max(_hedge_pool_size, int(workers))
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS or _hedge_pool_size, thread_name_prefix="hedge")
+        return _hedge_executor
+
+def get_breaker(provider):
+    with _lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+def get_latency_tracker(provider):
+    with _lock:
+        if provider not in _latencies:
+            _latencies[provider] = LatencyTracker()
+        return _latencies[provider]
+
+def hedge_delay(provider):
+    """เวลาที่รอ Provider หลักก่อนยิงสำรอง = p95 ของเวลาตอบล่าสุด"""
+    tracker = get_latency_tracker(provider)
+    if len(tracker) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return tracker.percentile(95)
+
+def call_with_tracking(provider, call, is_failure):
+    """เรียก call() แล้วบันทึกผลลง circuit breaker และสถิติเวลาตอบของ Provider"""
+    start = time.monotonic()
+    try:
+        result = call()
+    except Exception:
+        get_breaker(provider).record_failure()
+        raise
+    if is_failure(result):
+        get_breaker(provider).record_failure()
+    else:
+        get_breaker(provider).record_success()
+        get_latency_tracker(provider).record(time.monotonic() - start)
+    return result
+
+def route_with_failover(chain, call_provider, is_failure, hedging=False):
+    """ส่งคำขอตามลำดับ Provider ใน chain ข้ามตัวที่วงจรเปิดอยู่ คืน (provider, result)
+
+    call_provider(provider) ต้องคืนผลลัพธ์ (ผลที่ is_failure เป็นจริงถือว่าล้มเหลว)
+    hedging=True: ถ้า Provider แรกยังไม่ตอบภายใน p95 ให้ยิงตัวถัดไปพร้อมกันแล้วใช้ผลที่สำเร็จก่อน
+    (นับเวลาจากตอนที่คำขอเริ่มทำงานจริง ไม่ใช่ตอนเข้าคิว pool ที่เต็มจะได้ไม่ยิง hedge ซ้อนโดยเปล่าประโยชน์)
+    เรียก allow() เฉพาะก่อนส่งคำขอจริง (half-open ให้ทดลองได้ครั้งเดียว ถ้าขอสิทธิ์แล้วไม่ได้ใช้ breaker จะค้าง)
+    """
+    queue = list(chain)
+    attempted = False
+
+    def next_allowed():
+        nonlocal attempted
+        while queue:
+            provider = queue.pop(0)
+            if get_breaker(provider).allow():
+                attempted = True
+                return provider
+        if not attempted and chain:
+            # ทุกตัวถูกตัดวงจร: ลองตัวแรกตามลำดับดีกว่าล้มเหลวทันที
+            attempted = True
+            return chain[0]
+        return None
+
+    last = (chain[0] if chain else None, None)
+    if not hedging:
+        while True:
+            provider = next_allowed()
+            if provider is None:
+                return last
+            try:
+                result = call_with_tracking(provider, lambda: call_provider(provider), is_failure)
+            except Exception as e:
+                last = (provider, e)
+                continue
+            if not is_failure(result):
+                return provider, result
+            last = (provider, result)
+
+    pending = {}
+    started = {}
+
+    def run(provider, future_id):
+        started[future_id] = time.monotonic()
+        return call_with_tracking(provider, lambda: call_provider(provider), is_failure)
+
+    def launch():
+        provider = next_allowed()
+        if provider is None:
+            return False
+        future_id = object()
+        future = _get_hedge_executor().submit(run, provider, future_id)
+        pending[future] = (provider, future_id)
+        return True
+
+    def hedge_timeout():
+        """วินาทีที่เหลือก่อนถึงเวลายิง hedge (None = ไม่มีตัวสำรองแล้ว)"""
+        if not queue:
+            return None
+        provider, future_id = pending[next(reversed(pending))]  # คำขอที่ยิงล่าสุด
+        start = started.get(future_id)
+        if start is None:
+            return 0.05  # ยังรอคิวใน pool: รอให้เริ่มทำงานก่อนเริ่มนับเวลา
+        return max(0.0, start + hedge_delay(provider) - time.monotonic())
+
+    launch()
+    while pending:
+        timeout = hedge_timeout()
+        done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            provider, future_id = pending[next(reversed(pending))]
+            if future_id in started and time.monotonic() - started[future_id] >= hedge_delay(provider):
+                launch()  # Provider ที่รอยังช้ากว่า p95: ยิงตัวถัดไปคู่ขนาน
+            continue
+        for future in done:
+            provider, _ = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                last = (provider, e)
+                continue
+            if not is_failure(result):
+                return provider, result
+            last = (provider, result)
+        if not pending and queue:
+            launch()  # ตัวที่ยิงไปล้มเหลวหมด: ลองตัวถัดไป
+    return last
+
+def get_breaker_snapshot():
+    """สถานะ circuit breaker และ p95 ของแต่ละ Provider (สำหรับ UI)"""
+    with _lock:
+        providers = sorted(set(_breakers) | set(_latencies))
+    snapshot = []
+    for provider in providers:
+        p95 = get_latency_tracker(provider).percentile(95)
+        snapshot.append({
+            "provider": provider,
+            "state": get_breaker(provider).state,
+            "failures": get_breaker(provider).failures,
+            "p95": round(p95, 1) if p95 is not None else None,
+        })
+    return snapshot
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+
+from .utils import normalize_thai_digits
+
+# --- Optional Imports ---
+try:
+    from pythainlp.tokenize import word_tokenize as pythainlp_tokenize
+    from pythainlp.corpus import thai_words
+    PYTHAINLP_AVAILABLE = True
+except ImportError:
+    PYTHAINLP_AVAILABLE = False
+
+# ตัวตัดคำที่ใช้ทำดัชนี RAG: auto | newmm | dict | ngram | regex
+RAG_TOKENIZER = os.getenv('RAG_TOKENIZER', 'auto').strip().lower()
+# ไฟล์พจนานุกรม (หนึ่งคำต่อบรรทัด) สำหรับตัวตัดคำ dict เมื่อไม่มี pythainlp
+THAI_DICT_PATH = os.getenv('THAI_DICT_PATH', '')
+# ความยาว n-gram ของอักษรไทย
+NGRAM_SIZE = int(os.getenv('RAG_NGRAM_SIZE', '3'))
+
+# แยกข้อความเป็นช่วงอักษรไทยติดกัน หรือคำภาษาอื่น/ตัวเลข
+_RUN_PATTERN = re.compile(r'[ก-๏]+|[^\W฀-๿]+')
+_THAI_RUN = re.compile(r'[ก-๏]')
+
+def _runs(text):
+    """ทำให้เป็นมาตรฐาน (ตัวพิมพ์เล็ก + เลขอารบิก) แล้วแยกเป็นช่วง"""
+    return _RUN_PATTERN.findall(normalize_thai_digits(text).lower())
+
+def regex_tokenize(text):
+    """ตัดตามช่วงอักษร (ภาษาไทยที่ไม่มีช่องว่างจะได้ทั้งประโยคเป็นคำเดียว)"""
+    return _runs(text)
+
+def ngram_tokenize(text, n=None):
+    """ภาษาไทย: character n-gram, ภาษาอื่น/ตัวเลข: ทั้งคำ"""
+    n = n or NGRAM_SIZE
+    tokens = []
+    for run in _runs(text):
+        if not _THAI_RUN.match(run) or len(run) <= n:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return tokens
+
+
+class DictionarySegmenter:
+    """ตัดคำไทยแบบ longest matching จากพจนานุกรม (อักษรที่ไม่อยู่ในพจนานุกรมรวมเป็นคำเดียว)"""
+
+    def __init__(self, words):
+        self.words = {w.strip().lower() for w in words if w.strip()}
+        self.max_len = max((len(w) for w in self.words), default=1)
+
+    def segment(self, run):
+        tokens = []
+        unknown = ""
+        i = 0
+        while i < len(run):
+            for size in range(min(self.max_len, len(run) - i), 0, -1):
+                if run[i:i + size] in self.words:
+                    break
+            else:
+                unknown += run[i]
+                i += 1
+                continue
+            if unknown:
+                tokens.append(unknown)
+                unknown = ""
+            tokens.append(run[i:i + size])
+            i += size
+        if unknown:
+            tokens.append(unknown)
+        return tokens
+
+    def __call__(self, text):
+        tokens = []
+        for run in _runs(text):
+            tokens.extend(self.segment(run) if _THAI_RUN.match(run) else [run])
+        return tokens
+
+
+def _load_dictionary():
+    """โหลดพจนานุกรมจาก THAI_DICT_PATH หรือ pythainlp (ไม่ต้องต่อเน็ต) คืน None ถ้าไม่มี"""
+    if THAI_DICT_PATH and os.path.exists(THAI_DICT_PATH):
+        with open(THAI_DICT_PATH, 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+    if PYTHAINLP_AVAILABLE:
+        return thai_words()
+    return None
+
+def newmm_tokenize(text):
+    """ตัดคำด้วย pythainlp (newmm, พจนานุกรมในตัว)"""
+    tokens = []
+    for run in _runs(text):
+        if _THAI_RUN.match(run):
+            tokens.extend(t for t in pythainlp_tokenize(run, engine="newmm", keep_whitespace=False) if t.strip())
+        else:
+            tokens.append(run)
+    return tokens
+
+
+# Registry ของตัวตัดคำ (เพิ่มเองได้ด้วย register_tokenizer)
+TOKENIZERS = {
+    "regex": regex_tokenize,
+    "ngram": ngram_tokenize,
+}
+if PYTHAINLP_AVAILABLE:
+    TOKENIZERS["newmm"] = newmm_tokenize
+
+def register_tokenizer(name, func):
+    """ลงทะเบียนตัวตัดคำ func(text) -> list[str]"""
+    TOKENIZERS[name] = func
+
+def resolve_tokenizer_name(name=None):
+    """แปลงชื่อที่ตั้งค่าไว้เป็นตัวตัดคำที่ใช้ได้จริงในเครื่องนี้"""
+    name = (name or RAG_TOKENIZER).lower()
+    if name == "auto":
+        return "newmm" if "newmm" in TOKENIZERS else "ngram"
+    if name == "dict" and "dict" not in TOKENIZERS:
+        words = _load_dictionary()
+        if not words:
+            print("Thai dictionary not found, falling back to n-gram tokenizer")
+            return "ngram"
+        TOKENIZERS["dict"] = DictionarySegmenter(words)
+    if name not in TOKENIZERS:
+        print(f"Unknown tokenizer '{name}', falling back to n-gram tokenizer")
+        return "ngram"
+    return name
+
+def is_tokenizer_available(name):
+    """ตัวตัดคำชื่อนี้ใช้ได้ในเครื่องนี้หรือไม่ (ไม่ fallback) ใช้ตรวจดัชนีที่สร้างไว้ก่อนหน้า"""
+    if name == "dict" and "dict" not in TOKENIZERS and _load_dictionary():
+        resolve_tokenizer_name(name)
+    return name in TOKENIZERS
+
+def get_tokenizer(name=None):
+    """คืน (ชื่อ, ฟังก์ชันตัดคำ)"""
+    name = resolve_tokenizer_name(name)
+    return name, TOKENIZERS[name]
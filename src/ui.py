@@ -8,8 +8,10 @@ from datetime import datetime
 
 # Internal Imports
 from .localization import t, toggle_language
-from .analysis import AI_PROVIDERS
+from .analysis import AI_PROVIDERS, BATTLE_PROVIDER
 from .utils import get_bloom_color, load_analysis_history, clear_all_history
+from .ratelimit import get_rate_limit_snapshot
+from .routing import get_breaker_snapshot
 
 def render_hero_section():
     """ส่วนหัวของแอพแบบ Minimalist Dashboard"""
@@ -59,6 +61,52 @@ def render_hero_section():
                  if new_model != st.session_state.selected_model:
                      st.session_state.selected_model = new_model
                      st.session_state.analysis_results = None
+                 
+                 if AI_PROVIDERS[st.session_state.selected_provider].get("supports_batch"):
+                     st.toggle(
+                         "📦 Batch Mode (หลายข้อต่อคำขอ)",
+                         key='batch_mode',
+                         help="รวมหลายข้อในคำขอเดียว ลดจำนวนครั้งที่เรียก AI และ token ของ System Prompt (จำนวนข้อต่อคำขอเลือกอัตโนมัติตามงบ token)"
+                     )
+                 
+                 if st.session_state.selected_provider == BATTLE_PROVIDER:
+                     contestant_options = [
+                         f"{p} · {m}" for p in AI_PROVIDERS if p != BATTLE_PROVIDER for m in AI_PROVIDERS[p]["models"]
+                     ]
+                     current = [f"{p} · {m}" for p, m in st.session_state.battle_contestants]
+                     selected = st.multiselect(
+                         "⚔️ โมเดลที่แข่งกัน",
+                         contestant_options,
+                         default=[c for c in current if c in contestant_options],
+                         help="ทุกโมเดลวิเคราะห์ข้อเดียวกันพร้อมกัน (เลือกได้มากกว่า 2 โมเดล)"
+                     )
+                     if len(selected) >= 2:
+                         st.session_state.battle_contestants = [c.split(" · ", 1) for c in selected]
+                     else:
+                         st.caption("⚠️ เลือกอย่างน้อย 2 โมเดล")
+                 else:
+                     st.toggle(
+                         "🔀 Failover (สลับ Provider อัตโนมัติ)",
+                         key='failover',
+                         help="ถ้า Provider ที่เลือกล้มเหลวหรือถูกตัดวงจร (circuit breaker) จะส่งต่อให้ Provider อื่นที่มี API Key"
+                     )
+                     st.toggle(
+                         "⚡ Hedged Requests",
+                         key='hedging',
+                         help="ถ้า Provider หลักตอบช้ากว่า p95 ของตัวเอง ให้ยิง Provider สำรองพร้อมกันแล้วใช้ผลที่มาก่อน (เปลือง quota มากขึ้น)"
+                     )
+                 
+                 for breaker in get_breaker_snapshot():
+                     if breaker['state'] != "closed":
+                         st.caption(f"🚫 `{breaker['provider']}` ถูกตัดวงจร ({breaker['state']}, ล้มเหลว {breaker['failures']} ครั้ง)")
+                 
+                 # Rate Limit Budget (shared by all sessions on this server)
+                 for budget in get_rate_limit_snapshot(st.session_state.selected_provider):
+                     rpm = f"{budget['rpm_available']}/{budget['rpm_limit']}" if budget['rpm_available'] is not None else "∞"
+                     tpm = f"{budget['tpm_available']}/{budget['tpm_limit']}" if budget['tpm_available'] is not None else "∞"
+                     st.caption(f"⏱️ `{budget['name']}` · RPM {rpm} · TPM {tpm}")
+                     if budget['blocked_for'] > 0:
+                         st.caption(f"⏳ รอโควตาอีก {budget['blocked_for']} วินาที")
     
     st.markdown("---")
 
@@ -80,8 +128,58 @@ def render_top_navigation():
     """Show Top Navigation Bar (Settings & Manual)"""
     pass # Integrated into render_hero_section now for cleaner UI
 
+def follow_job(job_id):
+    """ให้ session นี้ติดตาม job (ใส่ job id + token ใน URL เพื่อกลับมาดูต่อหลัง reload ได้)"""
+    from .database import get_job_access_token
+    
+    st.session_state.active_job_id = job_id
+    st.session_state.job_error = None
+    st.query_params["job"] = str(job_id)
+    st.query_params["key"] = get_job_access_token(job_id) or ""
+
+def _stop_following_job():
+    st.session_state.active_job_id = None
+    st.query_params.pop("job", None)
+    st.query_params.pop("key", None)
+
+def _start_resume(job_id):
+    """สั่ง resume job แล้วให้หน้าหลักติดตามสถานะ"""
+    from .jobs import resume_job, is_job_active
+    
+    if is_job_active(job_id):
+        st.info("งานนี้กำลังทำงานอยู่แล้ว")
+        return
+    remaining = resume_job(job_id)
+    follow_job(job_id)
+    if remaining:
+        st.toast(f"🔁 วิเคราะห์ต่ออีก {remaining} ข้อ (Job #{job_id})", icon="🤖")
+    else:
+        st.toast(f"💾 ทุกข้อเสร็จแล้ว กำลังบันทึกผล (Job #{job_id})", icon="🤖")
+    st.rerun()
+
+def render_incomplete_jobs():
+    """งานวิเคราะห์ที่ค้าง/ล้มเหลว พร้อมปุ่มทำต่อเฉพาะข้อที่ยังไม่เสร็จ"""
+    from .database import get_incomplete_jobs, get_job_task_counts
+    from .jobs import is_job_active
+    
+    jobs = [job for job in get_incomplete_jobs() if not is_job_active(job['id'])]
+    if not jobs:
+        return
+    
+    st.markdown("#### ⏸️ งานที่ยังไม่เสร็จ")
+    for job in jobs:
+        counts = get_job_task_counts(job['id'])
+        done = counts.get('done', 0)
+        with st.expander(f"⏸️ {job['filename']} ({done}/{job['total_questions']})", expanded=False):
+            if job.get('error'):
+                st.caption(f"⚠️ {job['error']}")
+            st.caption(f"สำเร็จ {done} · ล้มเหลว {counts.get('error', 0)} · ค้าง {counts.get('pending', 0) + counts.get('running', 0)}")
+            if st.button("▶️ วิเคราะห์ต่อ", key=f"resume_job_{job['id']}", use_container_width=True):
+                _start_resume(job['id'])
+
 def render_history_sidebar_v2():
     """Show History in Sidebar"""
+    render_incomplete_jobs()
     history = load_analysis_history()
     
     if not history:
@@ -125,12 +223,23 @@ def render_history_sidebar_v2():
                 # Load full results from DB
                 loaded_results = load_exam_results(exam_id)
                 if loaded_results:
+                    from .database import get_job_id_for_exam, get_job_tasks
+                    source_job = get_job_id_for_exam(exam_id)
                     st.session_state.analysis_results = loaded_results
-                    st.session_state.question_texts = []
+                    st.session_state.question_texts = [task['question_text'] for task in get_job_tasks(source_job)] if source_job else []
+                    st.session_state.question_items = None
                     st.success(f"โหลด: {filename}")
                     st.rerun()
                 else:
                     st.error("ไม่สามารถโหลดข้อมูลได้")
+            
+            # Resume: วิเคราะห์ซ้ำเฉพาะข้อที่ล้มเหลว (เฉพาะผลที่มาจาก job ซึ่งเก็บโจทย์รายข้อไว้)
+            from .database import get_job_id_for_exam, get_job_task_counts
+            job_id = get_job_id_for_exam(exam_id) if exam_id else None
+            failed = get_job_task_counts(job_id).get('error', 0) if job_id else 0
+            if failed:
+                if st.button(f"🔁 วิเคราะห์ซ้ำข้อที่ล้มเหลว ({failed} ข้อ)", key=f"resume_exam_{i}_{exam_id}", use_container_width=True):
+                    _start_resume(job_id)
     
     # --- Question Bank Section ---
     st.markdown("---")
@@ -195,26 +304,26 @@ def render_input_studio(start_analysis_callback):
                 st.session_state.analysis_results = None
                 st.session_state.last_uploaded_file_name = uploaded_file.name
                 st.session_state.question_texts = None
+                st.session_state.question_items = None
                 
                 # --- PERFORM INSTANT EXTRACTION ---
                 try:
-                    from .utils import extract_text_from_pdf, extract_text_from_docx
-                    from .analysis import extract_questions
+                    from .analysis import extract_uploaded_file
                     
                     with st.spinner(f"⚡ {t('reading_file')}"):
-                        text = ""
-                        if uploaded_file.type == "application/pdf":
-                            text = extract_text_from_pdf(uploaded_file)
-                        elif uploaded_file.type == "text/plain":
-                            text = str(uploaded_file.read(), "utf-8")
-                            uploaded_file.seek(0)
-                        elif "wordprocessingml" in uploaded_file.type: # DOCX
-                            text = extract_text_from_docx(uploaded_file)
+                        # แสดงจำนวนข้อที่พบระหว่างที่หน้าถัดไปของ PDF ยังอ่านไม่เสร็จ
+                        progress = st.empty()
+                        extraction = extract_uploaded_file(
+                            uploaded_file,
+                            on_question=lambda found, pages_read: progress.caption(f"⚡ พบแล้ว {len(found)} ข้อ (อ่านแล้ว {pages_read} หน้า)")
+                        )
+                        progress.empty()
                         
-                        if text:
-                            qs = extract_questions(text)
+                        if extraction["raw_text"]:
+                            qs = extraction["questions"]
                             if qs:
                                 st.session_state.question_texts = qs
+                                st.session_state.question_items = extraction["items"]
                                 st.toast(f"✅ พบ {len(qs)} ข้อ! พร้อมวิเคราะห์", icon="⚡")
                                 
                                 # --- Usability: Preview Extraction ---
@@ -223,6 +332,9 @@ def render_input_studio(start_analysis_callback):
                                         st.text_area(f"ข้อที่ {i+1}", q.strip(), height=60, disabled=True)
                                     if len(qs) > 3:
                                         st.caption(f"...และอีก {len(qs)-3} ข้อ")
+                                    answered = sum(1 for q in extraction["items"] if q.answer)
+                                    if answered:
+                                        st.caption(f"🔑 พบเฉลยในไฟล์ {answered} ข้อ (ใช้ตรวจคำตอบของ AI)")
                 except Exception as e:
                     st.error(f"Auto-extract failed: {e}")
         
@@ -232,15 +344,59 @@ def render_input_studio(start_analysis_callback):
                 btn_label, 
                 type="primary", 
                 use_container_width=True,
-                on_click=start_analysis_callback
+                on_click=start_analysis_callback,
+                disabled=bool(st.session_state.get('active_job_id'))
             )
         elif uploaded_file:
              st.caption(f"⏳ {t('reading_file')}")
         else:
              st.button(t('start_analysis_btn'), disabled=True, use_container_width=True)
 
+        render_job_monitor()
+
     return uploaded_file
 
+# ระยะเวลา poll สถานะ job เบื้องหลัง (วินาที)
+JOB_POLL_INTERVAL = 2
+
+def render_job_monitor():
+    """ติดตามงานวิเคราะห์เบื้องหลังของ session นี้ (ถ้ามี)"""
+    if st.session_state.get('job_error'):
+        # แสดงในการ render รอบเต็ม (ถ้าแสดงใน fragment ก่อน st.rerun() ผู้ใช้จะไม่เห็น)
+        st.error(f"งานวิเคราะห์ล้มเหลว: {st.session_state.job_error}")
+    job_id = st.session_state.get('active_job_id')
+    if job_id:
+        _job_monitor_fragment(job_id)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def _job_monitor_fragment(job_id):
+    """Poll สถานะ job จาก DB และแสดงผลเฉพาะข้อที่เสร็จแล้ว (rerun ทั้งหน้าเมื่อ job จบ)"""
+    from .jobs import get_job_progress
+    
+    progress = get_job_progress(job_id)
+    if not progress:
+        _stop_following_job()
+        st.rerun()
+        return
+    
+    st.session_state.question_texts = progress['questions']
+    st.session_state.analysis_results = progress['results']
+    
+    if progress['status'] in ('done', 'failed'):
+        _stop_following_job()
+        if progress['status'] == 'done':
+            st.toast(t('analysis_complete'), icon="🎉")
+        else:
+            st.session_state.job_error = progress['error'] or "unknown error"
+        st.rerun()
+        return
+    
+    total = max(progress['total'], 1)
+    st.progress(progress['completed'] / total, text=f"🤖 Job #{job_id} · {progress['filename']} · วิเคราะห์เสร็จ {progress['completed']}/{progress['total']} ข้อ")
+    if not progress['is_active']:
+        st.caption("⏳ งานอยู่ในคิวของเซิร์ฟเวอร์ (ปิดหน้านี้ได้ ผลจะถูกบันทึกในประวัติ)")
+    render_live_results(progress['results'], f"job_{job_id}")
+
 def render_dashboard_overview(summary_data, bloom_check):
     """แสดง Dashboard สถิติหลัก"""
     st.markdown(f"### {t('dashboard_overview')}")
@@ -264,70 +420,111 @@ def render_dashboard_overview(summary_data, bloom_check):
              st.metric("Bloom Criteria", "FAIL", delta=t('unbalanced'), delta_color="inverse")
     st.markdown("---")
 
+def render_bloom_chart(bloom_check, key=None):
+    """Pie Chart การกระจายระดับ Bloom"""
+    st.markdown(f"##### {t('chart_bloom_dist')}")
+    bloom_counts = bloom_check['raw_counts']
+    chart_data_raw = {
+        'Level': list(bloom_counts.keys())[:-1], 
+        'Count': list(bloom_counts.values())[:-1],
+        'Color': [get_bloom_color(level) for level in list(bloom_counts.keys())[:-1]]
+    }
+    chart_df = pd.DataFrame(chart_data_raw)
+    
+    if not chart_df.empty and chart_df['Count'].sum() > 0:
+        base = alt.Chart(chart_df).encode(theta=alt.Theta("Count", stack=True))
+        pie = base.mark_arc(outerRadius=100).encode(
+            color=alt.Color("Level", scale=alt.Scale(domain=chart_df['Level'].tolist(), range=chart_df['Color'].tolist()), legend=None),
+            tooltip=["Level", "Count"],
+            order=alt.Order("Count", sort="descending")
+        )
+        st.altair_chart(pie, use_container_width=True, key=key)
+    else:
+        st.info("No data for chart.")
+
+def render_difficulty_trend(numbered_analysis, key=None):
+    """กราฟแนวโน้มความยาก numbered_analysis = [(เลขข้อ, analysis), ...]"""
+    st.markdown("##### 📈 Level of Difficulty Trend")
+    
+    # Prepare Data
+    diff_map = {"ง่าย": 1, "ปานกลาง": 2, "ยาก": 3, "Easy": 1, "Medium": 2, "Hard": 3}
+    diff_data = []
+    for i, item in numbered_analysis:
+         d_str = item.get('difficulty', 'ปานกลาง')
+         # Clean string to match key
+         d_val = 2
+         for k, v in diff_map.items():
+             if k in d_str:
+                 d_val = v
+                 break
+         diff_data.append({"Question": i, "Difficulty": d_val, "Label": d_str})
+         
+    diff_df = pd.DataFrame(diff_data)
+    
+    if not diff_df.empty:
+        line = alt.Chart(diff_df).mark_line(point=True).encode(
+            x=alt.X("Question", title="Question Number"),
+            y=alt.Y("Difficulty", scale=alt.Scale(domain=[0, 4]), title="Difficulty Level (1-3)"),
+            tooltip=["Question", "Label"]
+        ).properties(height=200)
+        
+        st.altair_chart(line, use_container_width=True, key=key)
+        st.caption("Trend showing difficulty progression across the exam.")
+
+def render_summary_table(df, key=None):
+    """ตารางสรุปรายข้อ (df ต้องมีคอลัมน์ที่ app.py เปลี่ยนชื่อไว้แล้ว)"""
+    st.markdown(f"##### {t('table_quick_summary')}")
+    st.dataframe(
+        df[['ข้อที่', 'คุณภาพข้อสอบ', 'ระดับความคิด', 'ข้อเสนอแนะ']],
+        column_config={
+            "คุณภาพข้อสอบ": st.column_config.TextColumn(t('quality'), width="small"),
+            "ระดับความคิด": st.column_config.TextColumn("Bloom", width="small"),
+        },
+        use_container_width=True,
+        hide_index=True,
+        key=key
+    )
+
+def build_results_table(numbered_analysis):
+    """สร้าง DataFrame สำหรับตารางสรุป numbered_analysis = [(เลขข้อ, analysis), ...]"""
+    df = pd.DataFrame([item for _, item in numbered_analysis])
+    df['ข้อที่'] = [i for i, _ in numbered_analysis]
+    df['คุณภาพข้อสอบ'] = df['is_good_question'].apply(lambda x: "✅ ดี" if x else "⚠️ ปรับปรุง")
+    return df.rename(columns={
+        'bloom_level': 'ระดับความคิด',
+        'improvement_suggestion': 'ข้อเสนอแนะ',
+        'difficulty': 'ความยาก',
+        'curriculum_standard': 'มาตรฐาน',
+        'correct_option': 'คำตอบ'
+    })
+
+def render_live_results(results, render_id=0):
+    """แสดงผลระหว่างวิเคราะห์ (เฉพาะข้อที่เสร็จแล้ว) ให้ครูเริ่มตรวจข้อแรกๆ ได้ทันที"""
+    from .utils import check_bloom_criteria, is_pending_response
+    
+    numbered = [(i + 1, item) for i, item in enumerate(results) if not is_pending_response(item)]
+    st.caption(f"⏳ แสดงผลระหว่างวิเคราะห์: เสร็จแล้ว {len(numbered)}/{len(results)} ข้อ")
+    if not numbered:
+        return
+    
+    bloom_check = check_bloom_criteria([item for _, item in numbered])
+    col_chart, col_table = st.columns([1, 1.5])
+    with col_chart:
+        render_bloom_chart(bloom_check, key=f"live_bloom_{render_id}")
+        render_difficulty_trend(numbered, key=f"live_trend_{render_id}")
+    with col_table:
+        render_summary_table(build_results_table(numbered), key=f"live_table_{render_id}")
+
 def render_detailed_results(all_analysis, bloom_check, summary_data, df):
     """แสดงผลลัพธ์ละเอียด (Charts + Table)"""
     col_chart, col_table = st.columns([1, 1.5])
     
     with col_chart:
-        st.markdown(f"##### {t('chart_bloom_dist')}")
-        bloom_counts = bloom_check['raw_counts']
-        chart_data_raw = {
-            'Level': list(bloom_counts.keys())[:-1], 
-            'Count': list(bloom_counts.values())[:-1],
-            'Color': [get_bloom_color(level) for level in list(bloom_counts.keys())[:-1]]
-        }
-        chart_df = pd.DataFrame(chart_data_raw)
-        
-        if not chart_df.empty and chart_df['Count'].sum() > 0:
-            base = alt.Chart(chart_df).encode(theta=alt.Theta("Count", stack=True))
-            pie = base.mark_arc(outerRadius=100).encode(
-                color=alt.Color("Level", scale=alt.Scale(domain=chart_df['Level'].tolist(), range=chart_df['Color'].tolist()), legend=None),
-                tooltip=["Level", "Count"],
-                order=alt.Order("Count", sort="descending")
-            )
-            st.altair_chart(pie, use_container_width=True)
-        else:
-            st.info("No data for chart.")
-            
-        # --- NEW: Difficulty Curve ---
-        st.markdown("##### 📈 Level of Difficulty Trend")
-        
-        # Prepare Data
-        diff_map = {"ง่าย": 1, "ปานกลาง": 2, "ยาก": 3, "Easy": 1, "Medium": 2, "Hard": 3}
-        diff_data = []
-        for i, item in enumerate(all_analysis, 1):
-             d_str = item.get('difficulty', 'ปานกลาง')
-             # Clean string to match key
-             d_val = 2
-             for k, v in diff_map.items():
-                 if k in d_str:
-                     d_val = v
-                     break
-             diff_data.append({"Question": i, "Difficulty": d_val, "Label": d_str})
-             
-        diff_df = pd.DataFrame(diff_data)
-        
-        if not diff_df.empty:
-            line = alt.Chart(diff_df).mark_line(point=True).encode(
-                x=alt.X("Question", title="Question Number"),
-                y=alt.Y("Difficulty", scale=alt.Scale(domain=[0, 4]), title="Difficulty Level (1-3)"),
-                tooltip=["Question", "Label"]
-            ).properties(height=200)
-            
-            st.altair_chart(line, use_container_width=True)
-            st.caption("Trend showing difficulty progression across the exam.")
+        render_bloom_chart(bloom_check)
+        render_difficulty_trend(list(enumerate(all_analysis, 1)))
 
     with col_table:
-        st.markdown(f"##### {t('table_quick_summary')}")
-        st.dataframe(
-            df[['ข้อที่', 'คุณภาพข้อสอบ', 'ระดับความคิด', 'ข้อเสนอแนะ']],
-            column_config={
-                "คุณภาพข้อสอบ": st.column_config.TextColumn(t('quality'), width="small"),
-                "ระดับความคิด": st.column_config.TextColumn("Bloom", width="small"),
-            },
-            use_container_width=True,
-            hide_index=True
-        )
+        render_summary_table(df)
         
     st.markdown("---")
     st.markdown(f"#### {t('deep_dive_title')}")
@@ -341,15 +538,20 @@ def render_detailed_results(all_analysis, bloom_check, summary_data, df):
             # Battle Mode UI
             if battle_info:
                 st.info("⚔️ **Battle Mode Result** (Head-to-Head Comparison)")
-                b_col1, b_col2 = st.columns(2)
-                with b_col1:
-                    st.markdown(f"**🤖 {battle_info['model_a']}**")
-                    st.json(battle_info['result_a'])
-                with b_col2:
-                    st.markdown(f"**🤖 {battle_info['model_b']}**")
-                    st.json(battle_info['result_b'])
+                # ผลเก่าในประวัติมีเฉพาะ model_a/model_b
+                contestants = battle_info.get('contestants') or [
+                    {"model": battle_info['model_a'], "result": battle_info['result_a']},
+                    {"model": battle_info['model_b'], "result": battle_info['result_b']},
+                ]
+                for b_col, entry in zip(st.columns(len(contestants)), contestants):
+                    with b_col:
+                        st.markdown(f"**🤖 {entry['model']}**")
+                        st.json(entry['result'])
                 st.markdown("---")
             
+            if item.get('analyzed_by'):
+                st.caption(f"🔀 วิเคราะห์โดย Provider สำรอง: {item['analyzed_by']}")
+            
             # Standard Details (Merged or Single)
             st.markdown(f"**{t('full_question')}**")
             st.info(st.session_state.question_texts[i] if st.session_state.question_texts and i < len(st.session_state.question_texts) else "N/A")
@@ -3,12 +3,18 @@ import os
 import re
 import json
 import io
+import math
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import streamlit as st
 import pandas as pd
 from datetime import datetime
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 
+from .question_scanner import normalize_exam_text, normalize_thai_digits, option_index
+
 # --- Optional Imports ---
 try:
     from docx import Document
@@ -49,21 +55,72 @@ def get_text_color_for_bloom(level):
     return '#1e293b' # Slate-800 for all pastel backgrounds
 
 # --- File Handling ---
-def extract_text_from_pdf(file):
-    """สกัดข้อความจากไฟล์ PDF (Cached)"""
+# จำนวน process ที่ใช้อ่านหน้า PDF พร้อมกัน และจำนวนหน้าขั้นต่ำที่คุ้มกับการแยก process
+PDF_PAGE_WORKERS = int(os.getenv('PDF_PAGE_WORKERS', str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '8'))
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _get_page_pool():
+    """Process pool ระดับ process สำหรับอ่านหน้า PDF (สร้างครั้งแรกที่ใช้)
+
+    ใช้ spawn แทน fork: process ของ Streamlit มีหลาย thread (job runner, hedge pool) และ lock ที่ถืออยู่
+    ขณะ fork จะติดไปค้างใน process ลูก
+    """
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(max_workers=PDF_PAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _page_pool
+
+def _page_text(page):
+    try:
+        return (page.get_text() if hasattr(page, 'get_text') else page.extract_text()) or ""
+    except Exception:
+        return ""
+
+def _extract_page_range(data, start, stop):
+    """อ่านข้อความหน้า start..stop-1 (รันใน worker process จึงเปิดไฟล์จาก bytes ใหม่)"""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+def iter_pdf_pages(file, workers=None):
+    """Generator ข้อความทีละหน้าตามลำดับ (ไฟล์ใหญ่อ่านหลายหน้าพร้อมกันใน process pool)"""
     from PyPDF2 import PdfReader
-    text = ""
+    workers = PDF_PAGE_WORKERS if workers is None else workers
     try:
-        pdf_reader = PdfReader(file)
-        for page in pdf_reader.pages:
-            try:
-                page_text = page.get_text() if hasattr(page, 'get_text') else page.extract_text()
-                text += (page_text or "") + "\n"
-            except Exception:
-                text += "\n"
+        data = file.getvalue() if hasattr(file, 'getvalue') else file.read()
+        reader = PdfReader(io.BytesIO(data))
+        total = len(reader.pages)
     except Exception:
-        pass
-    return text.strip()
+        return
+
+    next_page = 0
+    if workers > 1 and total >= PDF_PARALLEL_MIN_PAGES:
+        # แบ่งเป็นช่วงละหลายหน้า (ลด overhead ของการส่ง bytes ไป worker) แต่ยังเล็กพอให้หน้าแรกๆ ออกมาเร็ว
+        size = max(1, math.ceil(total / (workers * 4)))
+        futures = []
+        try:
+            pool = _get_page_pool()
+            futures = [pool.submit(_extract_page_range, data, start, min(total, start + size)) for start in range(0, total, size)]
+            for future in futures:
+                for page_text in future.result():
+                    next_page += 1
+                    yield page_text
+        except Exception as e:
+            # pool ใช้ไม่ได้ (เช่น process ลูกตาย) อ่านหน้าที่เหลือใน process นี้แทน
+            print(f"PDF page pool failed, reading sequentially: {e}")
+            for future in futures:
+                future.cancel()
+
+    for i in range(next_page, total):
+        yield _page_text(reader.pages[i])
+
+def extract_text_from_pdf(file):
+    """สกัดข้อความจากไฟล์ PDF (รวมทุกหน้าจาก iter_pdf_pages)"""
+    return "\n".join(iter_pdf_pages(file)).strip()
 
 def extract_text_from_docx(file):
     """สกัดข้อความจากไฟล์ DOCX (อ่านพารากราฟและตาราง)"""
@@ -93,33 +150,8 @@ def extract_text_from_docx(file):
         return None
 
 def clean_and_normalize(text):
-    """ทำความสะอาดข้อความและแปลงเลขไทยเป็นเลขอารบิก"""
-    if not text: return ""
-    # 1. แปลงเลขไทย
-    thai_digits = "๐๑๒๓๔๕๖๗๘๙"
-    for i, digit in enumerate(thai_digits):
-        text = text.replace(digit, str(i))
-    
-    # 2. ทำความสะอาดตัวอักษรพิเศษและช่องว่าง
-    text = re.sub(r'[ \t]+', ' ', text) 
-    text = text.replace('\r', '')
-    
-    # 3. ทำให้ตัวเลือกติดกับจุด (เช่น ก . -> ก.)
-    text = re.sub(r'([ก-งA-D])\s*\.', r'\1.', text)
-    
-    # 4. ทำให้เลขข้อติดกับจุด (เช่น 1 . -> 1.)
-    text = re.sub(r'(\d+)\s*\.', r'\1.', text)
-    
-    # NEW: Insert newline before potential question start if preceded by punctuation or space
-    # Matches: "text. 2. text" -> "text.\n2. text"
-    # Matches: "text (2) text" -> "text\n(2) text"
-    text = re.sub(r'(\s+)(\(?\d+[\.\)])\s', r'\n\2 ', text)
-    
-    # 5. ลบบรรทัดว่างที่ติดกันหลายบรรทัด
-    text = re.sub(r'\n{2,}', '\n', text)
-    
-    lines = [line.strip() for line in text.split('\n')]
-    return '\n'.join(lines)
+    """ทำความสะอาดข้อความและแปลงเลขไทยเป็นเลขอารบิก (ดู question_scanner.normalize_exam_text)"""
+    return normalize_exam_text(text)
 
 # --- Prompts ---
 def load_prompts(prompt_path_override=None) -> tuple[str, str]:
@@ -161,10 +193,12 @@ def load_prompts(prompt_path_override=None) -> tuple[str, str]:
         )
 
 # --- Analysis Helpers ---
+ERROR_REASONING = "AI วิเคราะห์ล้มเหลว"
+
 def create_error_response(error_message):
     """สร้าง response เมื่อเกิดข้อผิดพลาด"""
     return {
-        "bloom_level": "ไม่สามารถระบุได้", "reasoning": "AI วิเคราะห์ล้มเหลว",
+        "bloom_level": "ไม่สามารถระบุได้", "reasoning": ERROR_REASONING,
         "difficulty": "ไม่สามารถประเมินได้", "curriculum_standard": "ไม่สามารถระบุได้",
         "correct_option": "ไม่ระบุ", "correct_option_analysis": "ไม่ระบุ",
         "distractor_analysis": "ไม่ระบุ", "why_good_distractor": "ไม่ระบุ",
@@ -172,6 +206,33 @@ def create_error_response(error_message):
         "improvement_suggestion": f"**เกิดข้อผิดพลาด**: {error_message}"
     }
 
+PENDING_BLOOM_LEVEL = "⏳ กำลังวิเคราะห์"
+
+def create_pending_response():
+    """ตัวแทนผลลัพธ์ของข้อที่ยังวิเคราะห์ไม่เสร็จ (ใช้แสดงผลระหว่างวิเคราะห์)"""
+    return {
+        "bloom_level": PENDING_BLOOM_LEVEL, "reasoning": "-",
+        "difficulty": "-", "curriculum_standard": "-",
+        "correct_option": "-", "correct_option_analysis": "-",
+        "distractor_analysis": "-", "why_good_distractor": "-",
+        "is_good_question": False,
+        "improvement_suggestion": "รอผลการวิเคราะห์..."
+    }
+
+def is_pending_response(analysis):
+    """ตรวจว่าเป็นข้อที่ยังวิเคราะห์ไม่เสร็จหรือไม่"""
+    return not analysis or analysis.get("bloom_level") == PENDING_BLOOM_LEVEL
+
+def is_error_response(analysis):
+    """ตรวจว่าเป็นผลลัพธ์จาก create_error_response หรือไม่ (ไม่ควรนำไป cache/นับเป็นผลสำเร็จ)"""
+    return not analysis or analysis.get("reasoning") == ERROR_REASONING
+
+def normalize_question_for_key(question_text):
+    """ทำให้ข้อความข้อสอบเป็นรูปแบบมาตรฐานสำหรับใช้เป็น key (ตัดเลขข้อและช่องว่างส่วนเกิน)"""
+    text = clean_and_normalize(question_text or "")
+    text = re.sub(r'^\s*(?:ข้อ(?:ที่)?\s*)?\(?\d+[\.\)]\s*', '', text)
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
 def sanitize_analysis(analysis):
     """ทำความสะอาดและตรวจสอบผลลัพธ์จาก AI (Robust)"""
     required_keys = [
@@ -207,6 +268,16 @@ def sanitize_analysis(analysis):
 
     return result
 
+def apply_answer_key(analysis, answer):
+    """เทียบ correct_option ที่ AI ตอบกับคำตอบจากส่วนเฉลยของไฟล์ (ไม่ต้องเรียก AI เพิ่ม)
+
+    เพิ่ม answer_key และ answer_key_match (None = อ่าน correct_option ไม่ได้)
+    """
+    if not answer or is_error_response(analysis) or is_pending_response(analysis):
+        return analysis
+    predicted = option_index(analysis.get('correct_option'))
+    return dict(analysis, answer_key=answer, answer_key_match=None if predicted is None else predicted == option_index(answer))
+
 def check_bloom_criteria(analysis_results):
     """ตรวจสอบว่าชุดข้อสอบผ่านเกณฑ์การกระจายระดับ Bloom หรือไม่."""
     total = len(analysis_results)
@@ -273,7 +344,7 @@ def export_to_excel(analysis_results, filename="exam_analysis.xlsx"):
     header_fill = PatternFill(start_color="18181B", end_color="18181B", fill_type="solid")
     header_font = Font(color="FFFFFF", bold=True)
     
-    headers = ["ข้อที่", "ระดับ Bloom", "ความยาก", "คุณภาพ", "มาตรฐาน", "คำตอบ", "ข้อเสนอแนะ"]
+    headers = ["ข้อที่", "ระดับ Bloom", "ความยาก", "คุณภาพ", "มาตรฐาน", "คำตอบ", "ข้อเสนอแนะ", "เฉลยในไฟล์"]
     for col, header in enumerate(headers, 1):
         cell = ws.cell(row=1, column=col, value=header)
         cell.fill = header_fill
@@ -289,6 +360,7 @@ def export_to_excel(analysis_results, filename="exam_analysis.xlsx"):
         ws.cell(row=idx+1, column=5, value=item.get('curriculum_standard', 'N/A'))
         ws.cell(row=idx+1, column=6, value=item.get('correct_option', 'N/A'))
         ws.cell(row=idx+1, column=7, value=item.get('improvement_suggestion', 'N/A'))
+        ws.cell(row=idx+1, column=8, value=_answer_key_label(item))
     
     # Auto-adjust column widths
     for col in ws.columns:
@@ -303,6 +375,13 @@ def export_to_excel(analysis_results, filename="exam_analysis.xlsx"):
     output.seek(0)
     return output
 
+def _answer_key_label(item):
+    """คำตอบจากส่วนเฉลยพร้อมผลเทียบกับคำตอบของ AI (ว่างถ้าไฟล์ไม่มีเฉลย)"""
+    if not item.get('answer_key'):
+        return ""
+    match = item.get('answer_key_match')
+    return item['answer_key'] + {True: " (ตรง)", False: " (ไม่ตรง)"}.get(match, "")
+
 def export_to_word(analysis_results, filename="exam_analysis.docx"):
     """Export ผลวิเคราะห์เป็น MS Word (.docx)"""
     if not DOCX_AVAILABLE:
@@ -344,6 +423,9 @@ def export_to_word(analysis_results, filename="exam_analysis.docx"):
         add_row("ความยาก", item.get('difficulty', '-'))
         add_row("ผลการประเมิน", "✅ ดี" if item.get('is_good_question') else "⚠️ ต้องปรับปรุง")
         add_row("มาตรฐาน", item.get('curriculum_standard', '-'))
+        add_row("คำตอบ", item.get('correct_option', '-'))
+        if item.get('answer_key'):
+            add_row("เฉลยในไฟล์", _answer_key_label(item))
         add_row("ข้อเสนอแนะ", item.get('improvement_suggestion', '-'))
         
         doc.add_paragraph("") # Spacing